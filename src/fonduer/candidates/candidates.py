@@ -80,6 +80,15 @@ class CandidateExtractor(UDFRunner):
                 Candidate.type == candidate_class.__tablename__
             ).filter(Candidate.split == split).delete()
 
+    def _clear_ledger(self, stage, split, **kwargs):
+        """Forget the documents whose Candidates clear() deletes, i.e. the
+        documents with Candidates in the split.
+        """
+        # NOTE: Import here to avoid circular imports.
+        from fonduer.utils.utils_udf import delete_split_ledger
+
+        delete_split_ledger(self.session, stage, self.candidate_classes, split)
+
     def clear_all(self, split, **kwargs):
         """Delete all Candidates from given split the database."""
         logger.info("Clearing ALL Candidates.")
@@ -248,6 +248,8 @@ class MentionExtractor(UDFRunner):
 class MentionExtractorUDF(UDF):
     """UDF for performing mention extraction."""
 
+    DOC_ATTRIBUTES = ["sentences", "figures"]
+
     def __init__(self, mention_classes, mention_spaces, matchers, **kwargs):
         """Initialize the MentionExtractorUDF."""
         self.mention_classes = (
@@ -3,18 +3,29 @@ from fonduer.features.feature_libs.core_features import get_core_feats
 from fonduer.features.feature_libs.structural_features import get_structural_feats
 from fonduer.features.feature_libs.table_features import get_table_feats
 from fonduer.features.feature_libs.visual_features import get_visual_feats
+from fonduer.utils.profiler import profile_iter
 
 
 def get_all_feats(candidates):
-    for candidate_id, feature, value in get_core_feats(candidates):
+    for candidate_id, feature, value in profile_iter(
+        "core_features", get_core_feats(candidates)
+    ):
         yield candidate_id, feature, value
-    for candidate_id, feature, value in get_content_feats(candidates):
+    for candidate_id, feature, value in profile_iter(
+        "content_features", get_content_feats(candidates)
+    ):
         yield candidate_id, feature, value
-    for candidate_id, feature, value in get_structural_feats(candidates):
+    for candidate_id, feature, value in profile_iter(
+        "structural_features", get_structural_feats(candidates)
+    ):
         yield candidate_id, feature, value
-    for candidate_id, feature, value in get_table_feats(candidates):
+    for candidate_id, feature, value in profile_iter(
+        "table_features", get_table_feats(candidates)
+    ):
         yield candidate_id, feature, value
-    for candidate_id, feature, value in get_visual_feats(candidates):
+    for candidate_id, feature, value in profile_iter(
+        "visual_features", get_visual_feats(candidates)
+    ):
         yield candidate_id, feature, value
 
 
@@ -8,7 +8,9 @@ from fonduer.utils.utils_udf import (
     ALL_SPLITS,
     add_keys,
     batch_upsert_records,
+    delete_split_ledger,
     get_cands_list_from_split,
+    get_doc_candidate_counts,
     get_docs_from_split,
     get_mapping,
     get_sparse_matrix,
@@ -36,7 +38,9 @@ class Featurizer(UDFRunner):
         )
         self.candidate_classes = candidate_classes
 
-    def apply(self, docs=None, split=0, train=False, clear=True, **kwargs):
+    def apply(
+        self, docs=None, split=0, train=False, clear=True, pass_ids=True, **kwargs
+    ):
         """Apply features to the specified candidates.
 
         :param docs: If provided, apply features to all the candidates in these
@@ -47,12 +51,14 @@ class Featurizer(UDFRunner):
             the features of candidates.
         :param clear: Whether or not to clear the features table before applying
             features.
+        :param pass_ids: Whether to only send document ids to the parallel
+            workers rather than the full documents. Default True.
         """
         if docs:
             # Call apply on the specified docs for all splits
             split = ALL_SPLITS
             super(Featurizer, self).apply(
-                docs, split=split, train=train, clear=clear, **kwargs
+                docs, split=split, train=train, clear=clear, pass_ids=pass_ids, **kwargs
             )
             # Needed to sync the bulk operations
             self.session.commit()
@@ -62,7 +68,12 @@ class Featurizer(UDFRunner):
                 self.session, self.candidate_classes, split
             )
             super(Featurizer, self).apply(
-                split_docs, split=split, train=train, clear=clear, **kwargs
+                split_docs,
+                split=split,
+                train=train,
+                clear=clear,
+                pass_ids=pass_ids,
+                **kwargs
             )
             # Needed to sync the bulk operations
             self.session.commit()
@@ -97,6 +108,20 @@ class Featurizer(UDFRunner):
             query = self.session.query(FeatureKey)
             query.delete(synchronize_session="fetch")
 
+    def _clear_ledger(self, stage, split=0, **kwargs):
+        """Forget the documents whose Features clear() deletes, i.e. the documents
+        with candidates in the split.
+        """
+        delete_split_ledger(self.session, stage, self.candidate_classes, split)
+
+    def _estimate_costs(self, docs, split=0, **kwargs):
+        """Estimate the cost of each document by its number of candidates in
+        the split.
+        """
+        return get_doc_candidate_counts(
+            self.session, self.candidate_classes, docs, split
+        )
+
     def clear_all(self, **kwargs):
         """Delete all Features."""
         logger.info("Clearing ALL Features and FeatureKeys.")
@@ -140,6 +165,7 @@ class FeaturizerUDF(UDF):
                 get_mapping(self.session, Feature, cands, get_all_feats, feature_keys)
             )
             batch_upsert_records(self.session, Feature, records)
+            self._rows_written += len(records)
 
         # Insert all Feature Keys
         if train:
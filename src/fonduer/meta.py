@@ -11,17 +11,19 @@ logger = logging.getLogger(__name__)
 
 
 # Defines procedure for setting up a sessionmaker
-def new_sessionmaker():
+def new_sessionmaker(isolation_level="AUTOCOMMIT"):
     # Turning on autocommit for Postgres, see
     # http://oddbird.net/2014/06/14/sqlalchemy-postgres-autocommit/
     # Otherwise any e.g. query starts a transaction, locking tables... very
     # bad for e.g. multiple notebooks open, multiple processes, etc.
+    # Sessions which must write in transactions (e.g. the UDFs) pass another
+    # isolation_level, and commit regularly.
     if Meta.postgres and Meta.ready:
         engine = create_engine(
             Meta.conn_string,
             client_encoding="utf8",
             use_batch_mode=True,
-            isolation_level="AUTOCOMMIT",
+            isolation_level=isolation_level,
         )
     else:
         raise ValueError(
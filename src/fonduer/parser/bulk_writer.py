@@ -0,0 +1,197 @@
+"""Persist the Contexts of parsed documents with PostgreSQL COPY."""
+
+import io
+import logging
+
+from sqlalchemy import PickleType, inspect, text
+from sqlalchemy.orm.interfaces import MANYTOONE
+
+from fonduer.meta import Meta
+
+logger = logging.getLogger(__name__)
+
+# Grab pointer to global metadata
+_meta = Meta.init()
+
+# The sequence of the ids of the context table
+CONTEXT_ID_SEQUENCE = "context_id_seq"
+
+# The number of Context ids taken from the sequence at a time
+ID_BLOCK_SIZE = 10000
+
+
+class BulkContextWriter(object):
+    """Write Contexts to the database with COPY rather than through the ORM.
+
+    Adding Sentences to the session inserts them, and every Context they refer
+    to, one row at a time into the context table and into the table of their
+    type. The writer instead collects the new objects which adding them to the
+    session would insert, gives them ids taken from the context sequence in
+    blocks, and streams the rows of each table with a single COPY. Tables are
+    written in the order of their foreign keys.
+
+    The objects are not added to the session.
+
+    :param session: The database session to use.
+    :param id_block_size: The number of ids taken from the sequence at a time.
+    """
+
+    def __init__(self, session, id_block_size=ID_BLOCK_SIZE):
+        self.session = session
+        self.id_block_size = id_block_size
+        self._ids = []
+
+    def write(self, objects):
+        """Write the objects, and the new objects they refer to.
+
+        :param objects: The Contexts to write, e.g. the Sentences of a Document.
+        :return: The number of rows written to each table, by table name.
+        """
+        states = _new_states(objects)
+        for state, id in zip(states, self._take_ids(len(states))):
+            state.obj().id = id
+
+        rows = _table_rows(states)
+        cursor = self.session.connection().connection.cursor()
+        try:
+            for table in _meta.Base.metadata.sorted_tables:
+                if table in rows:
+                    columns, table_rows = rows[table]
+                    cursor.copy_expert(
+                        "COPY {} ({}) FROM STDIN".format(
+                            _quote(table.name), ", ".join(_quote(c) for c in columns)
+                        ),
+                        io.StringIO("".join(table_rows)),
+                    )
+        finally:
+            cursor.close()
+        return {table.name: len(table_rows) for table, (_, table_rows) in rows.items()}
+
+    def _take_ids(self, n):
+        """Return n unused Context ids, taking a block from the sequence if needed."""
+        if len(self._ids) < n:
+            result = self.session.execute(
+                text("SELECT nextval(:seq) FROM generate_series(1, :n)"),
+                {
+                    "seq": CONTEXT_ID_SEQUENCE,
+                    "n": max(n - len(self._ids), self.id_block_size),
+                },
+            )
+            self._ids.extend(row[0] for row in result)
+        ids = self._ids[:n]
+        self._ids = self._ids[n:]
+        return ids
+
+
+def _new_states(objects):
+    """Return the states of the objects which adding objects to a session would
+    insert, i.e. the objects and every object they cascade to, without an id.
+    """
+    states = []
+    seen = set()
+    for obj in objects:
+        state = inspect(obj)
+        # The Sentences of a Document all cascade to each other
+        if state in seen:
+            continue
+        related = [state] + [
+            inspect(o)
+            for o, _, _, _ in state.mapper.cascade_iterator("save-update", state)
+        ]
+        for s in related:
+            if s not in seen:
+                seen.add(s)
+                if not s.has_identity and s.obj().id is None:
+                    states.append(s)
+    return states
+
+
+def _table_rows(states):
+    """Format the rows of each table for the objects.
+
+    :return: A dict of the names of the columns and the rows in the COPY text
+        format, by table.
+    """
+    rows = {}
+    for state in states:
+        mapper = state.mapper
+        obj = state.obj()
+        values = _column_values(mapper, obj)
+        for table in mapper.tables:
+            columns = [c for c in table.columns]
+            if table not in rows:
+                rows[table] = ([c.name for c in columns], [])
+            rows[table][1].append(
+                "\t".join(_format_field(c, values.get(c)) for c in columns) + "\n"
+            )
+    return rows
+
+
+def _column_values(mapper, obj):
+    """Return the value of each column of the object, by column.
+
+    Foreign keys are taken from the objects the object refers to, as the ORM
+    only sets them when flushing.
+    """
+    values = {}
+    for table in mapper.tables:
+        for column in table.columns:
+            if column is mapper.polymorphic_on:
+                values[column] = mapper.polymorphic_identity
+                continue
+            value = getattr(obj, mapper.get_property_by_column(column).key)
+            if value is None and column.default is not None:
+                if column.default.is_scalar:
+                    value = column.default.arg
+            values[column] = value
+
+    for relationship in mapper.relationships:
+        if relationship.direction is not MANYTOONE:
+            continue
+        target = obj.__dict__.get(relationship.key)
+        if target is None:
+            continue
+        for local, remote in relationship.local_remote_pairs:
+            values[local] = getattr(
+                target, relationship.mapper.get_property_by_column(remote).key
+            )
+    return values
+
+
+def _quote(name):
+    return '"{}"'.format(name)
+
+
+def _format_field(column, value):
+    """Format a value of a column for the COPY text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(column.type, PickleType):
+        value = column.type.pickler.dumps(value, column.type.protocol)
+    return _escape(_format_value(value))
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, bytes):
+        return "\\x" + value.hex()
+    if isinstance(value, (list, tuple)):
+        return "{" + ",".join(_format_array_element(v) for v in value) + "}"
+    return str(value)
+
+
+def _format_array_element(value):
+    if value is None:
+        return "NULL"
+    return '"' + _format_value(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _escape(value):
+    """Escape the special characters of the COPY text format."""
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+        .replace("\t", "\\t")
+    )
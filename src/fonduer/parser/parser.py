@@ -1,3 +1,4 @@
+import hashlib
 import itertools
 import logging
 import os
@@ -5,28 +6,110 @@ import re
 import warnings
 from builtins import range
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import lxml.etree
 import lxml.html
+from sqlalchemy import or_, select
+from sqlalchemy.dialects.postgresql import insert
 
+from fonduer.meta import Meta
+from fonduer.parser.bulk_writer import BulkContextWriter
 from fonduer.parser.models import (
     Caption,
     Cell,
     Context,
+    Document,
     Figure,
     Paragraph,
     Section,
     Sentence,
     Table,
     construct_stable_id,
+    split_stable_id,
 )
+from fonduer.parser.pdf_extractors import EXTRACTORS, PDFExtractor
+from fonduer.parser.rule_tokenizer import RuleTokenizer
 from fonduer.parser.simple_tokenizer import SimpleTokenizer
 from fonduer.parser.spacy_parser import Spacy
-from fonduer.parser.visual_linker import VisualLinker
-from fonduer.utils.udf import UDF, UDFRunner
+from fonduer.parser.visual_linker import LINK_METHODS, VisualLinker
+from fonduer.utils.models import ContentHash
+from fonduer.utils.profiler import profile_iter
+from fonduer.utils.udf import UDF, UDFRunner, _config_hash
 
 logger = logging.getLogger(__name__)
 
+# Grab pointer to global metadata
+_meta = Meta.init()
+
+# The number of characters of HTML fed to the parser at a time when streaming
+STREAM_CHUNK_CHARS = 1 << 16
+
+# The number of elements read before the open elements are moved to the spine
+# when streaming
+STREAM_BLOCK_SIZE = 1000
+
+# The block-level elements which can be moved to the spine when streaming. The
+# tail of an element of the spine is read after its children, which are then
+# renumbered, so inline elements, whose tail usually holds text, are kept out
+# of the spine.
+STREAM_SPINE_TAGS = {
+    "article",
+    "aside",
+    "blockquote",
+    "body",
+    "dd",
+    "div",
+    "dl",
+    "dt",
+    "footer",
+    "form",
+    "header",
+    "li",
+    "main",
+    "nav",
+    "ol",
+    "p",
+    "section",
+    "table",
+    "tbody",
+    "td",
+    "tfoot",
+    "th",
+    "thead",
+    "tr",
+    "ul",
+}
+
+# The number of PDFs extracted at once when prefetching, i.e. the PDFs of the
+# current and of the next document
+PDF_PREFETCH_THREADS = 2
+
+# The number of stored documents deleted at a time before they are parsed again
+DELETE_BATCH_SIZE = 100
+
+# The settings of the Parser which change the parse of a document, hashed with
+# its text when parsing incrementally. Streaming keeps the document text with
+# the flattened tags, so it changes the stored Document. The others (e.g.
+# batch_split_sentences or bulk_copy) only change how fast the documents are
+# parsed.
+OUTPUT_SETTINGS = [
+    "structural",
+    "blacklist",
+    "flatten",
+    "lingual",
+    "strip",
+    "replacements",
+    "tabular",
+    "visual",
+    "pdf_path",
+    "language",
+    "tokenizer",
+    "pdf_link_method",
+    "pdf_extractor",
+    "streaming",
+]
+
 
 class Parser(UDFRunner):
     def __init__(
@@ -43,6 +126,17 @@ class Parser(UDFRunner):
         tabular=True,  # tabular information
         visual=False,  # visual information
         pdf_path=None,
+        nlp_batch_size=None,
+        batch_split_sentences=False,
+        bulk_copy=False,
+        preload_model=False,
+        streaming=False,
+        tokenizer="spacy",
+        pdf_cache_dir=None,
+        pdf_cache_size=None,
+        pdf_link_method="search",
+        pdf_extractor="poppler",
+        prefetch_pdf=False,
     ):
         """Initialize the Parser.
 
@@ -61,7 +155,84 @@ class Parser(UDFRunner):
         :param visual: Whether to include visual information in the parse.
             Requires PDFs for each input document.
         :param pdf_path: The path to the corresponding PDFs use for visual info.
+        :param nlp_batch_size: If set, each sentence is parsed by spaCy as its
+            own Doc, and the sentences of each document go through the spaCy
+            pipeline in batches of this size. Batches do not span documents.
+            Batching is faster, but tags can differ slightly as the model does
+            not see the neighboring sentences. Default None.
+        :param batch_split_sentences: Whether to tokenize and split the text of
+            all the paragraphs of a document at once, after traversing the
+            document, rather than one paragraph at a time. The parse is the
+            same. Default False.
+        :param bulk_copy: Whether to write the parsed Contexts with PostgreSQL
+            COPY rather than through the ORM. Requires a PostgreSQL database.
+            Default False.
+        :param preload_model: Whether to load the spaCy model of the language
+            once in this process, before the workers are forked, rather than
+            in every worker. The workers then share the memory of the model.
+            Default False.
+        :param streaming: Whether to parse each document while its HTML is
+            read, freeing the elements once parsed, rather than building its
+            whole tree first. This bounds the memory needed for very large
+            documents. The Sentences are the same as without streaming, but
+            the Sentences of the tail of a block-level element may come after
+            the ones of its children. The document text is kept without the
+            flattened tags stripped.
+            Default False.
+        :param tokenizer: How to tokenize and split sentences. "spacy" uses
+            the spaCy model of the language, and "rule" a rule-based tokenizer
+            which needs no model, e.g. for a Parser which is not lingual.
+            Default "spacy".
+        :param pdf_cache_dir: If set, the words and boxes extracted from the
+            PDFs for visual info are cached in this directory, and PDFs which
+            are in the cache are not read again, e.g. when the documents are
+            parsed again with other settings. Default None.
+        :param pdf_cache_size: The maximum size of the PDF cache in bytes. The
+            least recently used PDFs are evicted beyond it. Default None, for
+            no limit.
+        :param pdf_link_method: How the words of each document are linked to
+            the words of its PDF for visual info. "search" searches for exact,
+            then approximate matches near the words already linked. "anchors"
+            aligns the words on the words found once in both, which is faster
+            on long documents. Default "search".
+        :param pdf_extractor: How the words and boxes of the PDFs are
+            extracted for visual info. "poppler" runs pdftotext of
+            poppler-utils, and "pdfminer" extracts them in process with
+            pdfminer.six, which needs no external program. A PDFExtractor may
+            also be given. Default "poppler".
+        :param prefetch_pdf: Whether to extract the words of the PDF of each
+            document on a background thread as soon as the document is
+            received, and of the next document of the same chunk while the
+            document is parsed, rather than after the document is parsed.
+            Default False.
         """
+        if bulk_copy and not _meta.postgres:
+            raise ValueError("bulk_copy requires a PostgreSQL database.")
+        if pdf_link_method not in LINK_METHODS:
+            raise ValueError(
+                "Unknown pdf_link_method {}, must be one of {}.".format(
+                    pdf_link_method, LINK_METHODS
+                )
+            )
+        if (
+            not isinstance(pdf_extractor, PDFExtractor)
+            and pdf_extractor not in EXTRACTORS
+        ):
+            raise ValueError(
+                "Unknown pdf_extractor {}, must be one of {}.".format(
+                    pdf_extractor, sorted(EXTRACTORS)
+                )
+            )
+        if tokenizer not in ["spacy", "rule"]:
+            raise ValueError(
+                "Unknown tokenizer {}, must be 'spacy' or 'rule'.".format(tokenizer)
+            )
+        if (
+            preload_model
+            and (lingual or tokenizer == "spacy")
+            and Spacy(language).has_tokenizer_support()
+        ):
+            Spacy.preload(language)
         super(Parser, self).__init__(
             session,
             ParserUDF,
@@ -76,13 +247,272 @@ class Parser(UDFRunner):
             visual=visual,
             pdf_path=pdf_path,
             language=language,
+            nlp_batch_size=nlp_batch_size,
+            batch_split_sentences=batch_split_sentences,
+            bulk_copy=bulk_copy,
+            streaming=streaming,
+            tokenizer=tokenizer,
+            pdf_cache_dir=pdf_cache_dir,
+            pdf_cache_size=pdf_cache_size,
+            pdf_link_method=pdf_link_method,
+            pdf_extractor=pdf_extractor,
+            prefetch_pdf=prefetch_pdf,
+        )
+
+    def apply(self, doc_loader, incremental=False, **kwargs):
+        """Run the Parser.
+
+        :param doc_loader: The documents to parse, e.g. a DocPreprocessor.
+        :param incremental: Whether to only parse the documents which are new
+            or changed since they were last parsed, rather than clearing. A
+            hash of the text of each document and of the settings of the
+            Parser which change its parse (see OUTPUT_SETTINGS) is stored in
+            the ContentHash table. A document whose hash changed is deleted
+            first, with its Contexts, Mentions, Candidates and their
+            annotations (e.g. features and labels). Documents missing from the
+            doc_loader are kept. The doc_loader is read once to find
+            the changed documents, and again by the workers if it can be,
+            e.g. a DocPreprocessor. Default False.
+
+        The other arguments are the arguments of UDFRunner.apply.
+        """
+        if incremental:
+            kwargs["clear"] = False
+            doc_loader = self._changed_documents(doc_loader)
+        super(Parser, self).apply(doc_loader, **kwargs)
+
+    def _output_config(self):
+        """Return the settings of the Parser which change the parse."""
+        config = {name: self.udf_init_kwargs[name] for name in OUTPUT_SETTINGS}
+        # Parsing each sentence as its own Doc changes the tags, whatever the
+        # size of the batches
+        config["nlp_batched"] = self.udf_init_kwargs["nlp_batch_size"] is not None
+        return config
+
+    def _stage_config_hash(self, **kwargs):
+        """Record the finished documents in the ledger under the settings
+        which change the parse, so that resuming with other performance
+        settings (e.g. the parallelism of the NLP) skips them.
+        """
+        return _config_hash(self._output_config(), kwargs)
+
+    def _changed_documents(self, doc_loader):
+        """Return the documents which are new or whose content hash changed,
+        after deleting the stored version of the changed ones.
+
+        The documents are read and the stored ones deleted here, before the
+        workers are forked. A doc_loader which can be read again, e.g. a
+        DocPreprocessor, is read again by the workers, keeping only the
+        changed documents. Otherwise, the changed documents are kept in a list.
+        """
+        config_hash = _config_hash(self._output_config())
+        stored = {
+            name: (doc_id, content_hash)
+            for name, doc_id, content_hash in self.session.query(
+                Document.name, Document.id, ContentHash.content_hash
+            ).outerjoin(ContentHash, ContentHash.document_name == Document.name)
+        }
+
+        reread = _rereadable(doc_loader)
+        content_hashes = {}
+        docs = []
+        n_unchanged = 0
+        for doc in doc_loader:
+            content_hash = _content_hash(doc.text, config_hash)
+            if doc.name in stored and stored[doc.name][1] == content_hash:
+                n_unchanged += 1
+                continue
+            content_hashes[doc.name] = content_hash
+            if not reread:
+                # Stored with the outputs of the document by ParserUDF
+                doc.content_hash = content_hash
+                docs.append(doc)
+        self.logger.info("Skipped {} unchanged documents".format(n_unchanged))
+
+        self._delete_stored(
+            content_hashes, {name: doc_id for name, (doc_id, _) in stored.items()}
         )
+        if reread:
+            return _with_content_hashes(doc_loader, content_hashes)
+        return docs
+
+    def _clean_unfinished(self, doc_loader, finished):
+        """Delete the documents which were stored without being recorded in
+        the ledger, e.g. by a run with another configuration, before they are
+        parsed again.
+
+        The documents are read and the stored ones deleted here, before the
+        workers are forked, as in _changed_documents.
+        """
+        stored = {
+            name: doc_id
+            for name, doc_id in self.session.query(Document.name, Document.id)
+            if name not in finished
+        }
+        if not stored:
+            return doc_loader
+        if _rereadable(doc_loader):
+            self._delete_stored([doc.name for doc in doc_loader], stored)
+            return doc_loader
+        docs = [doc for doc in doc_loader if doc.name not in finished]
+        self._delete_stored([doc.name for doc in docs], stored)
+        return docs
+
+    def _delete_stored(self, names, stored):
+        """Delete the stored version of the documents with the given names,
+        DELETE_BATCH_SIZE documents at a time.
+
+        :param names: The names of the documents to parse, in order.
+        :param stored: The ids of the stored documents, by name.
+        """
+        doc_ids = [stored[name] for name in names if name in stored]
+        for i in range(0, len(doc_ids), DELETE_BATCH_SIZE):
+            self._delete_documents(doc_ids[i : i + DELETE_BATCH_SIZE])
+        if doc_ids:
+            self.session.commit()
+
+    def _delete_documents(self, doc_ids):
+        """Delete the documents with the given ids and everything derived
+        from them.
+
+        The rows of Candidate and Mention subclasses are deleted through the
+        ForeignKey to their Document, so their rows in the candidate and
+        mention tables, and the annotations of the Candidates, are deleted
+        first. Then the Contexts of the documents are deleted with a single
+        statement.
+        """
+        for base in ["candidate", "mention"]:
+            base_table = _meta.Base.metadata.tables[base]
+            subtables = _document_subtables(base)
+            if subtables:
+                self.session.execute(
+                    base_table.delete().where(
+                        or_(
+                            *[
+                                base_table.c.id.in_(
+                                    select([table.c.id]).where(
+                                        table.c.document_id.in_(doc_ids)
+                                    )
+                                )
+                                for table in subtables
+                            ]
+                        )
+                    )
+                )
+        self.session.execute(_delete_contexts(doc_ids))
 
     def clear(self, **kwargs):
         self.session.query(Context).delete()
 
 
+def _read_html_events(text):
+    """Yield the start and end events of the elements of an HTML text, feeding
+    the text to the parser in chunks.
+    """
+    parser = lxml.etree.HTMLPullParser(events=("start", "end"))
+    for offset in range(0, len(text), STREAM_CHUNK_CHARS):
+        parser.feed(text[offset : offset + STREAM_CHUNK_CHARS])
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
+def _strip_element(node):
+    """Remove the node from the tree, keeping its text, children and tail in
+    its place, as lxml.etree.strip_tags does for each stripped element.
+    """
+    parent = node.getparent()
+    previous = node.getprevious()
+    if node.text:
+        if previous is not None:
+            previous.tail = (previous.tail or "") + node.text
+        else:
+            parent.text = (parent.text or "") + node.text
+    for child in list(node):
+        node.addprevious(child)
+    previous = node.getprevious()
+    if node.tail:
+        if previous is not None:
+            previous.tail = (previous.tail or "") + node.tail
+        else:
+            parent.text = (parent.text or "") + node.tail
+    node.tail = None
+    parent.remove(node)
+
+
+def _rereadable(doc_loader):
+    """Whether the doc_loader reads its documents again at each iteration,
+    e.g. a DocPreprocessor, rather than holding them or being an iterator.
+    """
+    if isinstance(doc_loader, (list, tuple)):
+        return False
+    return iter(doc_loader) is not doc_loader
+
+
+def _with_content_hashes(doc_loader, content_hashes):
+    """Yield the documents which have a content hash, setting it on each."""
+    for doc in doc_loader:
+        if doc.name in content_hashes:
+            # Stored with the outputs of the document by ParserUDF
+            doc.content_hash = content_hashes[doc.name]
+            yield doc
+
+
+def _content_hash(text, config_hash):
+    """Return a hash of the text of a document and of the Parser configuration."""
+    return hashlib.sha256((config_hash + "\0" + (text or "")).encode()).hexdigest()
+
+
+def _delete_contexts(doc_ids):
+    """Return a statement deleting the documents with the given ids and all
+    of their Contexts, including the spans and images of their Mentions.
+    """
+    context = _meta.Base.metadata.tables["context"]
+    sentence = _meta.Base.metadata.tables["sentence"]
+    sentence_ids = select([sentence.c.id]).where(sentence.c.document_id.in_(doc_ids))
+    clauses = [context.c.id.in_(doc_ids)]
+    for table in _context_subtables():
+        if "document_id" in table.c:
+            clauses.append(
+                context.c.id.in_(
+                    select([table.c.id]).where(table.c.document_id.in_(doc_ids))
+                )
+            )
+        elif "sentence_id" in table.c:
+            clauses.append(
+                context.c.id.in_(
+                    select([table.c.id]).where(table.c.sentence_id.in_(sentence_ids))
+                )
+            )
+    return context.delete().where(or_(*clauses))
+
+
+def _context_subtables():
+    """Return the tables of the subclasses of Context."""
+    return [
+        table
+        for table in _meta.Base.metadata.sorted_tables
+        if "id" in table.c
+        and any(fk.column.table.name == "context" for fk in table.c.id.foreign_keys)
+    ]
+
+
+def _document_subtables(base):
+    """Return the tables of the subclasses of base which belong to a Document,
+    e.g. the tables of the Candidate subclasses for "candidate".
+    """
+    return [
+        table
+        for table in _meta.Base.metadata.sorted_tables
+        if "document_id" in table.c
+        and "id" in table.c
+        and any(fk.column.table.name == base for fk in table.c.id.foreign_keys)
+    ]
+
+
 class ParserUDF(UDF):
+    DOC_ATTRIBUTES = ["text"]
+
     def __init__(
         self,
         structural,
@@ -95,6 +525,16 @@ class ParserUDF(UDF):
         visual,
         pdf_path,
         language,
+        nlp_batch_size=None,
+        batch_split_sentences=False,
+        bulk_copy=False,
+        streaming=False,
+        tokenizer="spacy",
+        pdf_cache_dir=None,
+        pdf_cache_size=None,
+        pdf_link_method="search",
+        pdf_extractor="poppler",
+        prefetch_pdf=False,
         **kwargs
     ):
         """
@@ -106,6 +546,26 @@ class ParserUDF(UDF):
             _pattern_ isinstance a regex and _replace_ is a character string.
             All occurents of _pattern_ in the text will be replaced by
             _replace_.
+        :param nlp_batch_size: if set, the number of sentences which go through
+            the spaCy pipeline at a time, each sentence as its own Doc
+        :param batch_split_sentences: boolean, if True the sentences of all
+            paragraphs of a document are split in one batch
+        :param bulk_copy: boolean, if True the Contexts of each document are
+            written with COPY rather than added to the session
+        :param streaming: boolean, if True each document is parsed while its
+            HTML is read
+        :param tokenizer: "spacy" to tokenize with the spaCy model, or "rule"
+            to tokenize with a RuleTokenizer
+        :param pdf_cache_dir: directory where the words extracted from PDFs
+            are cached, or None to not cache them
+        :param pdf_cache_size: maximum size of the PDF cache in bytes
+        :param pdf_link_method: "search" or "anchors", how the words of the
+            document are linked to the words of its PDF
+        :param pdf_extractor: the name of a PDFExtractor, or a PDFExtractor,
+            which extracts the words of the PDFs
+        :param prefetch_pdf: boolean, if True the words of the PDF of each
+            document are extracted on a background thread while the document
+            is parsed
         """
         super(ParserUDF, self).__init__(**kwargs)
 
@@ -122,9 +582,18 @@ class ParserUDF(UDF):
             self.replacements.append((re.compile(pattern, flags=re.UNICODE), replace))
 
         self.lingual = lingual
-        self.lingual_parser = Spacy(self.language)
-        if self.lingual_parser.has_tokenizer_support():
+        self.streaming = streaming
+        self.batch_split_sentences = batch_split_sentences
+        self.lingual_parser = Spacy(self.language, batch_size=nlp_batch_size)
+        self.split_sentences_batch = None
+        if tokenizer == "rule":
+            self.tokenize_and_split_sentences = RuleTokenizer().parse
+            # Only the NLP pipeline needs the model
+            if self.lingual and self.lingual_parser.has_NLP_support():
+                self.lingual_parser.load_lang_model()
+        elif self.lingual_parser.has_tokenizer_support():
             self.tokenize_and_split_sentences = self.lingual_parser.split_sentences
+            self.split_sentences_batch = self.lingual_parser.split_sentences_batch
             self.lingual_parser.load_lang_model()
         else:
             self.tokenize_and_split_sentences = SimpleTokenizer().parse
@@ -149,9 +618,27 @@ class ParserUDF(UDF):
         self.visual = visual
         if self.visual:
             self.pdf_path = pdf_path
-            self.vizlink = VisualLinker()
+            self.vizlink = VisualLinker(
+                cache_dir=pdf_cache_dir,
+                cache_size=pdf_cache_size,
+                link_method=pdf_link_method,
+                extractor=pdf_extractor,
+            )
+        self.prefetch_pdf = prefetch_pdf
+        self._pdf_executor = None
+        # The Futures of the words of the PDFs being extracted, by document name
+        self._pdf_words = {}
+
+        self.bulk_writer = BulkContextWriter(self.session) if bulk_copy else None
+        # The content hashes of the parsed documents, by document name, see
+        # Parser.apply(incremental=True)
+        self._content_hashes = {}
 
     def apply(self, document, **kwargs):
+        content_hash = getattr(document, "content_hash", None)
+        if content_hash is not None:
+            self._content_hashes[document.name] = content_hash
+
         # The document is the Document model
         text = document.text
         if self.visual:
@@ -175,16 +662,72 @@ class ParserUDF(UDF):
                 self.visual = False
                 yield from self.parse(document, text)
             else:
+                # Start extracting the words of the PDF while the document is
+                # parsed, if not started already
+                self._prepare(document)
                 # Populate document.sentences
                 for _ in self.parse(document, text):
                     pass
                 # Add visual attributes
-                yield from self.vizlink.parse_visual(
-                    document.name, document.sentences, self.pdf_path
+                yield from profile_iter(
+                    "visual",
+                    self.vizlink.parse_visual(
+                        document.name,
+                        # Streaming may parse a Sentence after the next ones
+                        sorted(document.sentences, key=lambda s: s.position),
+                        self.pdf_path,
+                        pdf_words=self._pdf_words.pop(document.name, None),
+                    ),
                 )
         else:
             yield from self.parse(document, text)
 
+    def _prepare(self, document):
+        """Start extracting the words of the PDF of the document on a
+        background thread, if prefetch_pdf is set.
+        """
+        if (
+            not (self.visual and self.prefetch_pdf and self.pdf_path)
+            or document.name in self._pdf_words
+            or not self._valid_pdf(self.pdf_path, document.name)
+        ):
+            return
+        if self._pdf_executor is None:
+            self._pdf_executor = ThreadPoolExecutor(max_workers=PDF_PREFETCH_THREADS)
+        pdf_file = self.vizlink.find_pdf_file(document.name, self.pdf_path)
+        self._pdf_words[document.name] = self._pdf_executor.submit(
+            self.vizlink.extract_words, pdf_file
+        )
+
+    def _add_outputs(self, objects):
+        """Write the Sentences of one document, and the Contexts they refer to."""
+        if self.bulk_writer is None:
+            super(ParserUDF, self)._add_outputs(objects)
+        else:
+            self.bulk_writer.write(objects)
+
+    def _commit(self):
+        """Store the content hashes of the finished documents with their
+        outputs, then commit.
+        """
+        rows = [
+            {"document_name": name, "content_hash": self._content_hashes[name]}
+            for name in self._finished_docs
+            if name in self._content_hashes
+        ]
+        self._content_hashes = {}
+        if rows:
+            # The Documents must be inserted before their hashes
+            self.session.flush()
+            stmt = insert(ContentHash).values(rows)
+            self.session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[ContentHash.document_name],
+                    set_={"content_hash": stmt.excluded.content_hash},
+                )
+            )
+        super(ParserUDF, self)._commit()
+
     def _valid_pdf(self, path, filename):
         """Verify that the file exists and has a PDF extension."""
         # If path is file, but not PDF.
@@ -375,18 +918,24 @@ class ParserUDF(UDF):
         state["figure"]["idx"] += 1
         return state
 
-    def _parse_sentence(self, paragraph, node, state):
+    def _parse_sentence(self, paragraph, node, state, split_sentences=None):
         """Parse the Sentences of the node.
 
         :param node: The lxml node to parse
         :param state: The global state necessary to place the node in context
             of the document as a whole.
+        :param split_sentences: The parts of the Sentences of the paragraph
+            text, if it was already tokenized and split.
         """
         text = state["paragraph"]["text"]
         field = state["paragraph"]["field"]
         # Lingual Parse
         document = state["document"]
-        for parts in self.tokenize_and_split_sentences(document, text):
+        if split_sentences is None:
+            split_sentences = profile_iter(
+                "tokenize", self.tokenize_and_split_sentences(document, text)
+            )
+        for parts in split_sentences:
             parts["document"] = document
             # NOTE: Why do we overwrite this from the spacy parse?
             parts["position"] = state["sentence"]["idx"]
@@ -404,8 +953,12 @@ class ParserUDF(UDF):
             state["sentence"]["abs_offset"] = abs_sentence_offset_end
             if self.structural:
                 context_node = node.getparent() if field == "tail" else node
-                tree = lxml.etree.ElementTree(state["root"])
-                parts["xpath"] = tree.getpath(context_node)
+                if state["structure"]["anchors"] is None:
+                    parts["xpath"] = self._get_xpath(context_node, state)
+                else:
+                    anchor, parts["xpath"] = self._get_relative_xpath(
+                        context_node, state
+                    )
                 parts["html_tag"] = context_node.tag
                 parts["html_attrs"] = [
                     "=".join(x) for x in list(context_node.attrib.items())
@@ -418,41 +971,17 @@ class ParserUDF(UDF):
                     if attr.find("style") >= 0:
                         cur_style_index = index
                         break
-                head = state["root"].find("head")
-                styles = None
-                if head is not None:
-                    styles = head.find("style")
-                if styles is not None:
-                    for x in list(context_node.attrib.items()):
-                        if x[0] == "class":
-                            exp = r"(." + x[1] + ")([\n\s\r]*)\{(.*?)\}"
-                            r = re.compile(exp, re.DOTALL)
-                            if r.search(styles.text) is not None:
-                                if cur_style_index is not None:
-                                    parts["html_attrs"][cur_style_index] += (
-                                        r.search(styles.text)
-                                        .group(3)
-                                        .replace("\r", "")
-                                        .replace("\n", "")
-                                        .replace("\t", "")
-                                    )
-                                else:
-                                    parts["html_attrs"].extend(
-                                        [
-                                            "style="
-                                            + re.sub(
-                                                r"\s{1,}",
-                                                " ",
-                                                r.search(styles.text)
-                                                .group(3)
-                                                .replace("\r", "")
-                                                .replace("\n", "")
-                                                .replace("\t", "")
-                                                .strip(),
-                                            )
-                                        ]
-                                    )
-                            break
+                for x in list(context_node.attrib.items()):
+                    if x[0] == "class":
+                        style = self._get_class_style(x[1], state)
+                        if style is not None:
+                            if cur_style_index is not None:
+                                parts["html_attrs"][cur_style_index] += style
+                            else:
+                                parts["html_attrs"].extend(
+                                    ["style=" + re.sub(r"\s{1,}", " ", style.strip())]
+                                )
+                        break
             if self.tabular:
                 parts["position"] = state["sentence"]["idx"]
 
@@ -471,10 +1000,70 @@ class ParserUDF(UDF):
                         parts["col_end"] = parent.cell.col_end
                 else:
                     raise NotImplementedError("Sentence parent must be Paragraph.")
-            yield Sentence(**parts)
+            sentence = Sentence(**parts)
+            if self.structural and state["structure"]["anchors"] is not None:
+                state["structure"]["anchors"].append((sentence, anchor))
+            yield sentence
             state["sentence"]["idx"] += 1
 
-    def _parse_paragraph(self, node, state):
+    def _get_xpath(self, node, state):
+        """Return the XPath of the node, computed once per node.
+
+        :param node: The lxml node
+        :param state: The global state necessary to place the node in context
+            of the document as a whole.
+        """
+        xpaths = state["structure"]["xpath"]
+        if node not in xpaths:
+            xpaths[node] = state["structure"]["tree"].getpath(node)
+        return xpaths[node]
+
+    def _get_relative_xpath(self, node, state):
+        """Return the XPath of the node relative to the block being streamed.
+
+        The XPath of a block is only known once the whole document is read, so
+        the XPath of a node is split into an anchor and the rest of the path.
+
+        :param node: The lxml node
+        :param state: The global state necessary to place the node in context
+            of the document as a whole.
+        :return: A tuple of the anchor, i.e. the block or the node itself, and
+            the XPath of the node relative to the anchor.
+        """
+        block = state["structure"]["block"]
+        if block is None or node is block or node is block.getparent():
+            return node, ""
+        xpaths = state["structure"]["relative_xpath"]
+        if node not in xpaths:
+            xpath = lxml.etree.ElementTree(block).getpath(node)
+            xpaths[node] = xpath[len(block.tag) + 1 :]
+        return block, xpaths[node]
+
+    def _get_class_style(self, class_name, state):
+        """Return the style of a class from the inline stylesheet of the document.
+
+        The style of each class is looked up in the stylesheet only once.
+
+        :param class_name: The value of the class attribute of a node
+        :param state: The global state necessary to place the node in context
+            of the document as a whole.
+        :return: The style, or None if the class has no style.
+        """
+        styles = state["structure"]["styles"]
+        if styles is None:
+            return None
+        class_styles = state["structure"]["class_style"]
+        if class_name not in class_styles:
+            exp = r"(." + class_name + r")([\n\s\r]*)\{(.*?)\}"
+            match = re.compile(exp, re.DOTALL).search(styles)
+            class_styles[class_name] = (
+                match.group(3).replace("\r", "").replace("\n", "").replace("\t", "")
+                if match is not None
+                else None
+            )
+        return class_styles[class_name]
+
+    def _parse_paragraph(self, node, state, fields=("text", "tail")):
         """Parse a Paragraph of the node.
 
         A Paragraph is defined as
@@ -482,6 +1071,7 @@ class ParserUDF(UDF):
         :param node: The lxml node to parse
         :param state: The global state necessary to place the node in context
             of the document as a whole.
+        :param fields: The fields of the node to parse, among "text" and "tail".
         """
 
         # Both Paragraphs will share the same parent
@@ -491,7 +1081,7 @@ class ParserUDF(UDF):
             else state["parent"][node]
         )
 
-        for field in ["text", "tail"]:
+        for field in fields:
             text = getattr(node, field)
             text = text.strip() if text and self.strip else text
 
@@ -539,7 +1129,40 @@ class ParserUDF(UDF):
             state["paragraph"]["text"] = text
             state["paragraph"]["field"] = field
 
-            yield from self._parse_sentence(paragraph, node, state)
+            if self.batch_split_sentences:
+                # The sentences of all paragraphs are split after the DFS
+                state["paragraphs_to_split"].append((paragraph, node, field, text))
+            else:
+                yield from self._parse_sentence(paragraph, node, state)
+
+    def _parse_split_paragraphs(self, state):
+        """Parse the Sentences of all the paragraphs found by the DFS.
+
+        The paragraph texts are tokenized and split in one batch. The Sentences
+        are then created in the same order as during the DFS, so that their
+        positions and stable ids are the same.
+
+        :param state: The global state necessary to place the node in context
+            of the document as a whole.
+        """
+        document = state["document"]
+        paragraphs = state["paragraphs_to_split"]
+        texts = [text for _, _, _, text in paragraphs]
+        if self.split_sentences_batch is not None:
+            all_split_sentences = self.split_sentences_batch(document, texts)
+        else:
+            all_split_sentences = (
+                list(self.tokenize_and_split_sentences(document, text))
+                for text in texts
+            )
+
+        for (paragraph, node, field, text), split_sentences in zip(
+            paragraphs, profile_iter("tokenize", all_split_sentences)
+        ):
+            state["paragraph"]["text"] = text
+            state["paragraph"]["field"] = field
+            yield from self._parse_sentence(paragraph, node, state, split_sentences)
+        state["paragraphs_to_split"] = []
 
     def _parse_section(self, node, state):
         """Parse a Section of the node.
@@ -604,12 +1227,13 @@ class ParserUDF(UDF):
 
         return state
 
-    def _parse_node(self, node, state):
+    def _parse_node(self, node, state, fields=("text", "tail")):
         """Entry point for parsing all node types.
 
         :param node: The lxml HTML node to parse
         :param state: The global state necessary to place the node in context
             of the document as a whole.
+        :param fields: The fields of the node to parse, among "text" and "tail".
         :rtype: a *generator* of Sentences
         """
         # Processing on entry of node
@@ -622,32 +1246,48 @@ class ParserUDF(UDF):
 
         state = self._parse_caption(node, state)
 
-        yield from self._parse_paragraph(node, state)
+        yield from self._parse_paragraph(node, state, fields)
 
-    def parse(self, document, text):
-        """Depth-first search over the provided tree.
+    def _index_structure(self, root, streaming=False):
+        """Build the index of the structure of a document used by its Sentences.
 
-        Implemented as an iterative procedure. The structure of the state
-        needed to parse each node is also defined in this function.
-
-        :param document: the Document context
-        :param text: the structured text of the document (e.g. HTML)
-        :rtype: a *generator* of Sentences.
+        :param root: The root lxml node of the document
+        :param streaming: Whether the document is parsed as a stream. The
+            stylesheet is then indexed once it is read, and the XPaths are
+            anchored to the blocks of the stream.
+        :return: A dict with the ElementTree of the document, the memoized
+            XPath of each node, the text of the inline stylesheet and the
+            memoized style of each class.
         """
-        stack = []
+        styles = None
+        head = root.find("head")
+        if head is not None:
+            style = head.find("style")
+            if style is not None:
+                styles = style.text
+        return {
+            "tree": lxml.etree.ElementTree(root),
+            "xpath": {},
+            "styles": styles,
+            "class_style": {},
+            # Only used when streaming
+            "anchors": [] if streaming else None,
+            "block": None,
+            "relative_xpath": {},
+        }
 
-        root = lxml.html.fromstring(text)
+    def _new_state(self, document, root, streaming=False):
+        """Return the state of the parse of a document.
 
-        # flattens children of node that are in the 'flatten' list
-        if self.flatten:
-            lxml.etree.strip_tags(root, self.flatten)
-        # Assign the text, which was stripped of the 'flatten'-tags, to the document
-        document.text = lxml.etree.tostring(root, encoding="unicode")
+        This dictionary contain the global state necessary to parse a
+        document and each context element. This reflects the relationships
+        defined in parser/models. This contains the state necessary to create
+        the respective Contexts within the document.
 
-        # This dictionary contain the global state necessary to parse a
-        # document and each context element. This reflects the relationships
-        # defined in parser/models. This contains the state necessary to create
-        # the respective Contexts within the document.
+        :param document: the Document context
+        :param root: The root lxml node of the document
+        :param streaming: Whether the document is parsed as a stream.
+        """
         state = {
             "visited": set(),
             "parent": {},  # map of parent[child] = node used to discover child
@@ -660,35 +1300,40 @@ class ParserUDF(UDF):
             "caption": {"idx": 0},
             "table": {"idx": 0},
             "sentence": {"idx": 0, "abs_offset": 0},
+            "paragraphs_to_split": [],
+            "structure": self._index_structure(root, streaming),
         }
+        state["parent"][root] = document
+        state["context"][root] = document
+        return state
+
+    def _dfs(self, root, state):
+        """Depth-first search over the tree of the root node.
+
+        :param root: The lxml node to start from
+        :param state: The global state necessary to place the node in context
+            of the document as a whole.
+        :rtype: a *generator* of Sentences.
+        """
         # NOTE: Currently the helper functions directly manipulate the state
         # rather than returning a modified copy.
 
         # Iterative Depth-First Search
-        stack.append(root)
-        state["parent"][root] = document
-        state["context"][root] = document
-
-        tokenized_sentences = []
+        stack = [root]
         while stack:
             node = stack.pop()
             if node not in state["visited"]:
                 state["visited"].add(node)  # mark as visited
 
                 # Process
-                if self.lingual:
-                    tokenized_sentences += [y for y in self._parse_node(node, state)]
-                else:
-                    yield from self._parse_node(node, state)
+                yield from self._parse_node(node, state)
 
                 # NOTE: This reversed() order is to ensure that the iterative
                 # DFS matches the order that would be produced by a recursive
                 # DFS implementation.
                 for child in reversed(node):
                     # Skip nodes that are comments or blacklisted
-                    if child.tag is lxml.etree.Comment or (
-                        self.blacklist and child.tag in self.blacklist
-                    ):
+                    if self._skip_node(child):
                         continue
 
                     stack.append(child)
@@ -696,11 +1341,309 @@ class ParserUDF(UDF):
                     # store the parent of the node, which is either the parent
                     # Context, or if the parent did not create a Context, then
                     # use the node's parent Context.
-                    state["parent"][child] = (
-                        state["context"][node]
-                        if node in state["context"]
-                        else state["parent"][node]
-                    )
+                    state["parent"][child] = self._node_context(node, state)
+
+        if self.batch_split_sentences:
+            yield from self._parse_split_paragraphs(state)
+
+    def _skip_node(self, node):
+        """Whether the node is a comment or blacklisted."""
+        return node.tag is lxml.etree.Comment or (
+            self.blacklist and node.tag in self.blacklist
+        )
+
+    def _node_context(self, node, state):
+        """Return the Context of the node, or the Context of its parent."""
+        if node in state["context"]:
+            return state["context"][node]
+        return state["parent"][node]
+
+    def _parse_tree(self, document, text):
+        """Parse the whole tree of the document at once.
+
+        :param document: the Document context
+        :param text: the structured text of the document (e.g. HTML)
+        :rtype: a *generator* of Sentences.
+        """
+        root = lxml.html.fromstring(text)
+
+        # flattens children of node that are in the 'flatten' list
+        if self.flatten:
+            lxml.etree.strip_tags(root, self.flatten)
+        # Assign the text, which was stripped of the 'flatten'-tags, to the document
+        document.text = lxml.etree.tostring(root, encoding="unicode")
+
+        state = self._new_state(document, root)
+        yield from self._dfs(root, state)
+
+    def _parse_stream(self, document, text):
+        """Parse the document while it is read, freeing the parsed elements.
+
+        The elements which are still open while the document is read, and the
+        elements whose children are too many to be kept at once, form a spine.
+        Each element of the spine is parsed when its text is read. Each
+        complete child of the spine, with its whole subtree, is a block, and
+        is parsed with the same depth-first search as _parse_tree once its
+        tail is read. The block is then cleared, keeping only the element
+        itself, so that the XPaths of the later elements stay the same. The
+        tail of an element of the spine is parsed once it is read, i.e. after
+        the subtree of the element, and the Paragraphs and Sentences are then
+        renumbered as if it was parsed right after the text of the element,
+        as _parse_tree does. Only block-level elements (see STREAM_SPINE_TAGS)
+        whose parent holds no text are moved to the spine, so that their tail
+        rarely holds text.
+
+        Sentences are yielded as soon as they are parsed, but their XPaths,
+        positions and stable ids are only final once the whole document is
+        read, i.e. when the generator is exhausted. The Sentences of a tail are
+        yielded after the Sentences of the subtree of its element.
+        document.text is kept as it is, without the 'flatten'-tags stripped.
+
+        :param document: the Document context
+        :param text: the structured text of the document (e.g. HTML)
+        :rtype: a *generator* of Sentences.
+        """
+        state = None
+        # The open elements, each as [element, in the spine, text parsed, last
+        # parsed child, text parsed among the children]
+        stack = []
+        # The elements of the spine whose tail is not parsed yet, with the
+        # position of their tail in the document (see _tail_mark)
+        spine_tails = {}
+        n_buffered = 0
+        for event, node in _read_html_events(text):
+            if event == "start":
+                if state is None:
+                    state = self._new_state(document, node, streaming=True)
+                    stack.append([node, True, False, None, False])
+                    continue
+                parent = stack[-1]
+                if parent[1] and not self._flattened(node):
+                    # The previous siblings and their tails are complete
+                    yield from self._flush_spine(parent, node, spine_tails, state)
+                    n_buffered = 0
+                stack.append([node, False, False, None, False])
+                n_buffered += 1
+                if n_buffered > STREAM_BLOCK_SIZE:
+                    yield from self._extend_spine(stack, spine_tails, state)
+                    n_buffered = 0
+            else:
+                element = stack.pop()
+                if element[1]:
+                    yield from self._flush_spine(element, None, spine_tails, state)
+                elif stack and stack[-1][1] and self._flattened(node):
+                    if self.flatten:
+                        lxml.etree.strip_tags(node, self.flatten)
+                    _strip_element(node)
+        if state is None:
+            return
+
+        root = state["root"]
+        yield from self._parse_spine_tail(root, spine_tails.pop(root), state)
+
+        # Complete the XPaths now that the tree of the document is complete
+        for sentence, anchor in state["structure"]["anchors"]:
+            sentence.xpath = self._get_xpath(anchor, state) + sentence.xpath
+        state["structure"]["anchors"] = []
+
+    def _flattened(self, node):
+        return bool(self.flatten) and node.tag in self.flatten
+
+    def _has_text(self, text):
+        """Whether the text of a node would be parsed as a Paragraph."""
+        return bool(text.strip() if text and self.strip else text)
+
+    def _extend_spine(self, stack, spine_tails, state):
+        """Move the open elements to the spine, so that their children which
+        are complete can be parsed and freed.
+
+        Elements which are flattened or skipped, and figures, which need their
+        children to be parsed, are kept out of the spine with their subtree.
+        So are the elements which are not block-level, and the children of
+        elements with text, whose tail is parsed before their children when
+        not streaming.
+        """
+        sentences = []
+        for i in range(1, len(stack) - 1):
+            element, child = stack[i], stack[i + 1][0]
+            if element[1]:
+                continue
+            node = element[0]
+            if (
+                node.tag == "figure"
+                or node.tag not in STREAM_SPINE_TAGS
+                or stack[i - 1][4]
+                or self._flattened(node)
+                or self._skip_node(node)
+                or self._flattened(child)
+            ):
+                break
+            state["parent"][node] = self._node_context(node.getparent(), state)
+            # Strip the flattened children which were read before
+            for previous in list(node):
+                if previous is child:
+                    break
+                if self._flattened(previous):
+                    lxml.etree.strip_tags(previous, self.flatten)
+                    _strip_element(previous)
+            element[1] = True
+            sentences += self._flush_spine(element, child, spine_tails, state)
+        return sentences
+
+    def _flush_spine(self, element, until, spine_tails, state):
+        """Parse an element of the spine, if not parsed yet, and its complete
+        children before the until node.
+
+        :param element: The [element, in the spine, text parsed, last parsed
+            child, text parsed among the children] of the spine
+        :param until: The child not to parse, with the children after it, or
+            None to parse all the children.
+        """
+        node = element[0]
+        sentences = []
+        if not element[2]:
+            element[2] = True
+            element[4] = self._has_text(node.text)
+            state["structure"]["block"] = None
+            sentences += self._parse_node(node, state, fields=("text",))
+            if self.batch_split_sentences:
+                sentences += self._parse_split_paragraphs(state)
+            spine_tails[node] = self._tail_mark(state)
+
+        child = node[0] if element[3] is None and len(node) else None
+        if element[3] is not None:
+            child = element[3].getnext()
+        while child is not None and child is not until:
+            element[4] = element[4] or self._has_text(child.tail)
+            if child in spine_tails:
+                mark = spine_tails.pop(child)
+                sentences += self._parse_spine_tail(child, mark, state)
+            else:
+                sentences += self._parse_block(child, node, state)
+            element[3] = child
+            child = child.getnext()
+        return sentences
+
+    def _tail_mark(self, state):
+        """Return where the tail of an element of the spine is parsed without
+        streaming, i.e. the numbers of Paragraphs and Sentences of the document
+        and the character offset after the text of the element.
+        """
+        document = state["document"]
+        return (
+            len(document.paragraphs),
+            len(document.sentences),
+            state["sentence"]["abs_offset"],
+        )
+
+    def _parse_spine_tail(self, node, mark, state):
+        """Parse the tail of an element of the spine, and forget the element.
+
+        The Paragraph and Sentences of the tail take the place they have
+        without streaming, i.e. before the ones parsed since mark.
+        """
+        state["structure"]["block"] = None
+        before = self._tail_mark(state)
+        sentences = list(self._parse_paragraph(node, state, fields=("tail",)))
+        if self.batch_split_sentences:
+            sentences += self._parse_split_paragraphs(state)
+        if len(state["document"].paragraphs) > before[0]:
+            self._move_tail(mark, before, state)
+        context = state["context"].pop(node, None)
+        state["parent"].pop(node, None)
+        if isinstance(context, Table):
+            state["table"].pop(context.position, None)
+        return sentences
+
+    def _move_tail(self, mark, before, state):
+        """Renumber the Paragraphs and Sentences parsed since mark, moving the
+        ones of the tail, parsed since before, in front of the others.
+        """
+        document = state["document"]
+        n_paragraphs, n_sentences, offset = mark
+        paragraphs = document.paragraphs[n_paragraphs:]
+        n_subtree = before[0] - n_paragraphs
+        paragraphs = paragraphs[n_subtree:] + paragraphs[:n_subtree]
+        for position, paragraph in enumerate(paragraphs, n_paragraphs):
+            paragraph.position = position
+            paragraph.stable_id = "{}::{}:{}".format(
+                document.name, "paragraph", position
+            )
+
+        sentences = document.sentences[n_sentences:]
+        n_subtree = before[1] - n_sentences
+        n_tail = len(sentences) - n_subtree
+        for i, sentence in enumerate(sentences):
+            if i < n_subtree:
+                sentence.position += n_tail
+                shift = state["sentence"]["abs_offset"] - before[2]
+            else:
+                sentence.position -= n_subtree
+                shift = offset - before[2]
+            doc_id, _, start, end = split_stable_id(sentence.stable_id)
+            sentence.stable_id = "{}::{}:{}:{}".format(
+                doc_id, "sentence", start + shift, end + shift
+            )
+
+    def _parse_block(self, block, parent, state):
+        """Parse a complete child of the spine with its subtree, then clear it.
+
+        :param block: The lxml node of the block
+        :param parent: The lxml node of the spine which is the parent of block
+        :param state: The global state necessary to place the node in context
+            of the document as a whole.
+        """
+        structure = state["structure"]
+        if structure["styles"] is None and parent is state["root"]:
+            if block.tag == "head":
+                style = block.find("style")
+                if style is not None:
+                    structure["styles"] = style.text
+        elif structure["styles"] is None and block.tag == "style":
+            if parent.tag == "head" and parent.getparent() is state["root"]:
+                structure["styles"] = block.text
+
+        sentences = []
+        if not self._skip_node(block):
+            if self.flatten:
+                lxml.etree.strip_tags(block, self.flatten)
+            table_idx = state["table"]["idx"]
+            state["parent"][block] = self._node_context(parent, state)
+            state["visited"] = set()
+            structure["block"] = block
+            structure["relative_xpath"] = {}
+            sentences = list(self._dfs(block, state))
+
+            # Forget the state of the nodes of the block
+            for node in state["visited"]:
+                state["parent"].pop(node, None)
+                state["context"].pop(node, None)
+            for idx in range(table_idx, state["table"]["idx"]):
+                state["table"].pop(idx, None)
+            state["visited"] = set()
+            structure["block"] = None
+            structure["relative_xpath"] = {}
+        block.clear()
+        return sentences
+
+    def parse(self, document, text):
+        """Depth-first search over the provided tree.
+
+        Implemented as an iterative procedure. The structure of the state
+        needed to parse each node is also defined in this function.
+
+        :param document: the Document context
+        :param text: the structured text of the document (e.g. HTML)
+        :rtype: a *generator* of Sentences.
+        """
+        if self.streaming:
+            sentences = self._parse_stream(document, text)
+        else:
+            sentences = self._parse_tree(document, text)
 
         if self.lingual:
-            yield from self.enrich_tokenized_sentences_with_nlp(tokenized_sentences)
+            yield from profile_iter(
+                "nlp", self.enrich_tokenized_sentences_with_nlp(list(sentences))
+            )
+        else:
+            yield from sentences
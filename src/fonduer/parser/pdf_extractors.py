@@ -0,0 +1,217 @@
+"""Backends which extract the words of PDFs and their bounding boxes."""
+
+import logging
+import re
+import shutil
+import subprocess
+from collections import namedtuple
+
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+# A page of a PDF, with its words in reading order
+PDFPage = namedtuple("PDFPage", ["width", "height", "words"])
+
+# A word of a PDF, with its horizontal extent, the vertical extent of its line,
+# and the top left corner of its block of text. Coordinates are in points from
+# the top left corner of the page.
+PDFWord = namedtuple(
+    "PDFWord",
+    [
+        "text",
+        "x_min",
+        "x_max",
+        "line_y_min",
+        "line_y_max",
+        "block_x_min",
+        "block_y_min",
+    ],
+)
+
+
+class PDFExtractor(object):
+    """The interface of the backends which extract the words of PDFs.
+
+    A backend has a name, which tells apart the words it extracts in a
+    PDFWordCache, and extracts the pages of a PDF with their words. Backends
+    must be safe to use from several threads at once.
+    """
+
+    name = None
+
+    def pages(self, pdf_file):
+        """Extract the words of every page of a PDF.
+
+        :param pdf_file: The path to the PDF.
+        :rtype: a *generator* of PDFPage, in the order of the pages.
+        """
+        raise NotImplementedError()
+
+
+class PopplerExtractor(PDFExtractor):
+    """Extract the words of PDFs with pdftotext of poppler-utils, which must be
+    0.36.0 or above and in PATH.
+
+    The words of every page are extracted with a single call of pdftotext,
+    whose output is parsed page by page as it is written.
+    """
+
+    name = "poppler"
+
+    def __init__(self):
+        # Check if poppler-utils is installed AND the version is 0.36.0 or above
+        if shutil.which("pdfinfo") is None or shutil.which("pdftotext") is None:
+            raise RuntimeError("poppler-utils is not installed or they are not in PATH")
+        version = subprocess.check_output(
+            "pdfinfo -v", shell=True, stderr=subprocess.STDOUT, universal_newlines=True
+        )
+        m = re.search(r"\d\.\d{2}\.\d", version)
+        if int(m.group(0).replace(".", "")) < 360:
+            raise RuntimeError(
+                "Installed poppler-utils's version is %s, but should be 0.36.0 or above"
+                % m.group(0)
+            )
+
+    def pages(self, pdf_file):
+        cmd = ["pdftotext", "-bbox-layout", pdf_file, "-"]
+        logger.debug(" ".join(cmd))
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as process:
+            try:
+                for page in _iter_pages(process.stdout):
+                    yield PDFPage(
+                        float(page.get("width")),
+                        float(page.get("height")),
+                        list(_page_words(page)),
+                    )
+            except etree.XMLSyntaxError:
+                # pdftotext writes nothing when it fails
+                process.stdout.close()
+                if process.wait() == 0:
+                    raise
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, cmd)
+
+
+class PDFMinerExtractor(PDFExtractor):
+    """Extract the words of PDFs in process with pdfminer.six, which needs no
+    external program.
+
+    Blocks and lines are the text boxes and lines of the layout analysis of
+    pdfminer, and words are the runs of characters of a line between spaces.
+
+    :param laparams: The keyword arguments of the pdfminer LAParams of the
+        layout analysis.
+    """
+
+    name = "pdfminer"
+
+    def __init__(self, **laparams):
+        try:
+            import pdfminer.high_level  # noqa: F401
+        except ImportError:
+            raise RuntimeError(
+                "pdfminer.six is not installed. Use `pip install pdfminer.six`."
+            )
+        self.laparams = laparams
+
+    def pages(self, pdf_file):
+        from pdfminer.high_level import extract_pages
+        from pdfminer.layout import LAParams
+
+        for layout in extract_pages(pdf_file, laparams=LAParams(**self.laparams)):
+            yield PDFPage(layout.width, layout.height, list(_layout_words(layout)))
+
+
+# The backends, by name
+EXTRACTORS = {
+    extractor.name: extractor for extractor in [PopplerExtractor, PDFMinerExtractor]
+}
+
+
+def get_extractor(extractor):
+    """Return a PDFExtractor.
+
+    :param extractor: The name of a backend in EXTRACTORS, or a PDFExtractor.
+    """
+    if isinstance(extractor, PDFExtractor):
+        return extractor
+    if extractor not in EXTRACTORS:
+        raise ValueError(
+            "Unknown PDF extractor {}, must be one of {}.".format(
+                extractor, sorted(EXTRACTORS)
+            )
+        )
+    return EXTRACTORS[extractor]()
+
+
+def _iter_pages(stream):
+    """Parse the output of pdftotext -bbox-layout incrementally.
+
+    :param stream: The binary output of pdftotext.
+    :rtype: a *generator* of the page elements. Each page is cleared once the
+        caller moves on to the next one.
+    """
+    for _, page in etree.iterparse(
+        stream, events=("end",), tag="{*}page", recover=True, huge_tree=True
+    ):
+        yield page
+        page.clear()
+        # Drop the pages already seen from the tree
+        while page.getprevious() is not None:
+            del page.getparent()[0]
+
+
+def _page_words(page):
+    """Yield the words of a page element of the output of pdftotext."""
+    for block in page.iter("{*}block"):
+        x_min_block = float(block.get("xMin"))
+        y_min_block = float(block.get("yMin"))
+        for line in block.iter("{*}line"):
+            y_min_line = float(line.get("yMin"))
+            y_max_line = float(line.get("yMax"))
+            for word in line.iter("{*}word"):
+                yield PDFWord(
+                    "".join(word.itertext()),
+                    float(word.get("xMin")),
+                    float(word.get("xMax")),
+                    y_min_line,
+                    y_max_line,
+                    x_min_block,
+                    y_min_block,
+                )
+
+
+def _layout_words(layout):
+    """Yield the words of a pdfminer LTPage.
+
+    pdfminer measures from the bottom left corner of the page, so vertical
+    coordinates are flipped.
+    """
+    from pdfminer.layout import LTChar, LTTextBox, LTTextLine
+
+    def top(y):
+        return layout.y1 - y
+
+    for block in layout:
+        if not isinstance(block, LTTextBox):
+            continue
+        for line in block:
+            if not isinstance(line, LTTextLine):
+                continue
+            chars = []
+            # Virtual spaces and line breaks are not LTChar, and end words too
+            for char in list(line) + [None]:
+                if isinstance(char, LTChar) and not char.get_text().isspace():
+                    chars.append(char)
+                elif chars:
+                    yield PDFWord(
+                        "".join(c.get_text() for c in chars),
+                        chars[0].x0 - layout.x0,
+                        max(c.x1 for c in chars) - layout.x0,
+                        top(line.y1),
+                        top(line.y0),
+                        block.x0 - layout.x0,
+                        top(block.y1),
+                    )
+                    chars = []
@@ -0,0 +1,157 @@
+"""An on-disk cache of the words and bounding boxes extracted from PDFs."""
+
+import hashlib
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# The version of the layout of the cache files, part of every key
+CACHE_VERSION = 1
+
+# The number of bytes of a PDF read at a time when hashing it
+HASH_BLOCK_SIZE = 1 << 20
+
+
+class PDFWordCache(object):
+    """Cache the words of PDFs and their bounding boxes in a directory.
+
+    Each PDF is stored in its own .npz file of columnar arrays: the UTF-8
+    encoded text of the words with their lengths, the ids of the words, their
+    boxes, and the dimensions of the pages. A PDF is looked up by the hash of
+    its content, so a PDF which is moved or copied is still found, and a PDF
+    which is modified is not. Within a process, the content hash of a file is
+    reused as long as its path, size and modification time are unchanged.
+
+    When the files of the cache exceed max_size bytes, the least recently used
+    ones are removed.
+
+    :param cache_dir: The directory of the cache files, created if needed.
+    :param max_size: The maximum total size of the cache files, in bytes, or
+        None for no limit.
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        if max_size is not None and max_size < 0:
+            raise ValueError("max_size must be None or non-negative.")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._content_hashes = {}
+
+    def key(self, pdf_file, config=""):
+        """Return the key of a PDF.
+
+        :param pdf_file: The path to the PDF.
+        :param config: The settings the words are extracted with.
+        """
+        stat = os.stat(pdf_file)
+        file_id = (os.path.realpath(pdf_file), stat.st_size, stat.st_mtime_ns)
+        if file_id not in self._content_hashes:
+            content_hash = hashlib.sha1()
+            with open(pdf_file, "rb") as f:
+                for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                    content_hash.update(block)
+            self._content_hashes[file_id] = content_hash.hexdigest()
+        key = hashlib.sha1()
+        for part in [str(CACHE_VERSION), config, self._content_hashes[file_id]]:
+            key.update(part.encode("utf-8"))
+            key.update(b"\0")
+        return key.hexdigest()
+
+    def get(self, key):
+        """Return the words stored for a key.
+
+        :param key: The key of the PDF.
+        :return: The pdf_word_list, the coordinate_map and the dimensions of
+            the pages of the PDF, or None if the PDF is not in the cache.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                text = data["text"].tobytes().decode("utf-8")
+                lengths = data["lengths"].tolist()
+                word_ids = [tuple(word_id) for word_id in data["word_ids"].tolist()]
+                boxes = [tuple(box) for box in data["boxes"].tolist()]
+                dims = data["dims"].tolist()
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.warning("Ignoring unreadable cache file {}".format(path))
+            return None
+        # Mark the file as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        words = []
+        end = 0
+        for length in lengths:
+            words.append(text[end : end + length])
+            end += length
+        pdf_word_list = list(zip(word_ids, words))
+        coordinate_map = dict(zip(word_ids, boxes))
+        pdf_dims = {page: (width, height) for page, width, height in dims}
+        return pdf_word_list, coordinate_map, pdf_dims
+
+    def put(self, key, pdf_word_list, coordinate_map, pdf_dims):
+        """Store the words of a PDF, then evict files beyond the size limit.
+
+        :param key: The key of the PDF.
+        :param pdf_word_list: The list of (word id, word) of the PDF.
+        :param coordinate_map: The box of each word, by word id.
+        :param pdf_dims: The (width, height) of each page, by page number.
+        """
+        word_ids = [word_id for word_id, _ in pdf_word_list]
+        words = [word for _, word in pdf_word_list]
+        arrays = {
+            "text": np.frombuffer("".join(words).encode("utf-8"), dtype=np.uint8),
+            "lengths": np.array([len(word) for word in words], dtype=np.int32),
+            "word_ids": np.array(word_ids, dtype=np.int32).reshape(-1, 2),
+            "boxes": np.array(
+                [coordinate_map[word_id] for word_id in word_ids], dtype=np.int32
+            ).reshape(-1, 5),
+            "dims": np.array(
+                [(page,) + dim for page, dim in sorted(pdf_dims.items())],
+                dtype=np.int32,
+            ).reshape(-1, 3),
+        }
+        # Write to a temporary file first, so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        if self.max_size is not None:
+            self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def _evict(self):
+        """Remove the least recently used files until the cache fits."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another process removed it already
+                pass
+            total -= size
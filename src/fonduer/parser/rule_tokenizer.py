@@ -0,0 +1,85 @@
+"""A rule-based tokenizer and sentence splitter which needs no language model."""
+import re
+from builtins import object
+from collections import defaultdict
+
+# A number (e.g. 12.5 or 1,000), a word with inner hyphens, apostrophes or
+# periods (e.g. BC546-A, don't, e.g), or any other single character
+TOKEN_PATTERN = r"\d+(?:[.,]\d+)*|\w+(?:[-'’.]\w+)*|[^\w\s]"
+
+# The characters which end a sentence
+SENTENCE_END_CHARS = [".", "!", "?", "。"]
+
+
+class RuleTokenizer(object):
+    """Tokenizes text with regular expressions and splits sentences on
+    punctuation.
+
+    A sentence ends after a sentence-ending punctuation mark and any
+    punctuation which directly follows it (e.g. a closing quote), as with
+    spaCy's rule-based sentencizer. The Sentence parts have the same layout as
+    the parts from spaCy, with empty placeholders for the NLP attributes.
+    """
+
+    def __init__(
+        self, token_pattern=TOKEN_PATTERN, sentence_end_chars=SENTENCE_END_CHARS
+    ):
+        """
+        :param token_pattern: The regular expression of a token.
+        :param sentence_end_chars: The tokens which end a sentence.
+        """
+        self.token_regex = re.compile(token_pattern, flags=re.UNICODE)
+        self.sentence_end_chars = set(sentence_end_chars)
+
+    def parse(self, document, text):
+        """Split the text into tokenized sentences.
+
+        :param document: The Document context of the data model.
+        :param text: The text of the parent paragraph of the sentences.
+        :rtype: a *generator* of the parts of Sentences.
+        """
+        position = 0
+        sentence = []
+        seen_end = False
+        for match in self.token_regex.finditer(text):
+            token = match.group()
+            is_punct = _is_punct(token)
+            if seen_end and not is_punct:
+                yield self._sentence_parts(document, text, sentence, position)
+                position += 1
+                sentence = []
+                seen_end = False
+            sentence.append(match)
+            if token in self.sentence_end_chars:
+                seen_end = True
+        if sentence:
+            yield self._sentence_parts(document, text, sentence, position)
+
+    def _sentence_parts(self, document, text, tokens, position):
+        """Return the parts of a Sentence of the matches of its tokens."""
+        parts = defaultdict(list)
+        start = tokens[0].start()
+        for token in tokens:
+            parts["words"].append(token.group())
+            parts["lemmas"].append("")  # placeholder for later NLP parsing
+            parts["pos_tags"].append("")  # placeholder for later NLP parsing
+            parts["ner_tags"].append("")  # placeholder for later NLP parsing
+            parts["char_offsets"].append(token.start() - start)
+            parts["abs_char_offsets"].append(token.start())
+            parts["dep_parents"].append(0)  # placeholder for later NLP parsing
+            parts["dep_labels"].append("")  # placeholder for later NLP parsing
+
+        # Add null entity array (matching null for CoreNLP)
+        parts["entity_cids"] = ["O" for _ in parts["words"]]
+        parts["entity_types"] = ["O" for _ in parts["words"]]
+
+        parts["position"] = position
+
+        # Link the sentence to its parent document object
+        parts["document"] = document
+        parts["text"] = text[start : tokens[-1].end()]
+        return parts
+
+
+def _is_punct(token):
+    return len(token) == 1 and not token.isalnum() and not token.isspace()
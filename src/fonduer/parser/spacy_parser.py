@@ -14,6 +14,9 @@ try:
 except Exception as e:
     raise Exception("spaCy not installed. Use `pip install spacy`.")
 
+# The models loaded by Spacy.preload in this process, by language
+_preloaded_models = {}
+
 
 class Spacy(object):
     """
@@ -48,13 +51,20 @@ class Spacy(object):
 
     """
 
-    def __init__(self, lang):
+    def __init__(self, lang, batch_size=None):
+        """
+        :param lang: The language of the spaCy model.
+        :param batch_size: If set, enrich_sentences_with_NLP parses each
+            sentence as its own spaCy Doc, and runs each pipeline component on
+            batches of this many sentences. Default None.
+        """
         self.logger = logging.getLogger(__name__)
         self.name = "spacy"
         self.languages = ["en", "de", "es", "pt", "fr", "it", "nl", "xx"]
         self.alpha_languages = {"ja": "Japanese"}
 
         self.lang = lang
+        self.batch_size = batch_size
         self.model = None
 
         # self.model = self.load_lang_model()
@@ -122,6 +132,9 @@ class Spacy(object):
 
         :return:
         """
+        if self.lang in _preloaded_models:
+            self.model, self.sentence_splitter = _preloaded_models[self.lang]
+            return
         if self.lang in self.languages:
             if not Spacy.model_installed(self.lang):
                 download(self.lang)
@@ -140,35 +153,51 @@ class Spacy(object):
                 except (UnicodeDecodeError, ValueError):
                     pass
         self.model = model
+        # Built once, rather than added to the pipeline of the model, which
+        # only holds the NLP components
+        self.sentence_splitter = model.create_pipe("sbd")
+
+    @staticmethod
+    def preload(lang):
+        """
+        Load the spaCy language model of a language once for this process.
+        Every later call to load_lang_model for the language, including in the
+        processes forked from this one, reuses the model rather than loading
+        its own copy. The model is then shared copy-on-write between the
+        forked processes (see UDFRunner._fork_workers).
+        :param lang: The language of the spaCy model.
+        :return:
+        """
+        if lang in _preloaded_models:
+            return
+        spacy_parser = Spacy(lang)
+        spacy_parser.load_lang_model()
+        _preloaded_models[lang] = (spacy_parser.model, spacy_parser.sentence_splitter)
 
-    def sentence_list_separator_function(self, all_sentence_objs):
+    def _set_sentence_boundaries(self, doc, sentences):
+        """
+        Mark the first token of each Sentence as the start of a sentence in
+        the Doc of their words, so that the parser keeps the same sentences.
+        :param doc: A Doc of the words of the Sentences
+        :param sentences: List of fonduer Sentence objects
+        :return:
+        """
         start_token_marker = []
-        total_nr_input_words = 0
-        for sentence in all_sentence_objs:
+        for sentence in sentences:
             if len(sentence.words) > 0:
                 start_token_marker += [True] + [False] * (len(sentence.words) - 1)
-                total_nr_input_words += len(sentence.words)
 
-        def set_custom_boundary(doc):
-            output_tokens = list(doc)
-            total_nr_output_words = len(output_tokens)
-            try:
-                assert total_nr_input_words == total_nr_output_words
-            except AssertionError:
-                self.logger.error(
-                    "input token number ({}) not same as output token"
-                    " nr ({})".format(total_nr_input_words, total_nr_output_words)
-                )
-                raise
-
-            for token_nr, token in enumerate(doc):
-                if start_token_marker[token_nr] is True:
-                    doc[token.i].is_sent_start = True
-                else:
-                    doc[token.i].is_sent_start = False
-            return doc
+        try:
+            assert len(start_token_marker) == len(doc)
+        except AssertionError:
+            self.logger.error(
+                "input token number ({}) not same as output token"
+                " nr ({})".format(len(start_token_marker), len(doc))
+            )
+            raise
 
-        return set_custom_boundary
+        for token, is_sent_start in zip(doc, start_token_marker):
+            token.is_sent_start = is_sent_start
 
     def enrich_sentences_with_NLP(self, all_sentences):
         """
@@ -186,13 +215,9 @@ class Spacy(object):
         if len(all_sentences) == 0:
             return  # Nothing to parse
 
-        if self.model.has_pipe("sbd"):
-            self.model.remove_pipe("sbd")
-            self.logger.debug(
-                "Removed sentencizer ('sbd') from model. Now in pipeline: {}".format(
-                    self.model.pipe_names
-                )
-            )
+        if self.batch_size:
+            yield from self._enrich_sentences_in_batches(all_sentences)
+            return
 
         batch_char_limit = self.model.max_length
         sentence_batches = [[]]
@@ -209,18 +234,6 @@ class Spacy(object):
         for sentence_batch in sentence_batches:
             batch_sentence_strings = [x.text for x in sentence_batch]
 
-            if self.model.has_pipe("sentence_boundary_detector"):
-                self.model.remove_pipe(name="sentence_boundary_detector")
-
-            sentence_separator_fct = self.sentence_list_separator_function(
-                sentence_batch
-            )
-            self.model.add_pipe(
-                sentence_separator_fct,
-                before="parser",
-                name="sentence_boundary_detector",
-            )
-
             custom_tokenizer = TokenPreservingTokenizer(
                 self.model.vocab, sentence_batch
             )
@@ -228,6 +241,9 @@ class Spacy(object):
             # tokenizer that directly uses the already separated words
             # of each sentence as tokens
             doc = custom_tokenizer()
+            # The sentence boundaries are set on the Doc itself, rather than
+            # by a new pipeline component for every batch
+            self._set_sentence_boundaries(doc, sentence_batch)
             for name, proc in self.model.pipeline:  # iterate over components in order
                 doc = proc(doc)
 
@@ -250,29 +266,51 @@ class Spacy(object):
                 )
                 raise
 
-            sentence_nr = -1
-            for sent in batch_parsed_sentences:
-                sentence_nr += 1
-                parts = defaultdict(list)
+            for sentence, sent in zip(sentence_batch, batch_parsed_sentences):
+                self._set_nlp_attributes(sentence, sent)
+                yield sentence
 
-                for i, token in enumerate(sent):
-                    parts["lemmas"].append(token.lemma_)
-                    parts["pos_tags"].append(token.tag_)
-                    parts["ner_tags"].append(
-                        token.ent_type_ if token.ent_type_ else "O"
-                    )
-                    head_idx = (
-                        0 if token.head is token else token.head.i - sent[0].i + 1
-                    )
-                    parts["dep_parents"].append(head_idx)
-                    parts["dep_labels"].append(token.dep_)
-                current_sentence_obj = sentence_batch[sentence_nr]
-                current_sentence_obj.pos_tags = parts["pos_tags"]
-                current_sentence_obj.lemmas = parts["lemmas"]
-                current_sentence_obj.ner_tags = parts["ner_tags"]
-                current_sentence_obj.dep_parents = parts["dep_parents"]
-                current_sentence_obj.dep_labels = parts["dep_labels"]
-                yield current_sentence_obj
+    def _enrich_sentences_in_batches(self, all_sentences):
+        """
+        Enrich Sentences with NLP features, parsing each Sentence as its own
+        Doc. The Docs go through each component of the pipeline in batches
+        of self.batch_size, using the batched pipe method of the component.
+        :param all_sentences: List of fonduer Sentence objects
+        :return:
+        """
+        docs = (self._sentence_doc(sentence) for sentence in all_sentences)
+        for name, proc in self.model.pipeline:
+            if hasattr(proc, "pipe"):
+                docs = proc.pipe(docs, batch_size=self.batch_size)
+            else:
+                docs = (proc(doc) for doc in docs)
+
+        for sentence, doc in zip(all_sentences, docs):
+            self._set_nlp_attributes(sentence, doc[:])
+            yield sentence
+
+    def _sentence_doc(self, sentence):
+        """Return a Doc of the words of a Sentence, as a single sentence."""
+        doc = TokenPreservingTokenizer(self.model.vocab, [sentence])()
+        self._set_sentence_boundaries(doc, [sentence])
+        return doc
+
+    @staticmethod
+    def _set_nlp_attributes(sentence, sent):
+        """Copy the NLP features of a parsed spaCy Span to a Sentence."""
+        parts = defaultdict(list)
+        for token in sent:
+            parts["lemmas"].append(token.lemma_)
+            parts["pos_tags"].append(token.tag_)
+            parts["ner_tags"].append(token.ent_type_ if token.ent_type_ else "O")
+            head_idx = 0 if token.head is token else token.head.i - sent[0].i + 1
+            parts["dep_parents"].append(head_idx)
+            parts["dep_labels"].append(token.dep_)
+        sentence.pos_tags = parts["pos_tags"]
+        sentence.lemmas = parts["lemmas"]
+        sentence.ner_tags = parts["ner_tags"]
+        sentence.dep_parents = parts["dep_parents"]
+        sentence.dep_labels = parts["dep_labels"]
 
     def split_sentences(self, document, text):
         """
@@ -283,30 +321,33 @@ class Spacy(object):
         :return:
         """
 
-        if self.model.has_pipe("sentence_boundary_detector"):
-            self.model.remove_pipe(name="sentence_boundary_detector")
+        # Only tokenize and split, without running the NLP pipeline. Unlike
+        # calling the model, this does not limit the length of the text.
+        doc = self.sentence_splitter(self.model.make_doc(text))
+        yield from self._sentence_parts(document, doc)
 
-        if not self.model.has_pipe("sbd"):
-            sbd = self.model.create_pipe("sbd")  # add sentencizer
-            self.model.add_pipe(sbd)
-        try:
-            doc = self.model(text, disable=["parser", "tagger", "ner"])
-        except ValueError:
-            # temporary increase character limit of spacy
-            # 'Probably save' according to spacy, as no parser or NER is used
-            previous_max_length = self.model.max_length
-            self.model.max_length = 100000000
-            self.logger.warning(
-                "Temporarily increased spacy maximum "
-                " character limit to split sentences.".format(self.model.max_length)
-            )
-            doc = self.model(text, disable=["parser", "tagger", "ner"])
-            self.model.max_length = previous_max_length
-            self.logger.warning(
-                "Spacy maximum"
-                " character limit set back to.".format(self.model.max_length)
-            )
+    def split_sentences_batch(self, document, texts):
+        """
+        Split several input texts into sentences, like split_sentences, but
+        tokenizing all texts in one batch
+        :param document: The Document context
+        :param texts: The texts of the paragraphs of the document
+        :return: A generator of the list of sentences of each text
+        """
+        if hasattr(self.model.tokenizer, "pipe"):
+            docs = self.model.tokenizer.pipe(texts)
+        else:
+            docs = (self.model.make_doc(text) for text in texts)
+        for doc in docs:
+            yield list(self._sentence_parts(document, self.sentence_splitter(doc)))
 
+    def _sentence_parts(self, document, doc):
+        """
+        Convert the sentences of a split Doc to the parts of Sentences
+        :param document: The Document context
+        :param doc: The tokenized Doc of a paragraph, with sentence boundaries
+        :return:
+        """
         position = 0
         for sent in doc.sents:
             parts = defaultdict(list)
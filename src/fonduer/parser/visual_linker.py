@@ -1,20 +1,58 @@
 import logging
 import os
 import re
-import shutil
-import subprocess
-from builtins import object, range, str, zip
-from collections import OrderedDict, defaultdict
+from bisect import bisect_left
+from builtins import object, range, zip
+from collections import Counter, OrderedDict, defaultdict
 
 import numpy as np
 import pandas as pd
-from bs4 import BeautifulSoup
 from editdistance import eval as editdist  # Alternative library: python-levenshtein
 
+from fonduer.parser.pdf_extractors import get_extractor
+from fonduer.parser.pdf_word_cache import PDFWordCache
+
+# The ways of linking the words of the HTML to the words of the PDF
+LINK_METHODS = ["search", "anchors"]
+
+# The sizes of the n-grams of words tried in turn to anchor an alignment
+ANCHOR_NGRAM_SIZES = [1, 2, 3]
+
 
 class VisualLinker(object):
-    def __init__(self, time=False, verbose=False):
+    def __init__(
+        self,
+        time=False,
+        verbose=False,
+        cache_dir=None,
+        cache_size=None,
+        link_method="search",
+        extractor="poppler",
+    ):
+        """
+        :param cache_dir: If set, the directory of a PDFWordCache of the words
+            extracted from PDFs, so that each PDF is only extracted once across
+            parses.
+        :param cache_size: The maximum size of the cache in bytes, or None for
+            no limit.
+        :param link_method: How to link the words of the HTML to the words of
+            the PDF. "search" runs global and local searches for exact
+            matches, then a local search for approximate matches, with
+            link_lists. "anchors" aligns the words with
+            link_lists_by_anchors.
+        :param extractor: The PDFExtractor which extracts the words of the
+            PDFs, or the name of one of EXTRACTORS, e.g. "poppler" to run
+            pdftotext, or "pdfminer" to extract them in process.
+        """
+        if link_method not in LINK_METHODS:
+            raise ValueError(
+                "Unknown link_method {}, must be one of {}.".format(
+                    link_method, LINK_METHODS
+                )
+            )
         self.logger = logging.getLogger(__name__)
+        self.link_method = link_method
+        self.link_stats = None
         self.pdf_file = None
         self.verbose = verbose
         self.time = time
@@ -23,114 +61,141 @@ class VisualLinker(object):
         self.html_word_list = None
         self.links = None
         self.pdf_dim = None
+        self.pdf_dims = None
         delimiters = (
             u"([\(\)\,\?\u2212\u201C\u201D\u2018\u2019\u00B0\*']|(?<!http):|\.$|\.\.\.)"
         )
         self.separators = re.compile(delimiters)
-
-        # Check if poppler-utils is installed AND the version is 0.36.0 or above
-        if shutil.which("pdfinfo") is None or shutil.which("pdftotext") is None:
-            raise RuntimeError("poppler-utils is not installed or they are not in PATH")
-        version = subprocess.check_output(
-            "pdfinfo -v", shell=True, stderr=subprocess.STDOUT, universal_newlines=True
+        self.word_cache = (
+            PDFWordCache(cache_dir, max_size=cache_size) if cache_dir else None
         )
-        m = re.search(r"\d\.\d{2}\.\d", version)
-        if int(m.group(0).replace(".", "")) < 360:
-            raise RuntimeError(
-                "Installed poppler-utils's version is %s, but should be 0.36.0 or above"
-                % m.group(0)
-            )
+        self.extractor = get_extractor(extractor)
 
-    def parse_visual(self, document_name, sentences, pdf_path):
+    def parse_visual(self, document_name, sentences, pdf_path, pdf_words=None):
+        """Add the visual attributes of the sentences of a document.
+
+        :param document_name: The name of the document.
+        :param sentences: The sentences of the document.
+        :param pdf_path: The PDF of the document, or the directory of the PDFs.
+        :param pdf_words: If set, a Future of the result of extract_words for
+            the PDF of the document, e.g. started on another thread while the
+            document was parsed.
+        :rtype: a *generator* of the sentences.
+        """
         self.sentences = sentences
-        self.pdf_file = (
-            pdf_path if os.path.isfile(pdf_path) else pdf_path + document_name + ".pdf"
-        )
-        if not os.path.isfile(self.pdf_file):
-            self.pdf_file = self.pdf_file[:-3] + "PDF"
+        self.pdf_file = self.find_pdf_file(document_name, pdf_path)
         try:
-            self.extract_pdf_words()
+            if pdf_words is None:
+                self.extract_pdf_words()
+            else:
+                self._set_pdf_words(*pdf_words.result())
         except RuntimeError as e:
             self.logger.exception(e)
             return
         self.extract_html_words()
-        self.link_lists(search_max=200)
+        if self.link_method == "anchors":
+            self.link_lists_by_anchors(search_max=200)
+        else:
+            self.link_lists(search_max=200)
         for sentence in self.update_coordinates():
             yield sentence
 
-    def extract_pdf_words(self):
-        self.logger.debug(
-            "pdfinfo '{}' | grep -a Pages | sed 's/[^0-9]*//'".format(self.pdf_file)
-        )
-        num_pages = subprocess.check_output(
-            "pdfinfo '{}' | grep -a Pages | sed 's/[^0-9]*//'".format(self.pdf_file),
-            shell=True,
+    def find_pdf_file(self, document_name, pdf_path):
+        """Return the path to the PDF of a document."""
+        pdf_file = (
+            pdf_path if os.path.isfile(pdf_path) else pdf_path + document_name + ".pdf"
         )
+        if not os.path.isfile(pdf_file):
+            pdf_file = pdf_file[:-3] + "PDF"
+        return pdf_file
+
+    def extract_pdf_words(self):
+        """Extract the words of the PDF and their bounding boxes.
+
+        This fills pdf_word_list, coordinate_map and the dimensions of each
+        page.
+        """
+        self._set_pdf_words(*self.extract_words(self.pdf_file))
+
+    def extract_words(self, pdf_file):
+        """Return the words of a PDF and their bounding boxes, from the cache
+        if the PDF is in it.
+
+        This does not change the linker, so PDFs can be extracted on other
+        threads while the linker is used.
+
+        :param pdf_file: The path to the PDF.
+        :return: The pdf_word_list, the coordinate_map and the dimensions of
+            each page of the PDF.
+        """
+        key = None
+        cached = None
+        if self.word_cache is not None:
+            key = self.word_cache.key(
+                pdf_file, "{}:{}".format(self.extractor.name, self.separators.pattern)
+            )
+            cached = self.word_cache.get(key)
+        if cached is not None:
+            self.logger.debug("Using cached words of {}".format(pdf_file))
+            pdf_word_list, coordinate_map, pdf_dims = cached
+        else:
+            pdf_word_list, coordinate_map, pdf_dims = self._extract_words(pdf_file)
+        if len(pdf_word_list) == 0:
+            raise RuntimeError("Words could not be extracted from PDF: %s" % pdf_file)
+        if cached is None and key is not None:
+            self.word_cache.put(key, pdf_word_list, coordinate_map, pdf_dims)
+        if self.verbose:
+            self.logger.info("Extracted {} pdf words".format(len(pdf_word_list)))
+        return pdf_word_list, coordinate_map, pdf_dims
+
+    def _set_pdf_words(self, pdf_word_list, coordinate_map, pdf_dims):
+        self.pdf_word_list = pdf_word_list
+        self.coordinate_map = coordinate_map
+        self.pdf_dims = pdf_dims
+        # take last page dimensions
+        self.pdf_dim = pdf_dims[len(pdf_dims)]
+
+    def _extract_words(self, pdf_file):
+        """Extract the words of every page with the extractor.
+
+        :return: The pdf_word_list, the coordinate_map and the dimensions of
+            each page of the PDF.
+        """
         pdf_word_list = []
         coordinate_map = {}
-        for i in range(1, int(num_pages) + 1):
-            self.logger.debug(
-                "pdftotext -f {} -l {} -bbox-layout '{}' -".format(
-                    str(i), str(i), self.pdf_file
-                )
-            )
-            html_content = subprocess.check_output(
-                "pdftotext -f {} -l {} -bbox-layout '{}' -".format(
-                    str(i), str(i), self.pdf_file
-                ),
-                shell=True,
+        pdf_dims = {}
+        for page_num, page in enumerate(self.extractor.pages(pdf_file), 1):
+            pdf_dims[page_num] = (int(page.width), int(page.height))
+            pdf_word_list_i, coordinate_map_i = self._coordinates_from_page(
+                page, page_num
             )
-            soup = BeautifulSoup(html_content, "html.parser")
-            pages = soup.find_all("page")
-            pdf_word_list_i, coordinate_map_i = self._coordinates_from_HTML(pages[0], i)
             pdf_word_list += pdf_word_list_i
             # update coordinate map
             coordinate_map.update(coordinate_map_i)
-        self.pdf_word_list = pdf_word_list
-        self.coordinate_map = coordinate_map
-        if len(self.pdf_word_list) == 0:
-            raise RuntimeError(
-                "Words could not be extracted from PDF: %s" % self.pdf_file
-            )
-        # take last page dimensions
-        page_width, page_height = (
-            int(float(pages[0].get("width"))),
-            int(float(pages[0].get("height"))),
-        )
-        self.pdf_dim = (page_width, page_height)
-        if self.verbose:
-            self.logger.info("Extracted {} pdf words".format(len(self.pdf_word_list)))
+        return pdf_word_list, coordinate_map, pdf_dims
 
-    def _coordinates_from_HTML(self, page, page_num):
+    def _coordinates_from_page(self, page, page_num):
         pdf_word_list = []
         coordinate_map = {}
         block_coordinates = {}
-        blocks = page.find_all("block")
         i = 0  # counter for word_id in page_num
-        for block in blocks:
-            x_min_block = int(float(block.get("xmin")))
-            y_min_block = int(float(block.get("ymin")))
-            lines = block.find_all("line")
-            for line in lines:
-                y_min_line = int(float(line.get("ymin")))
-                y_max_line = int(float(line.get("ymax")))
-                words = line.find_all("word")
-                for word in words:
-                    xmin = int(float(word.get("xmin")))
-                    xmax = int(float(word.get("xmax")))
-                    for content in self.separators.split(word.getText()):
-                        if len(content) > 0:  # Ignore empty characters
-                            word_id = (page_num, i)
-                            pdf_word_list.append((word_id, content))
-                            coordinate_map[word_id] = (
-                                page_num,
-                                y_min_line,
-                                xmin,
-                                y_max_line,
-                                xmax,
-                            )
-                            block_coordinates[word_id] = (y_min_block, x_min_block)
-                            i += 1
+        for word in page.words:
+            for content in self.separators.split(word.text):
+                if len(content) > 0:  # Ignore empty characters
+                    word_id = (page_num, i)
+                    pdf_word_list.append((word_id, content))
+                    coordinate_map[word_id] = (
+                        page_num,
+                        int(word.line_y_min),
+                        int(word.x_min),
+                        int(word.line_y_max),
+                        int(word.x_max),
+                    )
+                    block_coordinates[word_id] = (
+                        int(word.block_y_min),
+                        int(word.block_x_min),
+                    )
+                    i += 1
         # sort pdf_word_list by page, block top then block left, top, then left
         pdf_word_list = sorted(
             pdf_word_list,
@@ -282,6 +347,94 @@ class VisualLinker(object):
             for i in range(len(self.html_word_list))
         )
 
+    def link_lists_by_anchors(self, search_max=100, edit_cost=20, offset_cost=1):
+        """Link the words of the HTML to the words of the PDF by aligning them.
+
+        Words which appear exactly once in both lists are anchors, and the
+        longest sequence of anchors in the same order in both lists is kept,
+        as in patience diff. Where no word is unique, n-grams of words are
+        used instead. The gaps between the kept anchors are aligned the same
+        way, recursively. Each remaining HTML word is then linked to a PDF
+        word of its gap, near the word after the PDF word of the previous HTML
+        word: the nearest word one of which is a prefix or suffix of the other
+        if any, or else the word of the least cost, from the edit distances to
+        all candidates computed at once.
+
+        The statistics of the links are stored in link_stats.
+
+        :param search_max: The maximum number of PDF words a remaining HTML
+            word is compared to.
+        :param edit_cost: The cost of each edit of the edit distance.
+        :param offset_cost: The cost of each word away from the expected
+            position.
+        """
+        html_words = [word for _, word in self.html_word_list]
+        pdf_words = [word for _, word in self.pdf_word_list]
+        N = len(html_words)
+        M = len(pdf_words)
+        if N == 0 or M == 0:
+            self.logger.error("N = {} and M = {} are invalid values.".format(N, M))
+            self.links = OrderedDict()
+            return
+
+        anchors = _find_anchors(html_words, pdf_words)
+        html_to_pdf = np.full(N, -1, dtype=np.int64)
+        for i, j in anchors:
+            html_to_pdf[i] = j
+
+        # Link the words between each pair of consecutive anchors
+        pdf_array = np.array(pdf_words)
+        bounds = [(-1, -1)] + anchors + [(N, M)]
+        for (i0, j0), (i1, j1) in zip(bounds, bounds[1:]):
+            previous = j0
+            for i in range(i0 + 1, i1):
+                if j1 - j0 <= 1:
+                    # No PDF word is left in the gap, use the nearest anchor
+                    html_to_pdf[i] = j0 if j0 >= 0 else min(j1, M - 1)
+                    continue
+                # Expect the word right after the PDF word of the previous one
+                offset = min(previous + 1, j1 - 1)
+                lo = max(j0 + 1, min(offset - search_max // 2, j1 - search_max))
+                candidates = np.arange(lo, min(j1, lo + search_max))
+                others = pdf_array[candidates]
+                distance = np.abs(candidates - offset)
+
+                word = html_words[i]
+                affixes = (
+                    np.char.startswith(word, others)
+                    | np.char.endswith(word, others)
+                    | np.char.startswith(others, word)
+                    | np.char.endswith(others, word)
+                )
+                if affixes.any():
+                    best = np.argmin(np.where(affixes, distance, M + search_max))
+                else:
+                    cost = (
+                        _edit_distances(word, others) * edit_cost
+                        + distance * offset_cost
+                    )
+                    best = np.argmin(cost)
+                html_to_pdf[i] = previous = candidates[best]
+
+        self.links = OrderedDict(
+            (self.html_word_list[i][0], self.pdf_word_list[html_to_pdf[i]][0])
+            for i in range(N)
+        )
+        exact = int(sum(html_words[i] == pdf_words[html_to_pdf[i]] for i in range(N)))
+        self.link_stats = {
+            "html_words": N,
+            "pdf_words": M,
+            "anchors": len(anchors),
+            "exact": exact,
+            "approximate": N - exact,
+            "exact_ratio": exact / N,
+        }
+        if self.verbose:
+            self.logger.info(
+                "Linked {exact:d}/{html_words:d} ({exact_ratio:.2f}) html words "
+                "exactly, with {anchors:d} anchors".format(**self.link_stats)
+            )
+
     def _calculate_offset(self, listA, listB, seedSize, maxOffset):
         wordsA = zip(*listA[:seedSize])[1]
         wordsB = zip(*listB[:maxOffset])[1]
@@ -345,3 +498,111 @@ class VisualLinker(object):
             yield sentence
         if self.verbose:
             self.logger.debug("Updated coordinates in database")
+
+
+def _find_anchors(a, b):
+    """Return the pairs of indices of the words which anchor an alignment of
+    the lists of words a and b, in increasing order of both.
+
+    Equal words at the start and end of both lists are anchors. In between,
+    the longest increasing sequence of the words which appear exactly once in
+    both lists are anchors, or else of the n-grams of words for the smallest
+    n which has some, and the gaps between them are aligned the same way.
+    """
+    anchors = []
+    ranges = [(0, len(a), 0, len(b))]
+    while ranges:
+        a0, a1, b0, b1 = ranges.pop()
+        while a0 < a1 and b0 < b1 and a[a0] == b[b0]:
+            anchors.append((a0, b0))
+            a0 += 1
+            b0 += 1
+        while a0 < a1 and b0 < b1 and a[a1 - 1] == b[b1 - 1]:
+            a1 -= 1
+            b1 -= 1
+            anchors.append((a1, b1))
+        if a0 == a1 or b0 == b1:
+            continue
+
+        for n in ANCHOR_NGRAM_SIZES:
+            kept = _unique_ngram_matches(a, b, a0, a1, b0, b1, n)
+            if kept:
+                break
+        else:
+            continue
+        anchors.extend(kept)
+        bounds = [(a0 - 1, b0 - 1)] + kept + [(a1, b1)]
+        for (i0, j0), (i1, j1) in zip(bounds, bounds[1:]):
+            if i1 - i0 > 1 and j1 - j0 > 1:
+                ranges.append((i0 + 1, i1, j0 + 1, j1))
+    return sorted(anchors)
+
+
+def _unique_ngram_matches(a, b, a0, a1, b0, b1, n):
+    """Return the pairs of indices of the words of the longest increasing
+    sequence of n-grams which appear exactly once in both a[a0:a1] and
+    b[b0:b1], without overlaps.
+    """
+    a_ngrams = [tuple(a[i : i + n]) for i in range(a0, a1 - n + 1)]
+    b_ngrams = [tuple(b[j : j + n]) for j in range(b0, b1 - n + 1)]
+    a_counts = Counter(a_ngrams)
+    b_counts = Counter(b_ngrams)
+    b_index = {ngram: j for j, ngram in enumerate(b_ngrams, b0) if b_counts[ngram] == 1}
+    unique = [
+        (i, b_index[ngram])
+        for i, ngram in enumerate(a_ngrams, a0)
+        if a_counts[ngram] == 1 and ngram in b_index
+    ]
+    matches = []
+    for i, j in _longest_increasing(unique):
+        if not matches or (i > matches[-1][0] and j > matches[-1][1]):
+            matches.extend((i + k, j + k) for k in range(n))
+    return matches
+
+
+def _longest_increasing(pairs):
+    """Return the longest subsequence of the pairs, sorted by their first
+    element, whose second elements increase, with patience sorting.
+    """
+    tails = []  # The second element of the last pair of each pile
+    tail_indices = []  # The index of the last pair of each pile
+    previous = [None] * len(pairs)
+    for k, (_, j) in enumerate(pairs):
+        pile = bisect_left(tails, j)
+        if pile > 0:
+            previous[k] = tail_indices[pile - 1]
+        if pile == len(tails):
+            tails.append(j)
+            tail_indices.append(k)
+        else:
+            tails[pile] = j
+            tail_indices[pile] = k
+    result = []
+    k = tail_indices[-1] if tail_indices else None
+    while k is not None:
+        result.append(pairs[k])
+        k = previous[k]
+    return result[::-1]
+
+
+def _edit_distances(word, others):
+    """Return the Levenshtein distances between a word and each of an array of
+    words, computed for all of the words at once.
+    """
+    lengths = np.char.str_len(others)
+    width = int(lengths.max()) if len(others) else 0
+    # The code points of the characters of each word, padded with zeros
+    codes = np.asarray(others, dtype="U{}".format(max(width, 1)))
+    codes = codes.view(np.uint32).reshape(len(others), -1)[:, :width]
+    columns = np.arange(width + 1)
+    previous = np.tile(columns, (len(others), 1))
+    for row, char in enumerate(word, 1):
+        current = np.empty_like(previous)
+        current[:, 0] = row
+        current[:, 1:] = np.minimum(
+            previous[:, :-1] + (codes != ord(char)), previous[:, 1:] + 1
+        )
+        # Insertions, i.e. current[:, j] <= current[:, j - 1] + 1
+        current = np.minimum.accumulate(current - columns, axis=1) + columns
+        previous = current
+    return previous[np.arange(len(others)), lengths]
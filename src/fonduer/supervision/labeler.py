@@ -7,7 +7,9 @@ from fonduer.utils.utils_udf import (
     ALL_SPLITS,
     add_keys,
     batch_upsert_records,
+    delete_split_ledger,
     get_cands_list_from_split,
+    get_doc_candidate_counts,
     get_docs_from_split,
     get_mapping,
     get_sparse_matrix,
@@ -55,7 +57,16 @@ class Labeler(UDFRunner):
 
         self.apply(docs=docs, split=split, lfs=lfs, train=True, clear=False, **kwargs)
 
-    def apply(self, docs=None, split=0, train=False, lfs=None, clear=True, **kwargs):
+    def apply(
+        self,
+        docs=None,
+        split=0,
+        train=False,
+        lfs=None,
+        clear=True,
+        pass_ids=True,
+        **kwargs
+    ):
         """Apply the labels of the specified candidates based on the provided LFs.
 
         :param docs: If provided, apply the LFs to all the candidates in these
@@ -69,6 +80,8 @@ class Labeler(UDFRunner):
             Labeler.
         :param clear: Whether or not to clear the labels table before applying
             these LFs.
+        :param pass_ids: Whether to only send document ids to the parallel
+            workers rather than the full documents. Default True.
         """
         if lfs is None:
             raise ValueError("Please provide a list of labeling functions.")
@@ -81,7 +94,13 @@ class Labeler(UDFRunner):
             # Call apply on the specified docs for all splits
             split = ALL_SPLITS
             super(Labeler, self).apply(
-                docs, split=split, train=train, lfs=self.lfs, clear=clear, **kwargs
+                docs,
+                split=split,
+                train=train,
+                lfs=self.lfs,
+                clear=clear,
+                pass_ids=pass_ids,
+                **kwargs
             )
             # Needed to sync the bulk operations
             self.session.commit()
@@ -96,6 +115,7 @@ class Labeler(UDFRunner):
                 train=train,
                 lfs=self.lfs,
                 clear=clear,
+                pass_ids=pass_ids,
                 **kwargs
             )
             # Needed to sync the bulk operations
@@ -136,6 +156,20 @@ class Labeler(UDFRunner):
             query = self.session.query(LabelKey)
             query.delete(synchronize_session="fetch")
 
+    def _clear_ledger(self, stage, split=0, **kwargs):
+        """Forget the documents whose Labels clear() deletes, i.e. the documents
+        with candidates in the split.
+        """
+        delete_split_ledger(self.session, stage, self.candidate_classes, split)
+
+    def _estimate_costs(self, docs, split=0, **kwargs):
+        """Estimate the cost of each document by its number of candidates in
+        the split.
+        """
+        return get_doc_candidate_counts(
+            self.session, self.candidate_classes, docs, split
+        )
+
     def clear_all(self, **kwargs):
         """Delete all Labels."""
         logger.info("Clearing ALL Labels and LabelKeys.")
@@ -220,6 +254,7 @@ class LabelerUDF(UDF):
                 get_mapping(self.session, Label, cands, self._f_gen, label_keys)
             )
             batch_upsert_records(self.session, Label, records)
+            self._rows_written += len(records)
 
         # Insert all Label Keys
         if train:
@@ -1,3 +1,11 @@
 from fonduer.utils.models.annotation import AnnotationKeyMixin, AnnotationMixin
+from fonduer.utils.models.ledger import ContentHash, StageLedger
+from fonduer.utils.models.task import UDFTask
 
-__all__ = ["AnnotationKeyMixin", "AnnotationMixin"]
+__all__ = [
+    "AnnotationKeyMixin",
+    "AnnotationMixin",
+    "ContentHash",
+    "StageLedger",
+    "UDFTask",
+]
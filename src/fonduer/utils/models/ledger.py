@@ -0,0 +1,41 @@
+from sqlalchemy import Column, ForeignKey, String
+
+from fonduer.meta import Meta
+
+# Grab pointer to global metadata
+_meta = Meta.init()
+
+
+class StageLedger(_meta.Base):
+    """A record that a stage (e.g. the Parser) finished processing a Document.
+
+    Each record also stores a hash of the configuration the stage ran with,
+    so that a later run with the same configuration can skip the Document.
+    """
+
+    __tablename__ = "stage_ledger"
+    stage = Column(String, primary_key=True)
+    document_name = Column(
+        String, ForeignKey("document.name", ondelete="CASCADE"), primary_key=True
+    )
+    config_hash = Column(String, primary_key=True)
+
+    def __repr__(self):
+        return "StageLedger ({}, {}, {})".format(
+            self.stage, self.document_name, self.config_hash
+        )
+
+
+class ContentHash(_meta.Base):
+    """A hash of the text of a Document and of the Parser configuration it was
+    last parsed with, see Parser.apply(incremental=True).
+    """
+
+    __tablename__ = "content_hash"
+    document_name = Column(
+        String, ForeignKey("document.name", ondelete="CASCADE"), primary_key=True
+    )
+    content_hash = Column(String, nullable=False)
+
+    def __repr__(self):
+        return "ContentHash ({}, {})".format(self.document_name, self.content_hash)
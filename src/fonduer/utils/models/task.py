@@ -0,0 +1,29 @@
+from sqlalchemy import Column, DateTime, Index, Integer, LargeBinary, String, func
+
+from fonduer.meta import Meta
+
+# Grab pointer to global metadata
+_meta = Meta.init()
+
+
+class UDFTask(_meta.Base):
+    """A unit of work of a stage (e.g. the Parser) in the database work queue.
+
+    The payload is a pickled document, or the id of a document. Workers on any
+    host claim pending tasks, process them, and mark them as done or failed.
+    """
+
+    __tablename__ = "udf_task"
+    id = Column(Integer, primary_key=True)
+    stage = Column(String, nullable=False)
+    config_hash = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="pending")
+    payload = Column(LargeBinary, nullable=False)
+    # The worker which last claimed the task, as <hostname>:<pid>
+    worker = Column(String)
+    updated = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (Index("udf_task_claim_idx", stage, config_hash, status),)
+
+    def __repr__(self):
+        return "UDFTask ({}, {}, {})".format(self.id, self.stage, self.status)
@@ -0,0 +1,144 @@
+"""Opt-in profiling of the time spent processing each document in a UDF."""
+
+import json
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# The record of the document being processed in this process, if profiling
+_active_record = None
+
+
+def start_record(stage, document):
+    """Start recording the phases of processing a document.
+
+    :param stage: The name of the stage, e.g. "Parser".
+    :param document: The name of the document, or None for work which does not
+        belong to a single document (e.g. a final commit).
+    :return: The record, a dict which can be sent to another process.
+    """
+    global _active_record
+    _active_record = {"stage": stage, "document": document, "rows": 0, "phases": {}}
+    return _active_record
+
+
+def stop_record():
+    """Stop recording phases, e.g. once the document is processed."""
+    global _active_record
+    _active_record = None
+
+
+def _add_time(record, name, seconds):
+    record["phases"][name] = record["phases"].get(name, 0.0) + seconds
+
+
+@contextmanager
+def profile_phase(name):
+    """Add the time spent in the with block to the phase of the active record.
+
+    Does nothing when no record is active.
+    """
+    record = _active_record
+    if record is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_time(record, name, time.perf_counter() - start)
+
+
+def profile_iter(name, iterable):
+    """Add the time spent generating the items of iterable to a phase.
+
+    The time spent by the consumer between two items is not counted.
+    Returns iterable unchanged when no record is active.
+    """
+    record = _active_record
+    if record is None:
+        return iterable
+    return _timed_iter(name, iterable, record)
+
+
+def _timed_iter(name, iterable, record):
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            _add_time(record, name, time.perf_counter() - start)
+            return
+        _add_time(record, name, time.perf_counter() - start)
+        yield item
+
+
+class Profile(object):
+    """The per-document records of profiling a run of a UDFRunner.
+
+    :param stage: The name of the stage, e.g. "Parser".
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.records = []
+        self.wall_time = 0.0
+
+    def add_records(self, records):
+        self.records.extend(records)
+
+    def summary(self):
+        """Aggregate the records.
+
+        :return: A dict with the number of documents and rows, the throughput
+            in documents and rows per second of wall time, and the total, p50,
+            p95 and max time per document of each phase.
+        """
+        doc_records = [r for r in self.records if r["document"] is not None]
+        n_rows = sum(r["rows"] for r in self.records)
+        phases = {}
+        for name in sorted({name for r in self.records for name in r["phases"]}):
+            total = sum(r["phases"].get(name, 0.0) for r in self.records)
+            times = [r["phases"][name] for r in doc_records if name in r["phases"]]
+            phases[name] = {
+                "total": total,
+                "p50": float(np.percentile(times, 50)) if times else 0.0,
+                "p95": float(np.percentile(times, 95)) if times else 0.0,
+                "max": max(times) if times else 0.0,
+            }
+        return {
+            "stage": self.stage,
+            "documents": len(doc_records),
+            "rows": n_rows,
+            "wall_time": self.wall_time,
+            "docs_per_sec": (
+                len(doc_records) / self.wall_time if self.wall_time else 0.0
+            ),
+            "rows_per_sec": n_rows / self.wall_time if self.wall_time else 0.0,
+            "phases": phases,
+        }
+
+    def to_json(self, path):
+        """Write the summary and the records to a JSON file."""
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "records": self.records}, f)
+
+    def to_dataframe(self):
+        """Return a DataFrame with one row per record and one column per phase.
+
+        The DataFrame can be stored as a stats table with DataFrame.to_sql.
+        """
+        return pd.DataFrame(
+            [
+                dict(
+                    stage=r["stage"],
+                    document=r["document"],
+                    rows=r["rows"],
+                    **r["phases"]
+                )
+                for r in self.records
+            ]
+        )
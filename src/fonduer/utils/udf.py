@@ -1,8 +1,27 @@
+import gc
+import hashlib
 import logging
-from multiprocessing import JoinableQueue, Manager, Process
+import math
+import os
+import pickle
+import re
+import resource
+import socket
+import sys
+import time
+import types
+from collections import OrderedDict
+from datetime import timedelta
+from multiprocessing import JoinableQueue, Process, Queue
 from queue import Empty
 
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import defer, subqueryload
+
 from fonduer.meta import Meta, new_sessionmaker
+from fonduer.utils.models import StageLedger, UDFTask
+from fonduer.utils.profiler import Profile, profile_phase, start_record, stop_record
 
 try:
     from IPython import get_ipython
@@ -17,9 +36,39 @@ else:
 
 QUEUE_TIMEOUT = 3
 
+# When the chunk size is picked automatically, aim for roughly this many
+# characters of document text per chunk.
+AUTO_CHUNK_CHARS = 1000000
+
+# Keep at least this many chunks per worker so that the load stays balanced.
+MIN_CHUNKS_PER_WORKER = 4
+
+# The largest automatic chunk size when the number of documents is unknown.
+MAX_AUTO_CHUNK_SIZE = 100
+
+# By default, the input queue holds at most this many chunks per worker, so
+# that the documents are not read much faster than the workers process them.
+QUEUE_CHUNKS_PER_WORKER = 2
+
+# Tasks claimed from the database by a worker which has not renewed its claim
+# for this many seconds are considered abandoned, and can be claimed again. A
+# worker renews the claim of its tasks between documents, at least every
+# quarter of the lease, so only a single document taking longer than the lease
+# makes its tasks expire.
+TASK_LEASE_SECONDS = 3600
+
+# A doc_loader which is not a list is scheduled in windows of this many
+# documents, so that it is still streamed to the workers.
+SCHEDULE_WINDOW = 10000
+
+# The number of tasks inserted into the database per statement.
+TASK_INSERT_SIZE = 1000
+
 # Grab pointer to global metadata
 _meta = Meta.init()
 
+logger = logging.getLogger(__name__)
+
 
 class UDFRunner(object):
     """
@@ -32,38 +81,171 @@ class UDFRunner(object):
         self.udf_class = udf_class
         self.udf_init_kwargs = udf_init_kwargs
         self.udfs = []
+        self.in_queue = None
+        self.out_queue = None
+        # The maximum number of chunks in the input queue of the workers
+        self.queue_size = None
+        self._worker_attrs = {}
+        self.pooled_udf = None
         self.pb = None
         self.session = session
         self.parallelism = parallelism
+        # The Profile of the last call to apply, if profiled
+        self.profile = None
 
     def apply(
-        self, doc_loader, clear=True, parallelism=None, progress_bar=True, **kwargs
+        self,
+        doc_loader,
+        clear=True,
+        parallelism=None,
+        progress_bar=True,
+        chunk_size=1,
+        pass_ids=False,
+        pool=None,
+        queue_size=None,
+        commit_policy=None,
+        resume=False,
+        schedule=None,
+        distributed=False,
+        profile=False,
+        recycle_policy=None,
+        **kwargs
     ):
         """
         Apply the given UDF to the set of objects returned by the doc_loader, either
         single or multi-threaded, and optionally calling clear() first.
+
+        :param chunk_size: The number of documents sent to a worker at a time
+            when running in parallel. If None, the chunk size is picked
+            automatically from the average size of the documents. Default 1.
+        :param pass_ids: Whether to send only the ids of the documents to the
+            workers when running in parallel. Each worker then loads the
+            documents it needs with its own session. Requires the documents to
+            already be in the database. Default False.
+        :param pool: A WorkerPool used to keep the UDF workers of this runner
+            alive between calls to apply. Default None.
+        :param queue_size: The maximum number of chunks waiting in the input
+            queue when running in parallel. If None, this is twice the
+            parallelism.
+        :param commit_policy: A CommitPolicy deciding how often the UDFs commit
+            and expunge their session. If None, the default CommitPolicy is
+            used.
+        :param resume: Whether to skip the documents which this stage already
+            finished with the same configuration, as recorded in the
+            StageLedger, rather than clearing. The Parser first deletes the
+            stored documents which it did not finish with this configuration.
+            Default False.
+        :param schedule: The order in which to process the documents. If None,
+            the order of the doc_loader is kept. If "largest_first", the
+            documents with the highest estimated cost (e.g. the longest text)
+            are processed first, so that no worker is left with a large
+            document at the end. Can also be a function which returns the cost
+            of a document. A list is sorted as a whole. Other doc_loaders are
+            read and sorted SCHEDULE_WINDOW documents at a time, and lose
+            their length. Default None.
+        :param distributed: Whether to queue the documents as tasks in the
+            UDFTask table of the database. Workers on other hosts can then
+            help process them with UDFRunner.work. Default False.
+        :param profile: Whether to record the time spent in each phase of
+            processing each document (e.g. apply, commit, queue wait, NLP) in
+            a Profile, stored as the profile attribute. Default False.
+        :param recycle_policy: A RecyclePolicy deciding when parallel workers
+            are replaced by fresh processes to free their memory. If None,
+            workers are never recycled.
+
+        The doc_loader does not need to have a length. Without one, documents
+        are streamed to the workers and the progress bar only counts them.
         """
-        # Clear everything downstream of this UDF if requested
-        if clear:
+        # Every finished document is recorded in the ledger under this stage
+        # and a hash of the configuration of the UDF.
+        stage = self.__class__.__name__
+        config_hash = self._stage_config_hash(**kwargs)
+        run_attrs = {
+            "stage": stage,
+            "config_hash": config_hash,
+            "profile": profile,
+            "recycle_policy": recycle_policy,
+        }
+        self.profile = Profile(stage) if profile else None
+
+        if resume:
+            # Only process the documents which are not finished yet
+            finished = {
+                name
+                for (name,) in self.session.query(StageLedger.document_name).filter(
+                    StageLedger.stage == stage, StageLedger.config_hash == config_hash
+                )
+            }
+            self.logger.info(
+                "Resuming {}, skipping {} finished documents".format(
+                    stage, len(finished)
+                )
+            )
+            doc_loader = _skip_finished(
+                self._clean_unfinished(doc_loader, finished), finished
+            )
+        elif clear:
+            # Clear everything downstream of this UDF if requested, and forget
+            # that the cleared documents were finished
+            self._clear_ledger(stage, **kwargs)
             self.clear(**kwargs)
 
+        if schedule is not None:
+            doc_loader = self._schedule(doc_loader, schedule, **kwargs)
+
         # Execute the UDF
         self.logger.info("Running UDF...")
 
         # Setup progress bar
+        self.pb = None
         if progress_bar:
             self.logger.debug("Setting up progress bar...")
-            if hasattr(doc_loader, "__len__"):
-                self.pb = tqdm(total=len(doc_loader))
-            else:
-                self.logger.error("Could not determine size of progress bar")
+            total = _loader_len(doc_loader)
+            if total is None:
+                self.logger.debug("Could not determine size of progress bar")
+            self.pb = tqdm(total=total)
+
+        commit_policy = commit_policy if commit_policy else CommitPolicy()
+        start = time.time()
 
         # Use the parallelism of the class if none is provided to apply
         parallelism = parallelism if parallelism else self.parallelism
-        if parallelism < 2:
-            self.apply_st(doc_loader, clear=clear, **kwargs)
+        if distributed:
+            self.apply_db(
+                doc_loader,
+                parallelism,
+                chunk_size=chunk_size,
+                pass_ids=pass_ids,
+                commit_policy=commit_policy,
+                run_attrs=run_attrs,
+                clear=clear,
+                **kwargs
+            )
+        elif parallelism < 2:
+            self.apply_st(
+                doc_loader,
+                pool=pool,
+                commit_policy=commit_policy,
+                run_attrs=run_attrs,
+                clear=clear,
+                **kwargs
+            )
         else:
-            self.apply_mt(doc_loader, parallelism, clear=clear, **kwargs)
+            self.apply_mt(
+                doc_loader,
+                parallelism,
+                chunk_size=chunk_size,
+                pass_ids=pass_ids,
+                pool=pool,
+                queue_size=queue_size,
+                commit_policy=commit_policy,
+                run_attrs=run_attrs,
+                clear=clear,
+                **kwargs
+            )
+
+        if self.profile is not None:
+            self.profile.wall_time = time.time() - start
 
         # Close progress bar
         if self.pb is not None:
@@ -73,104 +255,723 @@ class UDFRunner(object):
     def clear(self, **kwargs):
         raise NotImplementedError()
 
-    def apply_st(self, doc_loader, **kwargs):
+    def _stage_config_hash(self, **kwargs):
+        """Return the hash of the configuration under which the finished
+        documents are recorded in the ledger. By default, every argument of
+        the UDF.
+
+        :param kwargs: The keyword arguments of the UDF, e.g. the split.
+        """
+        return _config_hash(self.udf_init_kwargs, kwargs)
+
+    def _clear_ledger(self, stage, **kwargs):
+        """Delete the ledger rows of the documents whose outputs clear()
+        deletes, before it deletes them. By default, every row of the stage.
+
+        :param stage: The stage of the ledger rows.
+        :param kwargs: The keyword arguments of clear(), e.g. the split.
+        """
+        self.session.query(StageLedger).filter(StageLedger.stage == stage).delete()
+
+    def _clean_unfinished(self, doc_loader, finished):
+        """Remove what previous runs stored for the documents which are not
+        finished yet, when resuming. Does nothing by default.
+
+        This runs before the workers are forked, so the doc_loader returned,
+        which is read by the workers, must not use the session.
+
+        :param doc_loader: The documents to process.
+        :param finished: The names of the finished documents.
+        :return: The documents to process, which may omit the finished ones.
+        """
+        return doc_loader
+
+    def _estimate_costs(self, docs, **kwargs):
+        """Estimate the cost of applying the UDF to each of the documents.
+
+        By default, this is the length of the text of each document.
+
+        :param kwargs: The keyword arguments of the UDF, e.g. the split.
+        """
+        return [_doc_size(doc) for doc in docs]
+
+    def _schedule(self, doc_loader, schedule, **kwargs):
+        """Sort the documents by decreasing estimated cost.
+
+        A list is sorted as a whole, and other doc_loaders within windows of
+        SCHEDULE_WINDOW documents, so that they are not read all at once.
+        """
+        if schedule != "largest_first" and not callable(schedule):
+            raise ValueError("{} is not a valid schedule.".format(schedule))
+        if isinstance(doc_loader, (list, tuple)):
+            return self._sort_by_cost(list(doc_loader), schedule, **kwargs)
+        return (
+            doc
+            for docs in _chunk_docs(doc_loader, SCHEDULE_WINDOW, SCHEDULE_WINDOW)
+            for doc in self._sort_by_cost(docs, schedule, **kwargs)
+        )
+
+    def _sort_by_cost(self, docs, schedule, **kwargs):
+        """Sort a list of documents by decreasing cost under the schedule."""
+        if schedule == "largest_first":
+            costs = self._estimate_costs(docs, **kwargs)
+        else:
+            costs = [schedule(doc) for doc in docs]
+        order = sorted(range(len(docs)), key=lambda i: costs[i], reverse=True)
+        return [docs[i] for i in order]
+
+    def apply_st(
+        self, doc_loader, pool=None, commit_policy=None, run_attrs=None, **kwargs
+    ):
         """Run the UDF single-threaded, optionally with progress bar"""
-        udf = self.udf_class(**self.udf_init_kwargs)
+        if pool is not None and self.pooled_udf is not None:
+            udf = self.pooled_udf
+        else:
+            udf = self.udf_class(**self.udf_init_kwargs)
+        if pool is not None:
+            pool._checkout(self)
+            self.pooled_udf = udf
+        udf.commit_policy = commit_policy if commit_policy else CommitPolicy()
+        udf.commit_policy.reset()
+        for name, value in (run_attrs or {}).items():
+            setattr(udf, name, value)
 
         # Run single-thread
-        for doc in doc_loader:
+        for doc in udf._lookahead(doc_loader):
             if self.pb is not None:
                 self.pb.update(1)
 
-            udf.session.add_all(y for y in udf.apply(doc, **kwargs))
+            udf._apply_doc(doc, kwargs)
 
         # Commit session and close progress bar if applicable
-        udf.session.commit()
+        udf._finish()
+        if self.profile is not None:
+            self.profile.add_records(udf._take_profile_records())
 
-    def apply_mt(self, doc_loader, parallelism, **kwargs):
+    def apply_mt(
+        self,
+        doc_loader,
+        parallelism,
+        chunk_size=1,
+        pass_ids=False,
+        pool=None,
+        queue_size=None,
+        commit_policy=None,
+        run_attrs=None,
+        **kwargs
+    ):
         """Run the UDF multi-threaded using python multiprocessing"""
         if not _meta.postgres:
             raise ValueError("Fonduer must use PostgreSQL as a database backend.")
 
-        def fill_input_queue(in_queue, doc_loader, terminal_signal):
-            for doc in doc_loader:
-                in_queue.put(doc)
-            in_queue.put(terminal_signal)
-
-        # Create an input queue to feed documents to UDF workers
-        manager = Manager()
-        in_queue = manager.Queue()
-        # Use an output queue to track multiprocess progress
-        out_queue = JoinableQueue()
+        # Never make chunks so large that some workers are left without work.
+        total_count = _loader_len(doc_loader)
+        if total_count is None:
+            max_chunk_size = MAX_AUTO_CHUNK_SIZE
+        else:
+            max_chunk_size = max(
+                1, math.ceil(total_count / (parallelism * MIN_CHUNKS_PER_WORKER))
+            )
+        queue_size = queue_size if queue_size else parallelism * QUEUE_CHUNKS_PER_WORKER
 
-        total_count = len(doc_loader)
+        def fill_input_queue(in_queue, doc_loader, terminal_signal):
+            for chunk in _chunk_docs(doc_loader, chunk_size, max_chunk_size):
+                if pass_ids:
+                    chunk = [doc.id for doc in chunk]
+                in_queue.put(chunk)
+            # Each worker stops after taking exactly one terminal signal
+            for _ in range(parallelism):
+                in_queue.put(terminal_signal)
 
-        # Start UDF Processes
-        for i in range(parallelism):
-            udf = self.udf_class(
-                in_queue=in_queue,
-                out_queue=out_queue,
-                worker_id=i,
-                **self.udf_init_kwargs
+        # Reuse the workers kept alive by the pool when possible. Otherwise,
+        # start new UDF processes, which get the apply kwargs when forked.
+        if pool is not None:
+            pool._checkout(self)
+        worker_attrs = {
+            "apply_kwargs": kwargs,
+            "pass_ids": pass_ids,
+            "commit_policy": commit_policy if commit_policy else CommitPolicy(),
+        }
+        worker_attrs.update(run_attrs or {})
+        if self.udfs and (
+            pool is None
+            or len(self.udfs) != parallelism
+            or self.queue_size != queue_size
+            or not self._configure_workers(worker_attrs)
+        ):
+            self._stop_workers(graceful=False)
+        if not self.udfs:
+            self._start_workers(
+                parallelism, worker_attrs, queue_size, persistent=pool is not None
             )
-            udf.apply_kwargs = kwargs
-            self.udfs.append(udf)
-
-        # Start the UDF processes, and then join on their completion
-        for udf in self.udfs:
-            udf.start()
 
         # Fill input queue with documents
         terminal_signal = UDF.QUEUE_CLOSED
         in_queue_filler = Process(
-            target=fill_input_queue, args=(in_queue, doc_loader, terminal_signal)
+            target=fill_input_queue, args=(self.in_queue, doc_loader, terminal_signal)
         )
         in_queue_filler.start()
 
-        count_parsed = 0
-        while count_parsed < total_count:
-            y = out_queue.get()
-            # Update progress bar whenever an item has been  processed
-            if y == UDF.TASK_DONE:
-                count_parsed += 1
+        try:
+            self._wait_for_workers(parallelism)
+        except BaseException:
+            in_queue_filler.terminate()
+            self._stop_workers(graceful=False)
+            raise
+
+        in_queue_filler.join()
+
+        if pool is None:
+            self._stop_workers()
+
+    def apply_db(
+        self,
+        doc_loader,
+        parallelism,
+        chunk_size=1,
+        pass_ids=False,
+        commit_policy=None,
+        run_attrs=None,
+        **kwargs
+    ):
+        """Run the UDF through the UDFTask table of the database.
+
+        Every document (or document id) becomes a task of this stage. Any
+        previous tasks of this stage are replaced.
+        """
+        if not _meta.postgres:
+            raise ValueError("Fonduer must use PostgreSQL as a database backend.")
+
+        stage = run_attrs["stage"]
+        config_hash = run_attrs["config_hash"]
+        self.session.query(UDFTask).filter(UDFTask.stage == stage).delete()
+        for docs in _chunk_docs(doc_loader, TASK_INSERT_SIZE, TASK_INSERT_SIZE):
+            self.session.execute(
+                UDFTask.__table__.insert(),
+                [
+                    {
+                        "stage": stage,
+                        "config_hash": config_hash,
+                        "payload": pickle.dumps(doc.id if pass_ids else doc),
+                    }
+                    for doc in docs
+                ],
+            )
+        self.session.commit()
+
+        self._work_db(parallelism, chunk_size, commit_policy, run_attrs, kwargs)
+
+    def work(
+        self,
+        parallelism=None,
+        progress_bar=True,
+        chunk_size=1,
+        commit_policy=None,
+        profile=False,
+        recycle_policy=None,
+        **kwargs
+    ):
+        """Help process the tasks queued by UDFRunner.apply(distributed=True).
+
+        This can run on any host whose Meta is initialized with the same
+        database, using a runner created with the same arguments and the same
+        keyword arguments (e.g. split) as the call to apply. It returns once
+        no task of this stage is left.
+
+        :param chunk_size: The number of tasks a worker claims at a time.
+            Default 1.
+        :param profile: Whether to profile the tasks processed on this host.
+            Default False.
+        :param recycle_policy: A RecyclePolicy for the workers on this host.
+        """
+        stage = self.__class__.__name__
+        config_hash = self._stage_config_hash(**kwargs)
+        run_attrs = {
+            "stage": stage,
+            "config_hash": config_hash,
+            "profile": profile,
+            "recycle_policy": recycle_policy,
+        }
+        self.profile = Profile(stage) if profile else None
+        start = time.time()
+
+        self.pb = tqdm() if progress_bar else None
+        parallelism = parallelism if parallelism else self.parallelism
+        self._work_db(parallelism, chunk_size, commit_policy, run_attrs, kwargs)
+        if self.profile is not None:
+            self.profile.wall_time = time.time() - start
+        if self.pb is not None:
+            self.pb.close()
+
+    def _work_db(self, parallelism, chunk_size, commit_policy, run_attrs, kwargs):
+        """Process tasks of the UDFTask table until none is pending or running.
+
+        Tasks claimed by workers on other hosts are waited for. If their lease
+        expires, they are claimed again.
+        """
+        if self.udfs:
+            self._stop_workers(graceful=False)
+
+        worker_attrs = {
+            "apply_kwargs": kwargs,
+            "commit_policy": commit_policy if commit_policy else CommitPolicy(),
+            "distributed": True,
+            "claim_size": chunk_size if chunk_size else 1,
+        }
+        worker_attrs.update(run_attrs)
+
+        stage = run_attrs["stage"]
+        config_hash = run_attrs["config_hash"]
+        tasks = self.session.query(UDFTask).filter(
+            UDFTask.stage == stage, UDFTask.config_hash == config_hash
+        )
+        while True:
+            if tasks.filter(_claimable_task()).count():
+                self._start_workers(parallelism, worker_attrs, 1)
+                try:
+                    self._wait_for_workers(parallelism)
+                except BaseException:
+                    self._stop_workers(graceful=False)
+                    raise
+                self._stop_workers()
+            elif tasks.filter(UDFTask.status == "running").count():
+                time.sleep(QUEUE_TIMEOUT)
+            else:
+                break
+
+        failed = tasks.filter(UDFTask.status == "failed").count()
+        if failed:
+            self.logger.warning("{} {} tasks failed.".format(failed, stage))
+
+    def _wait_for_workers(self, parallelism):
+        """Wait until every worker has committed its results."""
+        count_finished = 0
+        while count_finished < parallelism:
+            y = self._get_output()
+            # Update progress bar whenever a chunk of items has been processed
+            if isinstance(y, tuple) and y[0] == UDF.TASK_DONE:
                 if self.pb is not None:
-                    self.pb.update(1)
+                    self.pb.update(y[1])
+                if self.profile is not None:
+                    self.profile.add_records(y[2])
+            elif isinstance(y, tuple) and y[0] == UDF.WORKER_RECYCLE:
+                self._recycle_worker(y[1])
+            elif y == UDF.QUEUE_CLOSED:
+                count_finished += 1
             else:
                 raise ValueError("Got non-sentinal output.")
 
-        in_queue_filler.join()
-        in_queue.put(UDF.QUEUE_CLOSED)
+    def _get_output(self):
+        """Return the next message of the workers.
+
+        :raises RuntimeError: if a worker died before sending it, e.g. after
+            an exception or when killed for lack of memory.
+        """
+        while True:
+            try:
+                return self.out_queue.get(timeout=QUEUE_TIMEOUT)
+            except Empty:
+                for udf in self.udfs:
+                    # Workers which finish, or exit to be recycled, exit with 0
+                    if udf.exitcode not in (None, 0):
+                        raise RuntimeError(
+                            "UDF worker {} exited with code {}.".format(
+                                udf.worker_id, udf.exitcode
+                            )
+                        )
+
+    def _start_workers(self, parallelism, worker_attrs, queue_size, persistent=False):
+        """Start the UDF processes.
+
+        :param worker_attrs: A dict of attributes to set on each UDF for this
+            call to apply, e.g. the apply kwargs.
+        :param queue_size: The maximum number of chunks in the input queue.
+        :param persistent: Whether the workers should wait for another call to
+            apply after finishing, rather than exit.
+        """
+        # Create a bounded input queue to feed documents to UDF workers. The
+        # queue filler blocks when it is full, which bounds memory usage.
+        self.in_queue = Queue(maxsize=queue_size)
+        self.queue_size = queue_size
+        # Use an output queue to track multiprocess progress
+        self.out_queue = JoinableQueue()
+
+        self._worker_attrs = worker_attrs
+        for i in range(parallelism):
+            self.udfs.append(self._new_worker(i, persistent))
+
+        self._fork_workers(self.udfs)
+
+    def _fork_workers(self, udfs):
+        """Start the UDF processes with the objects of this process frozen.
+
+        The objects tracked by the garbage collector when the workers are
+        forked (e.g. a preloaded spaCy model) are moved out of its reach, so
+        that collections in the workers do not copy the pages they share with
+        this process. They are unfrozen in this process once forked.
+        """
+        # gc.freeze is only available from Python 3.7
+        if hasattr(gc, "freeze"):
+            gc.freeze()
+        try:
+            for udf in udfs:
+                udf.start()
+        finally:
+            if hasattr(gc, "unfreeze"):
+                gc.unfreeze()
+
+    def _new_worker(self, worker_id, persistent):
+        """Create a UDF process with the attributes of the current apply."""
+        udf = self.udf_class(
+            in_queue=self.in_queue,
+            out_queue=self.out_queue,
+            worker_id=worker_id,
+            control_queue=Queue() if persistent else None,
+            **self.udf_init_kwargs
+        )
+        for name, value in self._worker_attrs.items():
+            setattr(udf, name, value)
+        return udf
+
+    def _recycle_worker(self, worker_id):
+        """Replace a worker which exited to free its memory.
+
+        The new worker takes the next documents from the shared input queue,
+        where the old one stopped.
+        """
+        old_udf = self.udfs[worker_id]
+        old_udf.join()
+        udf = self._new_worker(worker_id, old_udf.control_queue is not None)
+        self.udfs[worker_id] = udf
+        self._fork_workers([udf])
+        self.logger.debug("Recycled worker {}".format(worker_id))
+
+    def _configure_workers(self, worker_attrs):
+        """Send the UDF attributes of a new call to apply to persistent workers.
+
+        :return: True if every worker is ready to process documents.
+        """
+        # Pickle here rather than in the queue so that failures are visible.
+        # Objects created after the workers were forked (e.g. new labeling
+        # functions in a notebook) may only fail once unpickled by a worker.
+        try:
+            message = pickle.dumps(worker_attrs)
+        except Exception:
+            self.logger.debug("Restarting workers: apply kwargs can not be pickled.")
+            return False
 
         for udf in self.udfs:
-            udf.join()
+            udf.control_queue.put(message)
+        try:
+            ready = [self._get_output() for _ in self.udfs]
+        except RuntimeError as e:
+            self.logger.debug("Restarting workers: {}".format(e))
+            return False
+        if any(y != UDF.WORKER_READY for y in ready):
+            self.logger.debug("Restarting workers: apply kwargs were not loaded.")
+            return False
+        self._worker_attrs = worker_attrs
+        return True
+
+    def _stop_workers(self, graceful=True):
+        """Stop the UDF processes.
+
+        :param graceful: Whether to wait for idle persistent workers to exit
+            on their own rather than terminate them.
+        """
+        if graceful:
+            for udf in self.udfs:
+                if udf.control_queue is not None and udf.is_alive():
+                    udf.control_queue.put(UDF.QUEUE_CLOSED)
+            for udf in self.udfs:
+                udf.join()
 
         # Terminate and flush the processes
         for udf in self.udfs:
             udf.terminate()
         self.udfs = []
+        self.in_queue = None
+        self.out_queue = None
+        self.queue_size = None
+
+
+class CommitPolicy(object):
+    """Decide how often a UDF commits the objects it adds to its session.
+
+    The session is committed and expunged as soon as any of the limits is
+    reached, so that a UDF only holds a small, bounded transaction and does
+    not keep every object it created in memory. Commits only happen between
+    documents, and when the documents are passed by id, only once all the
+    documents loaded with them are applied. Limits set to None are ignored.
+
+    :param docs: Commit after processing this many documents. Default 100.
+    :param objects: Commit after adding this many objects, or writing this
+        many rows directly (e.g. the Features upserted by the Featurizer).
+        Default None.
+    :param seconds: Commit after this many seconds. Default None.
+    """
+
+    def __init__(self, docs=100, objects=None, seconds=None):
+        self.docs = docs
+        self.objects = objects
+        self.seconds = seconds
+        self.reset()
+
+    def reset(self):
+        """Start counting from the last commit."""
+        self.n_docs = 0
+        self.n_objects = 0
+        self.start = time.time()
+
+    def update(self, n_objects):
+        """Record one processed document which added n_objects objects.
+
+        :return: True if the session should be committed now.
+        """
+        self.n_docs += 1
+        self.n_objects += n_objects
+        return self.due()
+
+    def due(self):
+        """Return True if any limit was reached since the last commit."""
+        return (
+            (self.docs is not None and self.n_docs >= self.docs)
+            or (self.objects is not None and self.n_objects >= self.objects)
+            or (self.seconds is not None and time.time() - self.start >= self.seconds)
+        )
+
+
+class RecyclePolicy(object):
+    """Decide when a parallel UDF worker is replaced by a fresh process.
+
+    Long-running workers accumulate memory, e.g. in the module-level caches of
+    the feature libraries. A recycled worker commits its outputs and exits, and
+    a new worker forked from the runner takes its place. Limits set to None
+    are ignored.
+
+    :param docs: Recycle a worker after it processed this many documents.
+        Default None.
+    :param memory: Recycle a worker once its resident memory exceeds this many
+        megabytes. Default None.
+    """
+
+    def __init__(self, docs=None, memory=None):
+        self.docs = docs
+        self.memory = memory
+
+    def due(self, n_docs):
+        """Return True if a worker which processed n_docs should be recycled."""
+        return (self.docs is not None and n_docs >= self.docs) or (
+            self.memory is not None and _rss_bytes() >= self.memory * 1024 * 1024
+        )
+
+
+def _rss_bytes():
+    """Return the resident memory of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # Fall back to the peak resident memory, in bytes on macOS and in
+        # kilobytes elsewhere.
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+class WorkerPool(object):
+    """Keep the UDF workers of UDFRunners alive across calls to apply.
+
+    Starting a UDF worker forks a process, creates a new database engine and,
+    in the case of the Parser, loads a spaCy model. When the same pool is
+    passed to repeated calls to ``apply()``, e.g. when iterating on labeling
+    functions in a notebook, each UDFRunner reuses its warm workers instead.
+    A single pool can be shared by all the stages of a pipeline.
+
+    Workers are forked from the UDFRunner that first uses them, so the
+    arguments of later calls to ``apply()`` are pickled and sent to them. If
+    that fails, the workers of that UDFRunner are transparently restarted.
+
+    :param max_runners: The number of UDFRunners whose workers are kept alive.
+        The workers of the least recently used UDFRunner are stopped when a
+        new one is added. Default 4.
+    """
+
+    def __init__(self, max_runners=4):
+        self.max_runners = max_runners
+        self.runners = OrderedDict()
+
+    def _checkout(self, runner):
+        """Mark the runner as the most recently used one of the pool."""
+        self.runners[runner] = True
+        self.runners.move_to_end(runner)
+        while len(self.runners) > self.max_runners:
+            old_runner, _ = self.runners.popitem(last=False)
+            old_runner._stop_workers()
+            old_runner.pooled_udf = None
+
+    def close(self):
+        """Stop all the workers kept alive by the pool."""
+        for runner in self.runners:
+            runner._stop_workers()
+            runner.pooled_udf = None
+        self.runners.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _claimable_task():
+    """Return the condition of the tasks which a worker can claim."""
+    lease_expired = UDFTask.updated < func.now() - timedelta(seconds=TASK_LEASE_SECONDS)
+    return or_(
+        UDFTask.status == "pending",
+        and_(UDFTask.status == "running", lease_expired),
+    )
+
+
+def _stable_repr(value):
+    """Return a representation of value which is stable across sessions."""
+    if isinstance(value, dict):
+        items = sorted((_stable_repr(k), _stable_repr(v)) for k, v in value.items())
+        return "{" + ", ".join("{}: {}".format(k, v) for k, v in items) + "}"
+    if isinstance(value, (set, frozenset)):
+        return "{" + ", ".join(sorted(_stable_repr(v) for v in value)) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(_stable_repr(v) for v in value) + "]"
+    if isinstance(value, types.CodeType):
+        return "<code {} {} {}>".format(
+            value.co_code.hex(),
+            _stable_repr(value.co_consts),
+            _stable_repr(value.co_names),
+        )
+    # Identify functions and classes by name rather than by memory address,
+    # and functions by their code too, so that editing one changes the hash
+    if callable(value) and hasattr(value, "__qualname__"):
+        name = "{}.{}".format(value.__module__, value.__qualname__)
+        if hasattr(value, "__code__"):
+            name += _stable_repr(value.__code__)
+        return name
+    return re.sub(r" at 0x[0-9a-fA-F]+", "", repr(value))
+
+
+def _config_hash(*configs):
+    """Hash the configuration (e.g. the keyword arguments) of a UDF."""
+    return hashlib.sha1(_stable_repr(configs).encode("utf-8")).hexdigest()
+
+
+def _skip_finished(doc_loader, finished):
+    """Filter out the documents whose name is in finished."""
+    if isinstance(doc_loader, (list, tuple, set)):
+        return [doc for doc in doc_loader if doc.name not in finished]
+    return (doc for doc in doc_loader if doc.name not in finished)
+
+
+def _loader_len(doc_loader):
+    """Return the number of documents of doc_loader, or None if unknown."""
+    try:
+        return len(doc_loader)
+    except (TypeError, NotImplementedError):
+        return None
+
+
+def _doc_size(doc):
+    """Return the number of characters of text already loaded for a document."""
+    # Only look at attributes which are already loaded so that this never
+    # triggers a lazy load on an ORM object.
+    text = getattr(doc, "__dict__", {}).get("text")
+    return len(text) if text else 1
+
+
+def _chunk_docs(doc_loader, chunk_size, max_chunk_size):
+    """Group the documents of doc_loader into lists of documents.
+
+    :param doc_loader: An iterable of documents.
+    :param chunk_size: The number of documents per chunk. If None, pick the
+        size from the running average size of the documents seen so far.
+    :param max_chunk_size: An upper bound on the size of automatic chunks.
+    :rtype: a *generator* of lists of documents.
+    """
+    chunk = []
+    total_chars = 0
+    num_docs = 0
+    size = chunk_size if chunk_size else 1
+    for doc in doc_loader:
+        chunk.append(doc)
+        if not chunk_size:
+            total_chars += _doc_size(doc)
+            num_docs += 1
+            avg_chars = total_chars / num_docs
+            size = min(max(1, int(AUTO_CHUNK_CHARS // avg_chars)), max_chunk_size)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 class UDF(Process):
     TASK_DONE = "done"
     QUEUE_CLOSED = "QUEUECLOSED"
+    WORKER_READY = "ready"
+    WORKER_ERROR = "error"
+    WORKER_RECYCLE = "recycle"
+
+    # The attributes of a Document which apply() uses. When documents are
+    # passed to the workers by id, the listed relationships are eager-loaded
+    # and Document.text is deferred unless it is listed.
+    DOC_ATTRIBUTES = []
 
-    def __init__(self, in_queue=None, out_queue=None, worker_id=0):
+    def __init__(self, in_queue=None, out_queue=None, worker_id=0, control_queue=None):
         """
-        in_queue: A Queue of input objects to process; primarily for running in parallel
+        in_queue: A Queue of lists of input objects to process; primarily for
+            running in parallel
+        control_queue: A Queue of pickled UDF attributes (e.g. the apply kwargs)
+            for each new call to apply; only used by workers which are kept
+            alive by a WorkerPool
         """
         Process.__init__(self)
         self.daemon = True
         self.in_queue = in_queue
         self.out_queue = out_queue
+        self.control_queue = control_queue
         self.worker_id = worker_id
 
         # Each UDF starts its own Engine
         # See SQLalchemy, using connection pools with multiprocessing.
-        Session = new_sessionmaker()
+        # The session is not in autocommit mode, so that the outputs of the
+        # documents and their ledger rows are written in one transaction.
+        Session = new_sessionmaker(isolation_level="READ COMMITTED")
         self.session = Session()
 
         # We use a workaround to pass in the apply kwargs
         self.apply_kwargs = {}
+        # Whether the input queue holds document ids rather than documents
+        self.pass_ids = False
+        self.commit_policy = CommitPolicy()
+        # The ledger records the documents finished by this stage
+        self.stage = None
+        self.config_hash = None
+        self._finished_docs = []
+        # Whether the documents being applied were loaded into the session, in
+        # which case committing (and expunging) must wait until all of them
+        # are applied
+        self._docs_in_session = False
+        # Whether to claim tasks from the database rather than the input queue
+        self.distributed = False
+        self.claim_size = 1
+        # Whether to record the time spent in each phase of each document
+        self.profile = False
+        self._profile_records = []
+        self._pending_phases = {}
+        # When to replace this worker by a fresh process, if ever
+        self.recycle_policy = None
+        self._n_docs = 0
+        # The rows which apply wrote itself (e.g. upserted) rather than
+        # returned as objects, counted like the objects by the CommitPolicy
+        self._rows_written = 0
 
     def run(self):
         """
@@ -178,18 +979,330 @@ class UDF(Process):
         multiprocess setting The basic routine is: get from JoinableQueue,
         apply, put / add outputs, loop
         """
+        while True:
+            if self.distributed:
+                recycled = self._process_tasks()
+            else:
+                recycled = self._process_queue()
+            # Persistent workers wait for the next call to apply
+            if recycled or self.control_queue is None or not self._receive_attrs():
+                break
+        self.session.close()
+
+    def _process_queue(self):
+        """Process documents from the input queue until the terminal signal.
+
+        :return: True if the worker stopped early to be recycled.
+        """
+        recycled = False
+        self.commit_policy.reset()
+        wait_start = time.perf_counter()
         while True:
             try:
-                doc = self.in_queue.get(True, QUEUE_TIMEOUT)
-                if doc == UDF.QUEUE_CLOSED:
-                    self.in_queue.put(UDF.QUEUE_CLOSED)
+                docs = self.in_queue.get(True, QUEUE_TIMEOUT)
+                if docs == UDF.QUEUE_CLOSED:
+                    break
+                self._add_pending_phase("queue_wait", wait_start)
+                if self.pass_ids:
+                    load_start = time.perf_counter()
+                    docs = self._load_docs(docs)
+                    self._add_pending_phase("load", load_start)
+                    self._docs_in_session = True
+                for doc in self._lookahead(docs):
+                    self._apply_doc(doc, self.apply_kwargs)
+                self._docs_in_session = False
+                if self.commit_policy.due():
+                    self._finish()
+                # Report progress once per chunk rather than once per document
+                self.out_queue.put(
+                    (UDF.TASK_DONE, len(docs), self._take_profile_records())
+                )
+                if self._recycle_due():
+                    recycled = True
                     break
-                self.session.add_all(y for y in self.apply(doc, **self.apply_kwargs))
-                self.out_queue.put(UDF.TASK_DONE)
+                wait_start = time.perf_counter()
             except Empty:
                 continue
+        self._finish()
+        records = self._take_profile_records()
+        if records:
+            self.out_queue.put((UDF.TASK_DONE, 0, records))
+        self._report_end(recycled)
+        return recycled
+
+    def _process_tasks(self):
+        """Claim and process tasks from the UDFTask table until none is left.
+
+        Tasks are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so that
+        workers on several hosts never claim the same task.
+
+        :return: True if the worker stopped early to be recycled.
+        """
+        recycled = False
+        worker = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.commit_policy.reset()
+        while True:
+            claim_start = time.perf_counter()
+            claimable = (
+                select([UDFTask.id])
+                .where(
+                    and_(
+                        UDFTask.stage == self.stage,
+                        UDFTask.config_hash == self.config_hash,
+                        _claimable_task(),
+                    )
+                )
+                .order_by(UDFTask.id)
+                .limit(self.claim_size)
+                .with_for_update(skip_locked=True)
+            )
+            claimed = self.session.execute(
+                UDFTask.__table__.update()
+                .where(UDFTask.id.in_(claimable))
+                .values(status="running", worker=worker, updated=func.now())
+                .returning(UDFTask.id, UDFTask.payload)
+            ).fetchall()
+            self.session.commit()
+            if not claimed:
+                break
+            self._add_pending_phase("queue_wait", claim_start)
+
+            task_ids = [task_id for task_id, _ in claimed]
+            try:
+                load_start = time.perf_counter()
+                docs = self._load_task_docs([payload for _, payload in claimed])
+                # A task claimed again after its worker died may have some of
+                # its documents committed already
+                docs = self._unfinished_docs(docs)
+                self._add_pending_phase("load", load_start)
+                self._docs_in_session = True
+                lease_renewed = time.time()
+                for doc in self._lookahead(docs):
+                    self._apply_doc(doc, self.apply_kwargs)
+                    if time.time() - lease_renewed >= TASK_LEASE_SECONDS / 4:
+                        self._renew_lease(task_ids, worker)
+                        lease_renewed = time.time()
+                self._docs_in_session = False
+                self._finish()
+                status = "done"
+            except Exception:
+                logger.exception("Failed to process tasks {}".format(task_ids))
+                self._docs_in_session = False
+                self.session.rollback()
+                self.session.expunge_all()
+                self._finished_docs = []
+                self._pending_phases = {}
+                status = "failed"
+            self.session.query(UDFTask).filter(UDFTask.id.in_(task_ids)).update(
+                {"status": status, "updated": func.now()}, synchronize_session=False
+            )
+            self.session.commit()
+            self.out_queue.put(
+                (UDF.TASK_DONE, len(task_ids), self._take_profile_records())
+            )
+            if self._recycle_due():
+                recycled = True
+                break
+        self._report_end(recycled)
+        return recycled
+
+    def _renew_lease(self, task_ids, worker):
+        """Mark the claimed tasks as updated now, so that their lease does not
+        expire while they are processed.
+
+        The update is committed right away on its own connection, since the
+        outputs of the tasks are only committed once they are all processed.
+        """
+        stmt = (
+            UDFTask.__table__.update()
+            .where(and_(UDFTask.id.in_(task_ids), UDFTask.worker == worker))
+            .values(updated=func.now())
+        )
+        self.session.get_bind().execution_options(isolation_level="AUTOCOMMIT").execute(
+            stmt
+        )
+
+    def _recycle_due(self):
+        return self.recycle_policy is not None and self.recycle_policy.due(self._n_docs)
+
+    def _report_end(self, recycled):
+        """Tell the runner that this worker is done, or needs to be replaced."""
+        if recycled:
+            self.out_queue.put((UDF.WORKER_RECYCLE, self.worker_id))
+        else:
+            self.out_queue.put(UDF.QUEUE_CLOSED)
+
+    def _load_task_docs(self, payloads):
+        """Load the documents of the given task payloads."""
+        items = [pickle.loads(payload) for payload in payloads]
+        # The payloads are either all documents or all document ids
+        if items and isinstance(items[0], int):
+            return self._load_docs(items)
+        return items
+
+    def _unfinished_docs(self, docs):
+        """Return the documents which are not in the ledger of this stage."""
+        names = [doc.name for doc in docs if getattr(doc, "name", None) is not None]
+        if self.stage is None or not names:
+            return docs
+        finished = {
+            name
+            for (name,) in self.session.query(StageLedger.document_name).filter(
+                StageLedger.stage == self.stage,
+                StageLedger.config_hash == self.config_hash,
+                StageLedger.document_name.in_(names),
+            )
+        }
+        return _skip_finished(docs, finished)
+
+    def _apply_doc(self, doc, kwargs):
+        """Apply the UDF to one document and commit if the policy says so.
+
+        While the documents were loaded into the session, the commit waits
+        until all of them are applied, since it expunges the session.
+        """
+        name = getattr(doc, "name", None)
+        self._n_docs += 1
+        if self.profile:
+            record = start_record(self.stage, name)
+            record["phases"].update(self._pending_phases)
+            self._pending_phases = {}
+            self._profile_records.append(record)
+        try:
+            self._rows_written = 0
+            with profile_phase("apply"):
+                objects = list(self.apply(doc, **kwargs))
+            self._add_outputs(objects)
+            n_rows = len(objects) + self._rows_written
+            if self.profile:
+                record["rows"] = n_rows
+            if name is not None:
+                self._finished_docs.append(name)
+            due = self.commit_policy.update(n_rows)
+            if due and not self._docs_in_session:
+                with profile_phase("commit"):
+                    self._commit()
+        finally:
+            stop_record()
+
+    def _lookahead(self, docs):
+        """Yield the documents, preparing each one before the previous one is
+        applied.
+        """
+        docs = iter(docs)
+        try:
+            current = next(docs)
+        except StopIteration:
+            return
+        self._prepare(current)
+        for doc in docs:
+            self._prepare(doc)
+            yield current
+            current = doc
+        yield current
+
+    def _prepare(self, doc):
+        """Start the work on a document which can run ahead of apply, e.g. on
+        another thread. Does nothing by default.
+        """
+        pass
+
+    def _add_outputs(self, objects):
+        """Add the outputs of apply for one document to the session."""
+        self.session.add_all(objects)
+
+    def _finish(self):
+        """Commit the remaining outputs, profiling the commit if requested.
+
+        The time of this commit is not part of the record of any document.
+        """
+        if self.profile:
+            self._profile_records.append(start_record(self.stage, None))
+        try:
+            with profile_phase("commit"):
+                self._commit()
+        finally:
+            stop_record()
+
+    def _add_pending_phase(self, name, start):
+        """Add the time since start to the record of the next document."""
+        if self.profile:
+            self._pending_phases[name] = (
+                self._pending_phases.get(name, 0.0) + time.perf_counter() - start
+            )
+
+    def _take_profile_records(self):
+        """Return the profile records since the last call, and forget them."""
+        records = self._profile_records
+        self._profile_records = []
+        return records
+
+    def _commit(self):
+        """Commit the session and stop holding on to the committed objects.
+
+        The finished documents are added to the ledger in the same
+        transaction as their outputs, so a document is either fully stored
+        and in the ledger, or not stored at all.
+        """
+        if self.stage is not None and self._finished_docs:
+            # The outputs (e.g. the Documents) must be inserted before the
+            # ledger rows which refer to them
+            self.session.flush()
+            self.session.execute(
+                insert(StageLedger)
+                .values(
+                    [
+                        {
+                            "stage": self.stage,
+                            "document_name": name,
+                            "config_hash": self.config_hash,
+                        }
+                        for name in self._finished_docs
+                    ]
+                )
+                .on_conflict_do_nothing()
+            )
         self.session.commit()
-        self.session.close()
+        self._finished_docs = []
+        self.session.expunge_all()
+        self.commit_policy.reset()
+
+    def _receive_attrs(self):
+        """Wait for the UDF attributes of the next call to apply.
+
+        :return: False if the worker should exit.
+        """
+        message = self.control_queue.get()
+        if message == UDF.QUEUE_CLOSED:
+            return False
+        try:
+            for name, value in pickle.loads(message).items():
+                setattr(self, name, value)
+        except Exception:
+            self.out_queue.put(UDF.WORKER_ERROR)
+            return False
+        self.out_queue.put(UDF.WORKER_READY)
+        return True
+
+    def _load_docs(self, doc_ids):
+        """Load the Documents with the given ids, in the same order."""
+        # NOTE: Import here to avoid circular imports.
+        from fonduer.parser.models import Document
+
+        options = [
+            subqueryload(getattr(Document, attr))
+            for attr in self.DOC_ATTRIBUTES
+            if attr != "text"
+        ]
+        if "text" not in self.DOC_ATTRIBUTES:
+            options.append(defer(Document.text))
+        docs = {
+            doc.id: doc
+            for doc in self.session.query(Document)
+            .options(*options)
+            .filter(Document.id.in_(doc_ids))
+        }
+        return [docs[doc_id] for doc_id in doc_ids]
 
     def apply(self, doc, **kwargs):
         """This function takes in an object, and returns a generator / set / list"""
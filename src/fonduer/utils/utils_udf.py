@@ -1,10 +1,14 @@
 import logging
+from collections import Counter
 
 from scipy.sparse import csr_matrix
+from sqlalchemy import func, or_
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm.exc import NoResultFound
 
 from fonduer.candidates.models import Candidate
+from fonduer.parser.models import Document
+from fonduer.utils.models import StageLedger
 
 logger = logging.getLogger(__name__)
 
@@ -44,8 +48,8 @@ def batch_upsert_records(session, table, records):
         constraint=table.__table__.primary_key,
         set_={"keys": stmt.excluded.get("keys"), "values": stmt.excluded.get("values")},
     )
+    # Committed by the UDF with the other outputs of the documents
     session.execute(stmt)
-    session.commit()
 
 
 def get_sparse_matrix(session, key_table, cand_lists, key=None):
@@ -98,6 +102,27 @@ def get_docs_from_split(session, candidate_classes, split):
     return split_docs
 
 
+def delete_split_ledger(session, stage, candidate_classes, split):
+    """Delete the ledger rows of a stage for the documents which contain
+    candidates of the given classes in the split, e.g. before their outputs
+    in the split are cleared.
+
+    :param stage: The stage of the ledger rows.
+    :param split: The split of the candidates, or ALL_SPLITS.
+    """
+    split_doc_ids = []
+    for candidate_class in candidate_classes:
+        query = session.query(candidate_class.document_id)
+        if split != ALL_SPLITS:
+            query = query.filter(candidate_class.split == split)
+        split_doc_ids.append(Document.id.in_(query.subquery()))
+    split_doc_names = session.query(Document.name).filter(or_(*split_doc_ids))
+    session.query(StageLedger).filter(
+        StageLedger.stage == stage,
+        StageLedger.document_name.in_(split_doc_names.subquery()),
+    ).delete(synchronize_session=False)
+
+
 def get_mapping(session, table, candidates, generator, key_set):
     """Generate map of keys and values for the candidate from the generator.
 
@@ -165,6 +190,30 @@ def add_keys(session, key_table, keys):
 
     # Rather than deal with concurrency of querying first then inserting only
     # new keys, insert with on_conflict_do_nothing.
-    stmt = insert(key_table.__table__).values([{"name": key} for key in keys])
+    stmt = insert(key_table.__table__).values([{"name": key} for key in sorted(keys)])
     stmt = stmt.on_conflict_do_nothing(constraint=key_table.__table__.primary_key)
-    session.execute(stmt)
+    # The keys are shared by all the workers. Commit them right away on a
+    # connection of their own, rather than in the transaction of the session,
+    # so that workers adding the same keys do not wait for each other. The
+    # keys are sorted so that concurrent inserts lock them in the same order.
+    session.get_bind().execution_options(isolation_level="AUTOCOMMIT").execute(stmt)
+
+
+def get_doc_candidate_counts(session, candidate_classes, docs, split=ALL_SPLITS):
+    """Return the number of candidates of the given classes in each document.
+
+    :param docs: The documents whose candidates are counted.
+    :param split: Only count the candidates of this split, unless ALL_SPLITS.
+    """
+    counts = Counter()
+    doc_ids = [doc.id for doc in docs]
+    if not doc_ids:
+        return []
+    for candidate_class in candidate_classes:
+        query = session.query(
+            candidate_class.document_id, func.count(candidate_class.id)
+        ).filter(candidate_class.document_id.in_(doc_ids))
+        if split != ALL_SPLITS:
+            query = query.filter(candidate_class.split == split)
+        counts.update(dict(query.group_by(candidate_class.document_id)))
+    return [counts[doc_id] for doc_id in doc_ids]
@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+"""Micro-benchmark of the per-paragraph overhead of sentence splitting.
+
+Documents with many short table-cell paragraphs call split_sentences once per
+paragraph, and enrich_sentences_with_NLP once per document. This compares the
+persistent sentence splitter of Spacy with the previous approach, which
+swapped pipeline components of the spaCy model on every call.
+
+Usage: python tests/parser/benchmark_spacy_parser.py
+"""
+import timeit
+
+from fonduer.parser.spacy_parser import Spacy
+
+N_DOCUMENTS = 20
+N_PARAGRAPHS = 500
+PARAGRAPH = "12.5 V"
+
+
+def split_with_pipeline_mutation(model, text):
+    """Split sentences by adding the sentencizer to the pipeline, as before."""
+    if model.has_pipe("sentence_boundary_detector"):
+        model.remove_pipe(name="sentence_boundary_detector")
+    if not model.has_pipe("sbd"):
+        model.add_pipe(model.create_pipe("sbd"))
+    return list(model(text, disable=["parser", "tagger", "ner"]).sents)
+
+
+def enrich_with_pipeline_mutation(model):
+    """Swap the sentencizer for a boundary detector, as enrichment did."""
+    if model.has_pipe("sbd"):
+        model.remove_pipe("sbd")
+    model.add_pipe(lambda doc: doc, before="parser", name="sentence_boundary_detector")
+
+
+def run_before(model):
+    for _ in range(N_DOCUMENTS):
+        for _ in range(N_PARAGRAPHS):
+            split_with_pipeline_mutation(model, PARAGRAPH)
+        enrich_with_pipeline_mutation(model)
+
+
+def run_after(spacy):
+    for _ in range(N_DOCUMENTS):
+        for _ in range(N_PARAGRAPHS):
+            list(spacy.split_sentences(None, PARAGRAPH))
+
+
+def main():
+    spacy = Spacy("en")
+    spacy.load_lang_model()
+    n_paragraphs = N_DOCUMENTS * N_PARAGRAPHS
+
+    before = min(timeit.repeat(lambda: run_before(spacy.model), number=1, repeat=3))
+    # Leave the pipeline of the model as load_lang_model built it
+    for name in ["sbd", "sentence_boundary_detector"]:
+        if spacy.model.has_pipe(name):
+            spacy.model.remove_pipe(name)
+    after = min(timeit.repeat(lambda: run_after(spacy), number=1, repeat=3))
+
+    print("Paragraphs: {}".format(n_paragraphs))
+    print("Before: {:.1f} us per paragraph".format(before / n_paragraphs * 1e6))
+    print("After:  {:.1f} us per paragraph".format(after / n_paragraphs * 1e6))
+
+
+if __name__ == "__main__":
+    main()
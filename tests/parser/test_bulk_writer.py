@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+import logging
+from unittest.mock import MagicMock
+
+from fonduer import Meta
+from fonduer.parser import Parser
+from fonduer.parser.bulk_writer import BulkContextWriter
+from fonduer.parser.models import Context, Document, Paragraph, Section, Sentence
+from fonduer.parser.preprocessors import HTMLDocPreprocessor
+
+DB = "parser_test"
+
+
+def test_bulk_context_writer(caplog):
+    """Test that the writer streams the rows of each table with COPY."""
+    caplog.set_level(logging.INFO)
+
+    doc = Document(name="doc", stable_id="doc::document:0:0", text="a\tb", meta={})
+    section = Section(document=doc, stable_id="doc::section:0:5", position=0)
+    paragraph = Paragraph(
+        document=doc, section=section, stable_id="doc::paragraph:0:5", position=0
+    )
+    sentences = [
+        Sentence(
+            document=doc,
+            section=section,
+            paragraph=paragraph,
+            stable_id="doc::sentence:0:3",
+            position=0,
+            text='"a"\\',
+            words=['"a"', "\\"],
+            char_offsets=[0, 3],
+        ),
+        Sentence(
+            document=doc,
+            section=section,
+            paragraph=paragraph,
+            stable_id="doc::sentence:4:5",
+            position=1,
+            text="b",
+            words=["b"],
+            char_offsets=[4],
+        ),
+    ]
+
+    session = MagicMock()
+    session.execute.return_value = [(id,) for id in range(100, 110)]
+    writer = BulkContextWriter(session, id_block_size=10)
+    counts = writer.write(sentences)
+
+    assert counts == {
+        "context": 5,
+        "document": 1,
+        "section": 1,
+        "paragraph": 1,
+        "sentence": 2,
+    }
+    # Ids are taken from the block, the rest are kept for the next document
+    assert sorted(s.id for s in sentences + [doc, section, paragraph]) == list(
+        range(100, 105)
+    )
+    assert writer._ids == list(range(105, 110))
+
+    cursor = session.connection().connection.cursor()
+    copies = {
+        sql.split()[1].strip('"'): data.getvalue()
+        for (sql, data), _ in cursor.copy_expert.call_args_list
+    }
+    # Tables are written after the tables they refer to
+    tables = list(copies)
+    assert tables.index("context") < tables.index("document")
+    assert tables.index("paragraph") < tables.index("sentence")
+
+    # The pickled meta is written as bytea in hex
+    assert copies["document"].startswith("{}\tdoc\ta\\tb\t\\\\x".format(doc.id))
+    sentence_sql = next(
+        sql for (sql, _), _ in cursor.copy_expert.call_args_list if '"sentence"' in sql
+    )
+    columns = sentence_sql.split("(")[1].split(")")[0].replace('"', "").split(", ")
+    row = dict(zip(columns, copies["sentence"].splitlines()[0].split("\t")))
+    assert row["id"] == str(sentences[0].id)
+    assert row["document_id"] == str(doc.id)
+    assert row["paragraph_id"] == str(paragraph.id)
+    assert row["text"] == '"a"\\\\'
+    assert row["words"] == '{"\\\\"a\\\\"","\\\\\\\\"}'
+    assert row["char_offsets"] == '{"0","3"}'
+    assert row["cell_id"] == "\\N"
+
+
+def test_bulk_copy_round_trip(caplog):
+    """Test that parsing with COPY stores the same rows as the ORM."""
+    caplog.set_level(logging.INFO)
+
+    session = Meta.init("postgres://localhost:5432/" + DB).Session()
+    docs_path = "tests/data/html_simple/md.html"
+
+    def parse(bulk_copy):
+        parser = Parser(
+            session, structural=True, tabular=True, lingual=False, bulk_copy=bulk_copy
+        )
+        parser.apply(HTMLDocPreprocessor(docs_path), parallelism=1)
+        contexts = sorted(
+            (context.type, context.stable_id) for context in session.query(Context)
+        )
+        sentences = sorted(
+            (
+                s.stable_id,
+                s.position,
+                s.text,
+                s.words,
+                s.char_offsets,
+                s.xpath,
+                s.html_tag,
+                s.html_attrs,
+                s.document.name,
+                s.section.stable_id,
+                s.paragraph.stable_id,
+                s.table.stable_id if s.table else None,
+                s.cell.stable_id if s.cell else None,
+                (s.row_start, s.row_end, s.col_start, s.col_end),
+            )
+            for s in session.query(Sentence)
+        )
+        return contexts, sentences
+
+    contexts, sentences = parse(bulk_copy=False)
+    assert len(sentences) > 0
+    assert parse(bulk_copy=True) == (contexts, sentences)
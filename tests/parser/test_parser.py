@@ -1,12 +1,21 @@
 #! /usr/bin/env python
 import logging
 import os
-from unittest.mock import patch
+import threading
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
 
+import numpy
 import pytest
+from spacy.attrs import DEP, HEAD
+from spacy.tokens import Doc
+from spacy.vocab import Vocab
 
-from fonduer.parser.parser import ParserUDF
+from fonduer.parser import spacy_parser
+from fonduer.parser.parser import Parser, ParserUDF, _read_html_events
+from fonduer.parser.pdf_extractors import PDFExtractor, PDFPage, PDFWord
 from fonduer.parser.preprocessors import HTMLDocPreprocessor
+from fonduer.parser.spacy_parser import Spacy
 
 
 def get_parser_udf(
@@ -20,6 +29,12 @@ def get_parser_udf(
     tabular=True,  # tabular information
     visual=False,  # visual information
     pdf_path=None,
+    nlp_batch_size=None,
+    batch_split_sentences=False,
+    streaming=False,
+    tokenizer="spacy",
+    pdf_extractor="poppler",
+    prefetch_pdf=False,
 ):
     """Return an instance of ParserUDF."""
 
@@ -38,6 +53,12 @@ def get_parser_udf(
             visual=visual,
             pdf_path=pdf_path,
             language=language,
+            nlp_batch_size=nlp_batch_size,
+            batch_split_sentences=batch_split_sentences,
+            streaming=streaming,
+            tokenizer=tokenizer,
+            pdf_extractor=pdf_extractor,
+            prefetch_pdf=prefetch_pdf,
         )
     return parser_udf
 
@@ -349,6 +370,292 @@ def test_parse_md_paragraphs(caplog):
     assert len(doc.paragraphs[2].sentences) == 1
 
 
+def test_batched_nlp(caplog):
+    """Unit test of parsing with the spaCy pipeline run in batches."""
+    caplog.set_level(logging.INFO)
+
+    docs_path = "tests/data/html_simple/md_para.html"
+
+    # Preprocessor for the Docs
+    preprocessor = HTMLDocPreprocessor(docs_path)
+    doc = next(preprocessor.parse_file(docs_path, "md_para"))
+
+    # Create an Parser and parse the md document
+    parser_udf = get_parser_udf(
+        structural=True, tabular=True, lingual=True, nlp_batch_size=8
+    )
+    for _ in parser_udf.apply(doc):
+        pass
+
+    # The sentences are the same as without batching
+    assert len(doc.sentences) == 51
+    sentences = sorted(doc.sentences, key=lambda x: x.position)
+    assert sentences[1].text == "This is some basic, sample markdown."
+
+    # Every sentence is enriched with NLP features
+    for sentence in sentences:
+        assert len(sentence.pos_tags) == len(sentence.words)
+        assert len(sentence.dep_parents) == len(sentence.words)
+        assert all(pos_tag for pos_tag in sentence.pos_tags)
+        # Each sentence has exactly one root
+        assert sentence.dep_parents.count(0) == 1
+
+    # The batched pipe gives the same features as parsing each sentence alone
+    lingual_parser = parser_udf.lingual_parser
+    for sentence in sentences:
+        doc = lingual_parser._sentence_doc(sentence)
+        for _, proc in lingual_parser.model.pipeline:
+            doc = proc(doc)
+        expected = SimpleNamespace()
+        Spacy._set_nlp_attributes(expected, doc[:])
+        assert sentence.dep_parents == expected.dep_parents
+        assert sentence.dep_labels == expected.dep_labels
+        assert sentence.pos_tags == expected.pos_tags
+
+
+def test_dep_parents(caplog):
+    """Unit test of the dependency heads copied from a spaCy parse."""
+    caplog.set_level(logging.INFO)
+
+    words = ["Fonduer", "parses", "documents", ".", "It", "works", "."]
+    doc = Doc(Vocab(), words=words)
+    # The heads are relative to each token, and each sentence has one root
+    heads = [1, 0, -1, -2, 1, 0, -1]
+    deps = ["nsubj", "ROOT", "dobj", "punct", "nsubj", "ROOT", "punct"]
+    doc.from_array(
+        [HEAD, DEP],
+        numpy.array(
+            [[head, doc.vocab.strings.add(dep)] for head, dep in zip(heads, deps)],
+            dtype="int64",
+        ).astype("uint64"),
+    )
+
+    # The heads are 1-based within the sentence. The root keeps its own index,
+    # as spaCy returns a new Token for token.head
+    sentence = SimpleNamespace()
+    Spacy._set_nlp_attributes(sentence, doc[0:4])
+    assert sentence.dep_parents == [2, 2, 2, 2]
+    assert sentence.dep_labels == deps[:4]
+    Spacy._set_nlp_attributes(sentence, doc[4:7])
+    assert sentence.dep_parents == [2, 2, 2]
+    assert sentence.dep_labels == deps[4:]
+
+
+def test_batch_split_sentences(caplog):
+    """Unit test of splitting the sentences of all paragraphs in one batch."""
+    caplog.set_level(logging.INFO)
+
+    docs_path = "tests/data/html_simple/md_para.html"
+    preprocessor = HTMLDocPreprocessor(docs_path)
+
+    def parse(lingual, batch_split_sentences):
+        doc = next(preprocessor.parse_file(docs_path, "md_para"))
+        parser_udf = get_parser_udf(
+            structural=True,
+            tabular=True,
+            lingual=lingual,
+            batch_split_sentences=batch_split_sentences,
+        )
+        for _ in parser_udf.apply(doc):
+            pass
+        return [
+            (s.position, s.stable_id, s.text, s.xpath, s.words, s.char_offsets)
+            for s in sorted(doc.sentences, key=lambda x: x.position)
+        ]
+
+    # The sentences are the same as when splitting paragraph by paragraph
+    for lingual in [True, False]:
+        sentences = parse(lingual, batch_split_sentences=True)
+        assert sentences == parse(lingual, batch_split_sentences=False)
+
+
+def test_streaming(caplog, tmpdir):
+    """Unit test of parsing documents while their HTML is read."""
+    caplog.set_level(logging.INFO)
+
+    def parse(docs_path, streaming, batch_split_sentences=False):
+        preprocessor = HTMLDocPreprocessor(docs_path)
+        doc = next(preprocessor.parse_file(docs_path, "doc"))
+        parser_udf = get_parser_udf(
+            structural=True,
+            tabular=True,
+            lingual=False,
+            streaming=streaming,
+            batch_split_sentences=batch_split_sentences,
+        )
+        # The Sentences of the tail of a block are yielded after its subtree
+        return sorted(
+            (
+                s.position,
+                s.stable_id,
+                s.text,
+                s.xpath,
+                s.html_attrs,
+                s.paragraph.stable_id,
+                s.cell.stable_id if s.cell else None,
+            )
+            # The XPaths are complete once every Sentence is parsed
+            for s in list(parser_udf.apply(doc))
+        )
+
+    # Blocks with text in their tail, which is read after their subtree
+    tails_path = str(tmpdir.join("tails.html"))
+    with open(tails_path, "w") as f:
+        f.write(
+            "<html><body>Body text.<div><p>First para. Second sentence.</p>"
+            "<p>Second para.</p></div>  Tail of a div. Second sentence.  "
+            "<section><div><p>Nested one.</p><p>Nested two.</p></div>Inner tail."
+            "<p>After the inner tail.</p></section>Section tail.<div><ul>"
+            "<li>Item one</li><li>Item two</li></ul>List tail.</div></body>"
+            "Body tail.</html>"
+        )
+
+    for docs_path in [
+        tails_path,
+        "tests/data/html_simple/md_para.html",
+        "tests/data/html_extended/ext_diseases.html",
+        "tests/data/pure_html/brot.html",
+        "tests/data/pure_html/japan.html",
+        "tests/data/pure_html/lincoln_short.html",
+    ]:
+        sentences = parse(docs_path, streaming=False)
+        assert parse(docs_path, streaming=True) == sentences
+
+        # Free the elements every few elements, including inside paragraphs
+        # whose inline elements have text in their tail
+        for block_size in [5, 2, 1]:
+            with patch("fonduer.parser.parser.STREAM_BLOCK_SIZE", block_size):
+                assert parse(docs_path, streaming=True) == sentences
+
+    with patch("fonduer.parser.parser.STREAM_BLOCK_SIZE", 1):
+        assert parse(tails_path, True, batch_split_sentences=True) == parse(
+            tails_path, False, batch_split_sentences=True
+        )
+
+    # Sentences are yielded while the document is read, once the elements
+    # before them are freed
+    events = []
+
+    def read_html_events(text):
+        for event in _read_html_events(text):
+            events.append(event)
+            yield event
+
+    preprocessor = HTMLDocPreprocessor(docs_path)
+    doc = next(preprocessor.parse_file(docs_path, "doc"))
+    parser_udf = get_parser_udf(
+        structural=True, tabular=True, lingual=False, streaming=True
+    )
+    with patch("fonduer.parser.parser._read_html_events", read_html_events), patch(
+        "fonduer.parser.parser.STREAM_BLOCK_SIZE", 5
+    ):
+        sentences = parser_udf.apply(doc)
+        next(sentences)
+        n_events = len(events)
+        list(sentences)
+    assert n_events < len(events)
+
+
+def test_incremental_changed_documents(caplog):
+    """Unit test of selecting the documents to parse incrementally."""
+    caplog.set_level(logging.INFO)
+
+    docs_path = "tests/data/html_simple/"
+    preprocessor = HTMLDocPreprocessor(docs_path)
+    docs = list(preprocessor)
+
+    session = MagicMock()
+    stored = session.query.return_value.outerjoin.return_value
+    parser = Parser(session)
+    # Nothing is stored yet, every document is parsed
+    stored.__iter__.return_value = []
+    assert list(parser._changed_documents(docs)) == docs
+    hashes = {doc.name: doc.content_hash for doc in docs}
+
+    # Only the new and the changed documents are parsed again, in order, and
+    # the changed ones are deleted by id
+    changed, new = docs[0].name, docs[1].name
+    stored.__iter__.return_value = [
+        (name, doc_id, "stale" if name == changed else content_hash)
+        for doc_id, (name, content_hash) in enumerate(hashes.items())
+        if name != new
+    ]
+    with patch.object(parser, "_delete_documents") as delete_documents:
+        parsed = list(parser._changed_documents(list(preprocessor)))
+    assert [doc.name for doc in parsed] == [changed, new]
+    delete_documents.assert_called_once_with([0])
+
+    # The documents are deleted before the workers read the doc_loader, which
+    # reads the documents of a DocPreprocessor again
+    session.commit.reset_mock()
+    with patch.object(parser, "_delete_documents") as delete_documents:
+        parsed = parser._changed_documents(preprocessor)
+        delete_documents.assert_called_once_with([0])
+        session.commit.assert_called_once_with()
+        parsed = list(parsed)
+    assert [doc.name for doc in parsed] == [changed, new]
+    assert [doc.content_hash for doc in parsed] == [hashes[changed], hashes[new]]
+    delete_documents.assert_called_once_with([0])
+
+    # The changed documents are deleted in batches
+    stored.__iter__.return_value = [
+        (name, doc_id, "stale") for doc_id, name in enumerate(hashes)
+    ]
+    with patch.object(parser, "_delete_documents") as delete_documents, patch(
+        "fonduer.parser.parser.DELETE_BATCH_SIZE", 2
+    ):
+        parsed = list(parser._changed_documents(list(preprocessor)))
+    assert [doc.name for doc in parsed] == [doc.name for doc in docs]
+    assert [call[0][0] for call in delete_documents.call_args_list] == [
+        list(range(i, min(i + 2, len(docs)))) for i in range(0, len(docs), 2)
+    ]
+
+    # Another configuration changes the hash of every document
+    for other in [Parser(session, lingual=False), Parser(session, streaming=True)]:
+        with patch.object(other, "_delete_documents"):
+            parsed = list(other._changed_documents(list(preprocessor)))
+        assert len(parsed) == len(docs)
+
+    # But not the settings which only change how fast documents are parsed
+    stored.__iter__.return_value = [
+        (name, doc_id, content_hash)
+        for doc_id, (name, content_hash) in enumerate(hashes.items())
+    ]
+    parser = Parser(session, batch_split_sentences=True, prefetch_pdf=True)
+    with patch.object(parser, "_delete_documents"):
+        assert list(parser._changed_documents(list(preprocessor))) == []
+    # Nor the configuration under which the finished documents are recorded
+    config_hash = Parser(session)._stage_config_hash()
+    assert parser._stage_config_hash() == config_hash
+    assert Parser(session, lingual=False)._stage_config_hash() != config_hash
+
+    # When resuming, the stored documents which are not finished are deleted
+    session.query.return_value = [(docs[0].name, 7), (docs[1].name, 8)]
+    with patch.object(parser, "_delete_documents") as delete_documents:
+        parsed = parser._clean_unfinished(docs, {docs[1].name})
+    assert parsed == [doc for doc in docs if doc is not docs[1]]
+    delete_documents.assert_called_once_with([7])
+    with patch.object(parser, "_delete_documents") as delete_documents:
+        assert parser._clean_unfinished(preprocessor, {docs[1].name}) is preprocessor
+    delete_documents.assert_called_once_with([7])
+
+
+def test_preload_model(caplog, monkeypatch):
+    """Unit test of sharing a preloaded spaCy model between ParserUDFs."""
+    caplog.set_level(logging.INFO)
+
+    # Forget the spaCy models preloaded by this test
+    monkeypatch.setattr(spacy_parser, "_preloaded_models", {})
+    Spacy.preload("en")
+    Spacy.preload("en")
+    assert list(spacy_parser._preloaded_models) == ["en"]
+
+    parser_udf = get_parser_udf(language="en")
+    other_parser_udf = get_parser_udf(language="en")
+    assert parser_udf.lingual_parser.model is other_parser_udf.lingual_parser.model
+    assert parser_udf.lingual_parser.model is spacy_parser._preloaded_models["en"][0]
+
+
 def test_simple_tokenizer(caplog):
     """Unit test of Parser on a single document with lingual features off."""
     caplog.set_level(logging.INFO)
@@ -391,6 +698,151 @@ def test_simple_tokenizer(caplog):
     assert len(doc.sentences) == 44
 
 
+def test_rule_tokenizer(caplog):
+    """Unit test of Parser with the rule-based tokenizer and lingual off."""
+    caplog.set_level(logging.INFO)
+
+    docs_path = "tests/data/html_simple/md.html"
+
+    # Preprocessor for the Docs
+    preprocessor = HTMLDocPreprocessor(docs_path)
+    doc = next(preprocessor.parse_file(docs_path, "md"))
+
+    # Create an Parser and parse the md document
+    parser_udf = get_parser_udf(structural=True, lingual=False, tokenizer="rule")
+    for _ in parser_udf.apply(doc):
+        pass
+
+    # No spaCy model is loaded
+    assert parser_udf.lingual_parser.model is None
+
+    sentences = sorted(doc.sentences, key=lambda x: x.position)
+    header = sentences[0]
+    assert header.text == "Sample Markdown"
+    assert header.xpath == "/html/body/h1"
+    assert header.words == ["Sample", "Markdown"]
+    assert header.char_offsets == [0, 7]
+    assert header.abs_char_offsets == [0, 7]
+    assert header.lemmas == ["", ""]
+    assert header.dep_parents == [0, 0]
+
+    sentence = sentences[1]
+    assert sentence.text == "This is some basic, sample markdown."
+    assert sentence.words == [
+        "This",
+        "is",
+        "some",
+        "basic",
+        ",",
+        "sample",
+        "markdown",
+        ".",
+    ]
+
+
+class HeaderExtractor(PDFExtractor):
+    """Extract the header of the md document, recording the thread used."""
+
+    name = "header"
+
+    def __init__(self):
+        self.threads = []
+
+    def pages(self, pdf_file):
+        self.threads.append(threading.current_thread())
+        yield PDFPage(
+            612,
+            792,
+            [
+                PDFWord("Sample", 35.0, 111.0, 35.0, 61.0, 35.0, 35.0),
+                PDFWord("Markdown", 117.0, 231.0, 35.0, 61.0, 35.0, 35.0),
+            ],
+        )
+
+
+def test_prefetch_pdf(caplog):
+    """Test extracting the words of the PDF while the document is parsed."""
+    caplog.set_level(logging.INFO)
+
+    docs_path = "tests/data/html_simple/md.html"
+    pdf_path = "tests/data/pdf_simple/md.pdf"
+    preprocessor = HTMLDocPreprocessor(docs_path)
+    doc = next(preprocessor.parse_file(docs_path, "md"))
+
+    extractor = HeaderExtractor()
+    parser_udf = get_parser_udf(
+        structural=True,
+        lingual=False,
+        visual=True,
+        pdf_path=pdf_path,
+        language=None,
+        pdf_extractor=extractor,
+        prefetch_pdf=True,
+    )
+    for _ in parser_udf.apply(doc):
+        pass
+
+    assert len(extractor.threads) == 1
+    assert extractor.threads[0] is not threading.main_thread()
+    assert parser_udf._pdf_words == {}
+
+    header = sorted(doc.sentences, key=lambda x: x.position)[0]
+    assert header.page == [1, 1]
+    assert header.top == [35, 35]
+    assert header.left == [35, 117]
+    assert header.right == [111, 231]
+
+
+def test_lxml_preprocessor(caplog):
+    """Unit test of preprocessing HTML files with lxml rather than BeautifulSoup."""
+    caplog.set_level(logging.INFO)
+
+    docs_path = "tests/data/html_simple/diseases.html"
+
+    def parse(use_lxml):
+        preprocessor = HTMLDocPreprocessor(docs_path, use_lxml=use_lxml)
+        doc = next(preprocessor.parse_file(docs_path, "diseases"))
+        assert doc.name == "diseases"
+        assert doc.meta == {"file_name": "diseases"}
+
+        parser_udf = get_parser_udf(
+            structural=True, tabular=True, lingual=False, language=None
+        )
+        return [
+            (s.position, s.stable_id, s.text, s.xpath, sorted(s.html_attrs))
+            for s in parser_udf.apply(doc)
+        ]
+
+    # The same Sentences are parsed, with the attributes in the file's order
+    assert parse(use_lxml=True) == parse(use_lxml=False)
+
+
+def test_lxml_preprocessor_html_elements(caplog, tmpdir):
+    """Test that only files with several html elements are rejected."""
+    caplog.set_level(logging.INFO)
+
+    def preprocess(content, use_lxml):
+        fp = str(tmpdir.join("doc.html"))
+        with open(fp, "w") as f:
+            f.write(content)
+        preprocessor = HTMLDocPreprocessor(fp, use_lxml=use_lxml)
+        return list(preprocessor.parse_file(fp, "doc"))
+
+    # "<html" in a comment, a script or CDATA is not an html element
+    content = (
+        "<html><body><!-- <html> --><p>a</p>"
+        "<script>var s = '<html>';</script><![CDATA[<html>]]></body></html>"
+    )
+    for use_lxml in [True, False]:
+        assert len(preprocess(content, use_lxml)) == 1
+        with pytest.raises(NotImplementedError):
+            preprocess("<html><p>a</p></html><html><p>b</p></html>", use_lxml)
+        # Files without any element have no html element either
+        for empty_content in ["", " \n "]:
+            with pytest.raises(NotImplementedError):
+                preprocess(empty_content, use_lxml)
+
+
 def test_parse_document_diseases(caplog):
     """Unit test of Parser on a single document.
 
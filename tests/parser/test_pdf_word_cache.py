@@ -0,0 +1,54 @@
+#! /usr/bin/env python
+import logging
+import os
+import shutil
+
+from fonduer.parser.pdf_word_cache import PDFWordCache
+
+PDF_FILE = "tests/data/pdf_simple/md.pdf"
+
+
+def test_pdf_word_cache(caplog, tmpdir):
+    """Test storing and loading the words of a PDF."""
+    caplog.set_level(logging.INFO)
+
+    cache = PDFWordCache(str(tmpdir.join("cache")))
+    key = cache.key(PDF_FILE)
+    assert cache.get(key) is None
+
+    pdf_word_list = [((1, 1), "µm"), ((1, 0), "BC546"), ((2, 0), "")]
+    coordinate_map = {
+        (1, 0): (1, 100, 72, 112, 110),
+        (1, 1): (1, 300, 72, 312, 100),
+        (2, 0): (2, 60, 50, 70, 90),
+    }
+    pdf_dims = {1: (612, 792), 2: (842, 595)}
+    cache.put(key, pdf_word_list, coordinate_map, pdf_dims)
+    assert cache.get(key) == (pdf_word_list, coordinate_map, pdf_dims)
+
+    # A copy of the PDF has the same key, but not other settings
+    copy = str(tmpdir.join("copy.pdf"))
+    shutil.copy(PDF_FILE, copy)
+    assert PDFWordCache(cache.cache_dir).key(copy) == key
+    assert cache.key(PDF_FILE, config="other") != key
+
+
+def test_pdf_word_cache_eviction(caplog, tmpdir):
+    """Test that the least recently used files are evicted."""
+    caplog.set_level(logging.INFO)
+
+    cache = PDFWordCache(str(tmpdir))
+    pdf_word_list = [((1, 0), "a" * 1000)]
+    coordinate_map = {(1, 0): (1, 0, 0, 1, 1)}
+    for key in ["a", "b", "c"]:
+        cache.put(key, pdf_word_list, coordinate_map, {1: (1, 1)})
+    size = os.path.getsize(cache._path("a"))
+    os.utime(cache._path("a"), (0, 0))
+    os.utime(cache._path("b"), (1, 1))
+    os.utime(cache._path("c"), (2, 2))
+
+    # Reading a file marks it as recently used
+    assert cache.get("a") is not None
+    cache.max_size = 2 * size
+    cache.put("d", pdf_word_list, coordinate_map, {1: (1, 1)})
+    assert sorted(os.listdir(str(tmpdir))) == ["a.npz", "d.npz"]
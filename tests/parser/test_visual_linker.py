@@ -0,0 +1,207 @@
+#! /usr/bin/env python
+import io
+import logging
+import subprocess
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from fonduer.parser.pdf_extractors import PDFExtractor, PDFPage, PDFWord
+from fonduer.parser.visual_linker import VisualLinker, _edit_distances
+
+# The output of pdftotext -bbox-layout for a PDF of two pages
+BBOX_LAYOUT = b"""<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
+"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+<title></title>
+</head>
+<body>
+<doc>
+  <page width="612.000000" height="792.000000">
+    <flow>
+      <block xMin="72.0" yMin="300.0" xMax="200.0" yMax="312.0">
+        <line xMin="72.0" yMin="300.0" xMax="200.0" yMax="312.0">
+          <word xMin="72.0" yMin="300.0" xMax="100.0" yMax="312.0">Second</word>
+          <word xMin="104.0" yMin="300.0" xMax="130.0" yMax="312.0">block</word>
+        </line>
+      </block>
+      <block xMin="72.0" yMin="100.0" xMax="200.0" yMax="112.0">
+        <line xMin="72.0" yMin="100.0" xMax="200.0" yMax="112.0">
+          <word xMin="72.0" yMin="100.0" xMax="110.5" yMax="112.0">BC546:</word>
+          <word xMin="114.0" yMin="100.0" xMax="140.0" yMax="112.0">&amp;</word>
+        </line>
+      </block>
+    </flow>
+  </page>
+  <page width="842.000000" height="595.000000">
+    <flow>
+      <block xMin="50.0" yMin="60.0" xMax="90.0" yMax="70.0">
+        <line xMin="50.0" yMin="60.0" xMax="90.0" yMax="70.0">
+          <word xMin="50.0" yMin="60.0" xMax="90.0" yMax="70.0">(max)</word>
+        </line>
+      </block>
+    </flow>
+  </page>
+</doc>
+</body>
+</html>
+"""
+
+
+def test_extract_pdf_words(caplog):
+    """Test extracting the word boxes of every page with one pdftotext call."""
+    caplog.set_level(logging.INFO)
+
+    with patch("fonduer.parser.pdf_extractors.shutil.which"), patch(
+        "fonduer.parser.pdf_extractors.subprocess", autospec=True
+    ) as mock_subprocess:
+        mock_subprocess.check_output.return_value = "pdfinfo version 0.62.0"
+        process = mock_subprocess.Popen.return_value.__enter__.return_value
+        process.stdout = io.BytesIO(BBOX_LAYOUT)
+        process.wait.return_value = 0
+
+        vizlink = VisualLinker()
+        vizlink.pdf_file = "doc.pdf"
+        vizlink.extract_pdf_words()
+
+    mock_subprocess.Popen.assert_called_once_with(
+        ["pdftotext", "-bbox-layout", "doc.pdf", "-"], stdout=mock_subprocess.PIPE
+    )
+    # Words are sorted by block, and split on the separators
+    assert vizlink.pdf_word_list == [
+        ((1, 2), "BC546"),
+        ((1, 3), ":"),
+        ((1, 4), "&"),
+        ((1, 0), "Second"),
+        ((1, 1), "block"),
+        ((2, 0), "("),
+        ((2, 1), "max"),
+        ((2, 2), ")"),
+    ]
+    assert vizlink.coordinate_map[(1, 2)] == (1, 100, 72, 112, 110)
+    assert vizlink.coordinate_map[(2, 1)] == (2, 60, 50, 70, 90)
+    assert vizlink.pdf_dims == {1: (612, 792), 2: (842, 595)}
+    assert vizlink.pdf_dim == (842, 595)
+
+
+def test_extract_pdf_words_failure(caplog):
+    """Test that a failing pdftotext call raises an error."""
+    caplog.set_level(logging.INFO)
+
+    with patch("fonduer.parser.pdf_extractors.shutil.which"), patch(
+        "fonduer.parser.pdf_extractors.subprocess.check_output",
+        return_value="pdfinfo version 0.62.0",
+    ), patch("fonduer.parser.pdf_extractors.subprocess.Popen") as popen:
+        process = popen.return_value.__enter__.return_value
+        process.stdout = io.BytesIO(b"")
+        process.wait.return_value = 1
+        process.returncode = 1
+
+        vizlink = VisualLinker()
+        vizlink.pdf_file = "missing.pdf"
+        with pytest.raises(subprocess.CalledProcessError):
+            vizlink.extract_pdf_words()
+
+
+def test_extract_pdf_words_cached(caplog, tmpdir):
+    """Test that the words of a cached PDF are not extracted again."""
+    caplog.set_level(logging.INFO)
+
+    with patch("fonduer.parser.pdf_extractors.shutil.which"), patch(
+        "fonduer.parser.pdf_extractors.subprocess", autospec=True
+    ) as mock_subprocess:
+        mock_subprocess.check_output.return_value = "pdfinfo version 0.62.0"
+        process = mock_subprocess.Popen.return_value.__enter__.return_value
+        process.stdout = io.BytesIO(BBOX_LAYOUT)
+        process.wait.return_value = 0
+
+        vizlink = VisualLinker(cache_dir=str(tmpdir))
+        vizlink.pdf_file = "tests/data/pdf_simple/md.pdf"
+        vizlink.extract_pdf_words()
+        extracted = (vizlink.pdf_word_list, vizlink.coordinate_map, vizlink.pdf_dims)
+
+        vizlink = VisualLinker(cache_dir=str(tmpdir))
+        vizlink.pdf_file = "tests/data/pdf_simple/md.pdf"
+        vizlink.extract_pdf_words()
+
+    assert mock_subprocess.Popen.call_count == 1
+    assert (vizlink.pdf_word_list, vizlink.coordinate_map, vizlink.pdf_dims) == (
+        extracted
+    )
+    assert vizlink.pdf_dim == (842, 595)
+
+
+def test_link_lists_by_anchors(caplog):
+    """Test aligning the words of the HTML to the words of the PDF."""
+    caplog.set_level(logging.INFO)
+
+    with patch("fonduer.parser.pdf_extractors.shutil.which"), patch(
+        "fonduer.parser.pdf_extractors.subprocess.check_output",
+        return_value="pdfinfo version 0.62.0",
+    ):
+        with pytest.raises(ValueError):
+            VisualLinker(link_method="unknown")
+        vizlink = VisualLinker(link_method="anchors")
+
+    html_words = "The BC546 max current is 100 mA at 25 C and the max voltage is 65 V"
+    pdf_words = "The BC546 max curent is 100 mA at at 25 C the max voltage is 65V"
+    vizlink.html_word_list = [(("s", i), w) for i, w in enumerate(html_words.split())]
+    vizlink.pdf_word_list = [((1, j), w) for j, w in enumerate(pdf_words.split())]
+    vizlink.link_lists_by_anchors(search_max=10)
+
+    links = [vizlink.links[("s", i)][1] for i in range(len(vizlink.html_word_list))]
+    # "current" is linked to "curent", "and", missing from the PDF, to the word
+    # before it, and "65" and "V" to "65V"
+    assert links == [0, 1, 2, 3, 4, 5, 6, 7, 9, 10, 10, 11, 12, 13, 14, 15, 15]
+    assert vizlink.link_stats["exact"] == 13
+    assert vizlink.link_stats["html_words"] == 17
+
+
+def test_edit_distances(caplog):
+    """Test the edit distances of a word to many words at once."""
+    caplog.set_level(logging.INFO)
+
+    others = np.array(["", "BC546", "BC547", "546", "µA", "BC546B"])
+    assert _edit_distances("BC546", others).tolist() == [5, 0, 1, 2, 5, 1]
+    assert _edit_distances("", others).tolist() == [0, 5, 5, 3, 2, 6]
+
+
+class FakeExtractor(PDFExtractor):
+    """An extractor of the words of a single, fixed PDF."""
+
+    name = "fake"
+
+    def pages(self, pdf_file):
+        yield PDFPage(
+            612.5,
+            792.0,
+            [
+                PDFWord("(max)", 50.0, 90.9, 60.0, 70.0, 50.0, 60.0),
+                PDFWord("BC546", 72.0, 110.5, 10.0, 22.0, 72.0, 10.0),
+            ],
+        )
+
+
+def test_extractor_backends(caplog):
+    """Test extracting the words of PDFs with another extractor."""
+    caplog.set_level(logging.INFO)
+
+    with pytest.raises(ValueError):
+        VisualLinker(extractor="unknown")
+
+    vizlink = VisualLinker(extractor=FakeExtractor())
+    vizlink.pdf_file = "doc.pdf"
+    vizlink.extract_pdf_words()
+
+    # Words are split on the separators, and sorted by block
+    assert vizlink.pdf_word_list == [
+        ((1, 3), "BC546"),
+        ((1, 0), "("),
+        ((1, 1), "max"),
+        ((1, 2), ")"),
+    ]
+    assert vizlink.coordinate_map[(1, 3)] == (1, 10, 72, 22, 110)
+    assert vizlink.pdf_dims == {1: (612, 792)}
@@ -0,0 +1,68 @@
+#! /usr/bin/env python
+import json
+import logging
+import os
+
+from fonduer.utils.profiler import (
+    Profile,
+    profile_iter,
+    profile_phase,
+    start_record,
+    stop_record,
+)
+
+
+def test_profile_phases(caplog):
+    """Test that phases are only recorded while a record is active."""
+    caplog.set_level(logging.INFO)
+
+    with profile_phase("apply"):
+        pass
+    items = [1, 2, 3]
+    assert profile_iter("nlp", items) is items
+
+    record = start_record("Parser", "doc")
+    with profile_phase("apply"):
+        assert list(profile_iter("nlp", items)) == items
+    with profile_phase("apply"):
+        pass
+    stop_record()
+
+    assert set(record["phases"]) == {"apply", "nlp"}
+    assert record["phases"]["apply"] >= record["phases"]["nlp"] >= 0
+
+
+def test_profile_summary(caplog, tmpdir):
+    """Test the aggregation and export of profile records."""
+    caplog.set_level(logging.INFO)
+
+    profile = Profile("Parser")
+    profile.add_records(
+        [
+            {"stage": "Parser", "document": str(i), "rows": 10, "phases": {"apply": i}}
+            for i in range(1, 101)
+        ]
+    )
+    profile.add_records(
+        [{"stage": "Parser", "document": None, "rows": 0, "phases": {"commit": 2.0}}]
+    )
+    profile.wall_time = 10.0
+
+    summary = profile.summary()
+    assert summary["documents"] == 100
+    assert summary["rows"] == 1000
+    assert summary["docs_per_sec"] == 10.0
+    assert summary["rows_per_sec"] == 100.0
+    assert summary["phases"]["apply"]["total"] == 5050
+    assert summary["phases"]["apply"]["p50"] == 50.5
+    assert summary["phases"]["apply"]["max"] == 100
+    assert summary["phases"]["commit"]["total"] == 2.0
+
+    path = os.path.join(str(tmpdir), "profile.json")
+    profile.to_json(path)
+    with open(path) as f:
+        assert json.load(f)["summary"]["documents"] == 100
+
+    df = profile.to_dataframe()
+    assert len(df) == 101
+    assert df["apply"].sum() == 5050
@@ -0,0 +1,551 @@
+#! /usr/bin/env python
+import logging
+import os
+import pickle
+import time
+from datetime import datetime, timedelta, timezone
+from queue import Queue
+from unittest.mock import MagicMock, patch
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+import fonduer.utils.udf as udf_module
+from fonduer import Meta
+from fonduer.utils.models import UDFTask
+from fonduer.utils.udf import (
+    AUTO_CHUNK_CHARS,
+    UDF,
+    CommitPolicy,
+    RecyclePolicy,
+    UDFRunner,
+    WorkerPool,
+    _chunk_docs,
+    _config_hash,
+    _skip_finished,
+)
+from fonduer.utils.utils_udf import (
+    ALL_SPLITS,
+    add_keys,
+    batch_upsert_records,
+    get_doc_candidate_counts,
+)
+
+
+DB = "udf_test"
+
+
+class FakeDoc(object):
+    def __init__(self, text):
+        self.text = text
+
+
+def test_chunk_docs_fixed_size(caplog):
+    """Test that documents are grouped into chunks of the given size."""
+    caplog.set_level(logging.INFO)
+
+    chunks = list(_chunk_docs(range(10), 4, 100))
+    assert chunks == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+    chunks = list(_chunk_docs(range(3), 1, 100))
+    assert chunks == [[0], [1], [2]]
+
+    assert list(_chunk_docs([], 4, 100)) == []
+
+
+def test_chunk_docs_auto_size(caplog):
+    """Test that the automatic chunk size follows the document size."""
+    caplog.set_level(logging.INFO)
+
+    # Large documents are sent one at a time
+    docs = [FakeDoc("a" * AUTO_CHUNK_CHARS) for _ in range(3)]
+    assert [len(c) for c in _chunk_docs(docs, None, 100)] == [1, 1, 1]
+
+    # Small documents are batched, but never above the maximum chunk size
+    docs = [FakeDoc("a" * 10) for _ in range(25)]
+    assert [len(c) for c in _chunk_docs(docs, None, 10)] == [10, 10, 5]
+
+
+def test_config_hash(caplog):
+    """Test that the configuration hash is stable and tells configs apart."""
+    caplog.set_level(logging.INFO)
+
+    def lf(c):
+        return 1
+
+    config = {"split": 0, "lfs": [[lf]], "matcher": object()}
+    same_config = {"matcher": object(), "lfs": [[lf]], "split": 0}
+    assert _config_hash(config) == _config_hash(same_config)
+    assert _config_hash(config) != _config_hash(dict(config, split=1))
+
+    # A function with the same name but another body is another configuration
+    def edited_lf(c):
+        return 0
+
+    edited_lf.__qualname__ = lf.__qualname__
+    assert _config_hash(dict(config, lfs=[[edited_lf]])) != _config_hash(config)
+
+
+def test_skip_finished(caplog):
+    """Test that finished documents are skipped when resuming."""
+    caplog.set_level(logging.INFO)
+
+    docs = [FakeDoc("a") for _ in range(4)]
+    for i, doc in enumerate(docs):
+        doc.name = "doc{}".format(i)
+    finished = {"doc0", "doc2"}
+
+    assert _skip_finished(docs, finished) == [docs[1], docs[3]]
+    assert list(_skip_finished(iter(docs), finished)) == [docs[1], docs[3]]
+
+
+def test_schedule_largest_first(caplog):
+    """Test that documents can be ordered by decreasing estimated cost."""
+    caplog.set_level(logging.INFO)
+
+    docs = [FakeDoc("a" * n) for n in [3, 10, 1, 5]]
+    runner = UDFRunner(None, UDF)
+    ordered = runner._schedule(iter(docs), "largest_first")
+    assert [len(doc.text) for doc in ordered] == [10, 5, 3, 1]
+
+    ordered = runner._schedule(docs, lambda doc: -len(doc.text))
+    assert [len(doc.text) for doc in ordered] == [1, 3, 5, 10]
+
+    # A loader which is not a list is streamed, and sorted within windows
+    with patch.object(udf_module, "SCHEDULE_WINDOW", 2):
+        ordered = runner._schedule(iter(docs), "largest_first")
+        assert not isinstance(ordered, list)
+        assert [len(doc.text) for doc in ordered] == [10, 3, 5, 1]
+        assert runner._schedule(docs, "largest_first") == sorted(
+            docs, key=lambda doc: len(doc.text), reverse=True
+        )
+    with pytest.raises(ValueError):
+        runner._schedule(iter(docs), "smallest_first")
+
+
+def test_doc_candidate_counts(caplog):
+    """Test that only the candidates of the scheduled documents are counted."""
+    caplog.set_level(logging.INFO)
+
+    docs = [FakeDoc("a"), FakeDoc("b")]
+    docs[0].id, docs[1].id = 1, 2
+    candidate_class = MagicMock()
+    session = MagicMock()
+    query = session.query.return_value.filter.return_value
+    query.filter.return_value.group_by.return_value = [(2, 5)]
+    assert get_doc_candidate_counts(session, [candidate_class], docs, 0) == [0, 5]
+    candidate_class.document_id.in_.assert_called_once_with([1, 2])
+    query.filter.assert_called_once()
+
+    # The candidates of all splits are counted for ALL_SPLITS
+    query.filter.reset_mock()
+    query.group_by.return_value = [(1, 3), (2, 5)]
+    counts = get_doc_candidate_counts(session, [candidate_class], docs, ALL_SPLITS)
+    assert counts == [3, 5]
+    query.filter.assert_not_called()
+
+
+def test_load_task_docs(caplog):
+    """Test that the payloads of database tasks are loaded as documents."""
+    caplog.set_level(logging.INFO)
+
+    with patch("fonduer.utils.udf.new_sessionmaker", autospec=True):
+        udf = UDF()
+    docs = udf._load_task_docs([pickle.dumps(FakeDoc("a")), pickle.dumps(FakeDoc("b"))])
+    assert [doc.text for doc in docs] == ["a", "b"]
+
+    with patch.object(udf, "_load_docs", return_value=["doc"]) as load_docs:
+        assert udf._load_task_docs([pickle.dumps(3)]) == ["doc"]
+    load_docs.assert_called_once_with([3])
+
+
+def test_commit_ledger(caplog):
+    """Test that the ledger rows are committed with the outputs."""
+    caplog.set_level(logging.INFO)
+
+    with patch("fonduer.utils.udf.new_sessionmaker", autospec=True) as sessionmaker:
+        udf = UDF()
+    sessionmaker.assert_called_once_with(isolation_level="READ COMMITTED")
+    udf.stage, udf.config_hash = "UDFRunner", "hash"
+    udf._finished_docs = ["doc0", "doc1"]
+    udf._commit()
+    assert [call[0] for call in udf.session.method_calls] == [
+        "flush",
+        "execute",
+        "commit",
+        "expunge_all",
+    ]
+    assert udf._finished_docs == []
+
+    # Documents in the ledger are not processed again
+    docs = [FakeDoc("a") for _ in range(3)]
+    for i, doc in enumerate(docs):
+        doc.name = "doc{}".format(i)
+    udf.session.query.return_value.filter.return_value = [("doc1",)]
+    assert udf._unfinished_docs(docs) == [docs[0], docs[2]]
+
+
+def test_add_keys(caplog):
+    """Test that keys are committed on their own, apart from the outputs."""
+    caplog.set_level(logging.INFO)
+
+    from fonduer.features.models import Feature, FeatureKey
+
+    session = MagicMock()
+    add_keys(session, FeatureKey, {"b", "c", "a"})
+    bind = session.get_bind.return_value
+    bind.execution_options.assert_called_once_with(isolation_level="AUTOCOMMIT")
+    (stmt,), _ = bind.execution_options.return_value.execute.call_args
+    params = stmt.compile(dialect=postgresql.dialect()).params
+    assert list(params.values()) == ["a", "b", "c"]
+    session.execute.assert_not_called()
+
+    # The outputs are left to the UDF to commit
+    session = MagicMock()
+    batch_upsert_records(session, Feature, [{"candidate_id": 1, "keys": ["a"]}])
+    session.execute.assert_called_once()
+    session.commit.assert_not_called()
+
+
+def test_clear_ledger(caplog):
+    """Test that the ledger rows of the cleared documents are deleted first."""
+    caplog.set_level(logging.INFO)
+
+    runner = UDFRunner(MagicMock(), UDF)
+    calls = []
+
+    def clear_ledger(stage, **kwargs):
+        calls.append(("ledger", stage, kwargs))
+
+    runner._clear_ledger = clear_ledger
+    runner.clear = lambda **kwargs: calls.append(("clear", kwargs))
+    with patch.object(runner, "apply_st"):
+        runner.apply([], split=1, progress_bar=False)
+    assert calls == [("ledger", "UDFRunner", {"split": 1}), ("clear", {"split": 1})]
+
+
+def test_lookahead(caplog):
+    """Test that each document is prepared before the previous one is applied."""
+    caplog.set_level(logging.INFO)
+
+    with patch("fonduer.utils.udf.new_sessionmaker", autospec=True):
+        udf = UDF()
+    events = []
+    udf._prepare = lambda doc: events.append(("prepare", doc))
+    for doc in udf._lookahead(iter(range(3))):
+        events.append(("apply", doc))
+    assert events == [
+        ("prepare", 0),
+        ("prepare", 1),
+        ("apply", 0),
+        ("prepare", 2),
+        ("apply", 1),
+        ("apply", 2),
+    ]
+    assert list(udf._lookahead([])) == []
+
+
+class RecordingUDF(UDF):
+    """A UDF which records the process that applied it to each document."""
+
+    def __init__(self, out_dir, **kwargs):
+        self.out_dir = out_dir
+        super(RecordingUDF, self).__init__(**kwargs)
+
+    def apply(self, doc, tag, **kwargs):
+        if tag == "exit":
+            # Die without telling the runner, as if killed
+            os._exit(3)
+        with open(os.path.join(self.out_dir, str(os.getpid())), "a") as f:
+            f.write("{} {}\n".format(tag() if callable(tag) else tag, doc))
+        return []
+
+
+class SlowUDF(RecordingUDF):
+    """A RecordingUDF which takes longer for the documents named slow."""
+
+    def apply(self, doc, tag, **kwargs):
+        time.sleep(0.5 if doc.startswith("slow") else 0.05)
+        return super(SlowUDF, self).apply(doc, tag, **kwargs)
+
+
+class RecordingRunner(UDFRunner):
+    def __init__(self, session, out_dir, parallelism=2, udf_class=RecordingUDF):
+        super(RecordingRunner, self).__init__(
+            session, udf_class, parallelism=parallelism, out_dir=out_dir
+        )
+
+    def clear(self, **kwargs):
+        pass
+
+
+def _read_records(out_dir):
+    records = {}
+    for pid in os.listdir(out_dir):
+        with open(os.path.join(out_dir, pid)) as f:
+            records[pid] = [line.split() for line in f]
+    return records
+
+
+def test_fork_workers(caplog):
+    """Test that the objects of the runner are frozen while forking workers."""
+    caplog.set_level(logging.INFO)
+
+    events = []
+    udf = MagicMock()
+    udf.start.side_effect = lambda: events.append("start")
+    with patch("fonduer.utils.udf.new_sessionmaker", autospec=True):
+        runner = UDFRunner(MagicMock(), UDF)
+    with patch.object(udf_module, "gc") as gc:
+        gc.freeze.side_effect = lambda: events.append("freeze")
+        gc.unfreeze.side_effect = lambda: events.append("unfreeze")
+        runner._fork_workers([udf, udf])
+    assert events == ["freeze", "start", "start", "unfreeze"]
+
+
+def test_worker_pool(caplog, tmpdir):
+    """Test that a WorkerPool reuses the workers of a runner across applies."""
+    caplog.set_level(logging.INFO)
+
+    out_dir = str(tmpdir)
+    with patch("fonduer.utils.udf.new_sessionmaker", autospec=True), patch.object(
+        udf_module._meta, "postgres", True
+    ):
+        runner = RecordingRunner(MagicMock(), out_dir, parallelism=2)
+        with WorkerPool() as pool:
+            runner.apply(list(range(10)), tag="a", pool=pool, progress_bar=False)
+            pids = {udf.pid for udf in runner.udfs}
+            assert len(pids) == 2
+
+            runner.apply(list(range(5)), tag="b", pool=pool, progress_bar=False)
+            assert {udf.pid for udf in runner.udfs} == pids
+
+            # Arguments which can not be pickled make the runner restart workers
+            runner.apply([0], tag=lambda: "c", pool=pool, progress_bar=False)
+            assert not {udf.pid for udf in runner.udfs} & pids
+        assert runner.udfs == []
+
+    records = _read_records(out_dir)
+    assert {int(pid) for pid in records} >= pids
+    tags = sorted(tag for lines in records.values() for tag, _ in lines)
+    assert tags.count("a") == 10
+    assert tags.count("b") == 5
+    assert len(tags) == 16
+
+
+def test_dead_workers(caplog, tmpdir):
+    """Test that workers which die are restarted, or reported while applying."""
+    caplog.set_level(logging.INFO)
+
+    out_dir = str(tmpdir)
+    with patch("fonduer.utils.udf.new_sessionmaker", autospec=True), patch.object(
+        udf_module._meta, "postgres", True
+    ), patch.object(udf_module, "QUEUE_TIMEOUT", 0.1):
+        runner = RecordingRunner(MagicMock(), out_dir, parallelism=2)
+        with WorkerPool() as pool:
+            runner.apply(list(range(4)), tag="a", pool=pool, progress_bar=False)
+            pids = {udf.pid for udf in runner.udfs}
+
+            # A pooled worker which died is restarted with the others
+            runner.udfs[0].terminate()
+            runner.udfs[0].join()
+            runner.apply(list(range(4)), tag="b", pool=pool, progress_bar=False)
+            assert not {udf.pid for udf in runner.udfs} & pids
+            pids = {udf.pid for udf in runner.udfs}
+
+            # So are workers with another queue size
+            runner.apply(
+                list(range(4)), tag="c", pool=pool, queue_size=7, progress_bar=False
+            )
+            assert runner.queue_size == 7
+            assert not {udf.pid for udf in runner.udfs} & pids
+
+        with pytest.raises(RuntimeError, match="exited with code 3"):
+            runner.apply(list(range(4)), tag="exit", progress_bar=False)
+        assert runner.udfs == []
+
+    records = _read_records(out_dir)
+    tags = sorted(tag for lines in records.values() for tag, _ in lines)
+    assert tags == ["a"] * 4 + ["b"] * 4 + ["c"] * 4
+
+
+def test_streaming_apply(caplog, tmpdir):
+    """Test applying a UDF to a document loader without a length."""
+    caplog.set_level(logging.INFO)
+
+    out_dir = str(tmpdir)
+    with patch("fonduer.utils.udf.new_sessionmaker", autospec=True), patch.object(
+        udf_module._meta, "postgres", True
+    ):
+        runner = RecordingRunner(MagicMock(), out_dir, parallelism=2)
+        runner.apply((i for i in range(50)), tag="a", queue_size=1)
+
+    records = _read_records(out_dir)
+    docs = sorted(int(doc) for lines in records.values() for _, doc in lines)
+    assert docs == list(range(50))
+
+
+def test_commit_policy(caplog, tmpdir):
+    """Test that UDFs commit their session periodically."""
+    caplog.set_level(logging.INFO)
+
+    policy = CommitPolicy(docs=None, objects=5)
+    assert not policy.update(2)
+    assert policy.update(3)
+    policy.reset()
+    assert not policy.update(4)
+
+    policy = CommitPolicy(docs=3, seconds=0)
+    assert policy.update(0)
+    assert not CommitPolicy(docs=None).update(100)
+
+    out_dir = str(tmpdir)
+    with patch("fonduer.utils.udf.new_sessionmaker", autospec=True):
+        runner = RecordingRunner(MagicMock(), out_dir, parallelism=1)
+        with WorkerPool() as pool:
+            runner.apply(
+                list(range(10)),
+                tag="a",
+                pool=pool,
+                commit_policy=CommitPolicy(docs=4),
+                progress_bar=False,
+            )
+            session = runner.pooled_udf.session
+            # Two periodic commits and a final commit
+            assert session.commit.call_count == 3
+            assert session.expunge_all.call_count == 3
+
+
+def test_commit_policy_rows_written(caplog):
+    """Test that the rows a UDF writes itself count towards the commit policy."""
+    caplog.set_level(logging.INFO)
+
+    with patch("fonduer.utils.udf.new_sessionmaker", autospec=True):
+        udf = UDF()
+    udf.commit_policy = CommitPolicy(docs=None, objects=5)
+
+    def apply(doc):
+        # e.g. upsert 3 rows, and return no object
+        udf._rows_written += 3
+        return []
+
+    udf.apply = apply
+    for doc in range(4):
+        udf._apply_doc(doc, {})
+    assert udf.session.commit.call_count == 2
+
+
+def test_commit_policy_loaded_docs(caplog):
+    """Test that a UDF does not commit before the loaded documents are applied."""
+    caplog.set_level(logging.INFO)
+
+    with patch("fonduer.utils.udf.new_sessionmaker", autospec=True):
+        udf = UDF(in_queue=Queue(), out_queue=Queue())
+    udf.pass_ids = True
+    udf.commit_policy = CommitPolicy(docs=2)
+    # A commit expunges the session, which would detach the loaded documents
+    commits = []
+    udf.apply = lambda doc: commits.append(udf.session.commit.call_count) or []
+    udf._load_docs = lambda doc_ids: list(doc_ids)
+
+    udf.in_queue.put([0, 1, 2, 3, 4])
+    udf.in_queue.put([5])
+    udf.in_queue.put(UDF.QUEUE_CLOSED)
+    assert not udf._process_queue()
+    # One commit after the first chunk, and a final commit
+    assert commits == [0, 0, 0, 0, 0, 1]
+    assert udf.session.commit.call_count == 2
+
+
+def test_profile_apply(caplog, tmpdir):
+    """Test that the workers send their profile records to the runner."""
+    caplog.set_level(logging.INFO)
+
+    out_dir = str(tmpdir)
+    with patch("fonduer.utils.udf.new_sessionmaker", autospec=True), patch.object(
+        udf_module._meta, "postgres", True
+    ):
+        runner = RecordingRunner(MagicMock(), out_dir, parallelism=2)
+        runner.apply(list(range(6)), tag="a", profile=True, progress_bar=False)
+        # One record per document, and one per worker for its final commit
+        assert len(runner.profile.records) == 6 + 2
+        assert "commit" in runner.profile.summary()["phases"]
+        assert runner.profile.summary()["phases"]["apply"]["total"] > 0
+
+        runner.apply(list(range(6)), tag="a", parallelism=1, progress_bar=False)
+        assert runner.profile is None
+
+
+def test_recycle_workers(caplog, tmpdir):
+    """Test that workers are replaced once they reach their limit."""
+    caplog.set_level(logging.INFO)
+
+    assert not RecyclePolicy().due(100)
+    assert RecyclePolicy(docs=3).due(3)
+    assert RecyclePolicy(memory=0).due(0)
+
+    out_dir = str(tmpdir)
+    with patch("fonduer.utils.udf.new_sessionmaker", autospec=True), patch.object(
+        udf_module._meta, "postgres", True
+    ):
+        runner = RecordingRunner(MagicMock(), out_dir, parallelism=2)
+        runner.apply(
+            list(range(20)),
+            tag="a",
+            recycle_policy=RecyclePolicy(docs=3),
+            progress_bar=False,
+        )
+
+    records = _read_records(out_dir)
+    # Each worker processes at most 3 documents before being replaced
+    assert len(records) >= 7
+    assert all(len(lines) <= 3 for lines in records.values())
+    docs = sorted(int(doc) for lines in records.values() for _, doc in lines)
+    assert docs == list(range(20))
+
+
+def test_distributed_tasks(caplog, tmpdir):
+    """Test that workers share the tasks of the database and renew their lease."""
+    caplog.set_level(logging.INFO)
+
+    session = Meta.init("postgres://localhost:5432/" + DB).Session()
+    out_dir = str(tmpdir)
+    runner = RecordingRunner(session, out_dir, parallelism=2, udf_class=SlowUDF)
+
+    # The slow tasks take longer than the lease, which their worker renews
+    # while the other worker claims the fast ones
+    docs = ["slow{}".format(i) for i in range(4)]
+    docs += ["fast{}".format(i) for i in range(60)]
+    with patch.object(udf_module, "TASK_LEASE_SECONDS", 1.5):
+        runner.apply(docs, tag="a", distributed=True, chunk_size=4, progress_bar=False)
+
+    records = _read_records(out_dir)
+    assert len(records) == 2
+    assert sorted(doc for lines in records.values() for _, doc in lines) == sorted(
+        docs
+    )
+    tasks = session.query(UDFTask).filter(UDFTask.stage == "RecordingRunner")
+    assert {task.status for task in tasks} == {"done"}
+
+    # A task whose lease expired is claimed again
+    config_hash = udf_module._config_hash(runner.udf_init_kwargs, {"tag": "b"})
+    session.add(
+        UDFTask(
+            stage="RecordingRunner",
+            config_hash=config_hash,
+            status="running",
+            payload=pickle.dumps("lost"),
+            worker="host:0",
+            updated=datetime.now(timezone.utc) - timedelta(hours=2),
+        )
+    )
+    session.commit()
+    runner.work(parallelism=1, tag="b", progress_bar=False)
+
+    records = _read_records(out_dir)
+    assert [
+        doc for lines in records.values() for tag, doc in lines if tag == "b"
+    ] == ["lost"]
+    task = session.query(UDFTask).filter(UDFTask.config_hash == config_hash).one()
+    assert task.status == "done"
+    assert task.worker != "host:0"